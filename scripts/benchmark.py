@@ -0,0 +1,348 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the stages of the normative-modelling pipeline on synthetic data.
+
+Generates a long-format bundle table (subject_id, session_id, bundle, age,
+sex, cohort and one column per metric) with the age ranges of the six
+cohorts, and a stack of connectivity matrices, at the requested sizes. Then
+it times each stage, `--repeats` times:
+    split          Per-bundle CSV files (and parquet row groups), as bundleGAMLSS.py writes them.
+    fits           GAMLSS fit of every metric of one bundle with gamlss.R (only with --rscript),
+                   also reported per metric.
+    centiles       Loading and pivoting of the centile tables of a bundle.
+    plot           Rendering of the centile figure of a bundle.
+    graph_metrics  Graph metrics of the connectome stack.
+    bootstrap      Bootstrap of the connection frequencies of the connectome stack.
+    startup        Start-up time (interpreter and imports) of the script of every cli.py
+                   command, run with -h, also reported per script.
+
+Results are written to JSON with the commit, CPU count and sizes of the
+run, so that runs can be compared across commits and core counts with
+--compare.
+
+Usage:
+    python benchmark.py bench.json [--n_subjects 2000] [--n_bundles 10] [--rscript gamlss.R -n 4]
+    python benchmark.py bench_new.json --compare bench_old.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from cli import COMMANDS
+from connection_frequency import binarize, bootstrap_frequency
+from gamlss_io import load_centiles, write_bundle_table
+from gamlss_jobs import FitJob, fit_runner, metric_fits, run_fit_jobs
+from gamlss_plots import COHORT_ORDER, plot_centiles
+from graph_metrics import compute_graph_metrics
+
+
+STAGES = ["split", "fits", "centiles", "plot", "graph_metrics", "bootstrap", "startup"]
+
+# Age range (years) and relative size of each cohort.
+COHORTS = {
+    "MYRNA": ((0.0, 2.0), 0.10),
+    "BCP": ((0.0, 5.0), 0.20),
+    "ABCD": ((9.0, 14.0), 0.35),
+    "GESTE": ((6.0, 12.0), 0.05),
+    "BANDA": ((14.0, 17.5), 0.10),
+    "PING": ((3.0, 18.0), 0.20),
+}
+
+# Value at birth, value at 18 years and noise of the synthetic metrics.
+METRIC_TRENDS = {
+    "fa": (0.30, 0.50, 0.03),
+    "md": (1.5e-3, 0.8e-3, 0.05e-3),
+    "ad": (1.9e-3, 1.3e-3, 0.06e-3),
+    "rd": (1.3e-3, 0.6e-3, 0.05e-3),
+    "afd_fixel": (0.25, 0.55, 0.04),
+}
+
+PROBS = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("out_json",
+                   help="Output JSON file with the timings.")
+    p.add_argument("--stages",
+                   help="Stages to run.",
+                   nargs="+",
+                   choices=STAGES,
+                   default=STAGES)
+    p.add_argument("--n_subjects",
+                   type=int,
+                   help="Number of sessions of the synthetic bundle table.",
+                   default=2000)
+    p.add_argument("--n_bundles",
+                   type=int,
+                   help="Number of bundles of the synthetic bundle table.",
+                   default=10)
+    p.add_argument("--metric",
+                   help="Metrics of the synthetic bundle table.",
+                   nargs="+",
+                   choices=list(METRIC_TRENDS),
+                   default=list(METRIC_TRENDS))
+    p.add_argument("--n_connectomes",
+                   type=int,
+                   help="Number of synthetic connectivity matrices.",
+                   default=200)
+    p.add_argument("--n_nodes",
+                   type=int,
+                   help="Number of nodes of the synthetic connectivity matrices.",
+                   default=83)
+    p.add_argument("--n_bootstrap",
+                   type=int,
+                   help="Number of bootstrap iterations.",
+                   default=1000)
+    p.add_argument("--rscript",
+                   help="Path to gamlss.R. The fits stage is skipped without it.",
+                   default=None)
+    p.add_argument("-n", "--n_cpus",
+                   type=int,
+                   help="Number of CPUs used by the fits.",
+                   default=1)
+    p.add_argument("--repeats",
+                   type=int,
+                   help="Number of times each stage is run.",
+                   default=3)
+    p.add_argument("--seed",
+                   type=int,
+                   help="Seed of the synthetic data.",
+                   default=0)
+    p.add_argument("--compare",
+                   help="Previous benchmark JSON to compare the median timings with.",
+                   default=None)
+
+    return p
+
+
+def synthetic_bundle_table(n_subjects, n_bundles, metrics, seed=0):
+    """
+    Long-format bundle table with the age range and relative size of every
+    cohort, both sexes and one column per metric following a smooth age
+    trend with cohort offsets.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(COHORTS)
+    weights = np.array([COHORTS[c][1] for c in names])
+    cohort = rng.choice(names, size=n_subjects, p=weights / weights.sum())
+    low, high = np.array([COHORTS[c][0] for c in cohort]).T
+    age = rng.uniform(low, high)
+    sex = rng.choice(["M", "F"], size=n_subjects)
+    offset = dict(zip(names, rng.normal(0, 0.5, len(names))))
+
+    subjects = pd.DataFrame({
+        "subject_id": [f"sub-{i:05d}" for i in range(n_subjects)],
+        "session_id": "ses-01",
+        "age": age,
+        "sex": sex,
+        "cohort": cohort,
+    })
+
+    tables = []
+    trend = np.log1p(age) / np.log1p(18)
+    for b in range(n_bundles):
+        df = subjects.assign(bundle=f"bundle{b:02d}")
+        for metric in metrics:
+            start, end, noise = METRIC_TRENDS[metric]
+            values = start + (end - start) * trend
+            values += noise * (np.array([offset[c] for c in cohort]) + rng.normal(size=n_subjects))
+            df[metric] = np.clip(values, 0.05 * min(start, end), None)
+        tables.append(df)
+    return pd.concat(tables, ignore_index=True)
+
+
+def synthetic_connectomes(n_connectomes, n_nodes, density=0.3, seed=0):
+    """
+    Symmetric, min-max normalized connectivity matrices with an empty
+    diagonal and log-normal weights.
+    """
+    rng = np.random.default_rng(seed)
+    weights = rng.lognormal(size=(n_connectomes, n_nodes, n_nodes))
+    weights *= rng.random((n_connectomes, n_nodes, n_nodes)) < density
+    weights = np.triu(weights, 1)
+    weights += weights.transpose(0, 2, 1)
+    return weights / weights.max(axis=(1, 2), keepdims=True)
+
+
+def synthetic_centiles(df, metric, folder, n_ages=200):
+    """
+    Long-format centile table of a metric, as written by gamlss.R, from the
+    empirical quantiles of the data.
+    """
+    ages = np.linspace(df["age"].min(), df["age"].max(), n_ages)
+    values = np.quantile(df[metric], PROBS)
+    table = pd.DataFrame({"age": np.tile(ages, len(PROBS)),
+                          "prob": np.repeat(PROBS, n_ages),
+                          "metric": np.repeat(values, n_ages)})
+    table.to_csv(os.path.join(folder, f"{metric}_centiles_by_age.csv"), index=False)
+
+
+def _time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _summary(times):
+    return {"times": times, "median": float(np.median(times)), "min": float(np.min(times)),
+            "mean": float(np.mean(times))}
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args, workdir):
+    """
+    Time every requested stage in `workdir`. Returns the summary of each
+    stage, keyed by name.
+    """
+    results = {}
+    df = synthetic_bundle_table(args.n_subjects, args.n_bundles, args.metric, args.seed)
+    bundles = list(df["bundle"].unique())
+    bundle_df = df[df["bundle"] == bundles[0]]
+    bundle_dir = os.path.join(workdir, bundles[0])
+    os.makedirs(bundle_dir, exist_ok=True)
+    fits = metric_fits(bundle_df, args.metric)
+
+    if "split" in args.stages:
+        def _split():
+            for bundle in bundles:
+                df[df["bundle"] == bundle].to_csv(os.path.join(workdir, f"{bundle}_data.csv"), index=False)
+        results["split"] = _summary(_time(_split, args.repeats))
+        try:
+            results["split_parquet"] = _summary(_time(
+                lambda: write_bundle_table(df, os.path.join(workdir, "bundles_data.parquet"), bundles),
+                args.repeats))
+        except ImportError:
+            print("pyarrow is not installed, skipping the parquet split.")
+
+    if "fits" in args.stages and args.rscript is not None:
+        input_path = os.path.join(workdir, f"{bundles[0]}_data.csv")
+        bundle_df.to_csv(input_path, index=False)
+        per_metric = {}
+
+        def _fits():
+            jobs = [FitJob(bundles[0], metric, input_path, bundle_dir, column=column, cohorts=cohorts)
+                    for metric, column, _, cohorts in fits]
+            with fit_runner(args.rscript, args.n_cpus) as run_job:
+                run_fit_jobs(jobs, run_job, args.n_cpus)
+            for job in jobs:
+                if job.returncode != 0:
+                    raise RuntimeError(f"GAMLSS fit failed for {job.metric}, see {job.log_file}")
+                per_metric.setdefault(job.metric, []).append(job.wall_time)
+        results["fits"] = _summary(_time(_fits, args.repeats))
+        for metric, times in per_metric.items():
+            results[f"fits/{metric}"] = _summary(times)
+    elif "fits" in args.stages:
+        print("No --rscript given, skipping the fits.")
+
+    # Without the fits, synthetic centile tables stand in for the R outputs.
+    if not os.path.exists(os.path.join(bundle_dir, f"{fits[0][0]}_centiles_by_age.csv")):
+        for metric, _, data, _ in fits:
+            synthetic_centiles(data, metric, bundle_dir)
+
+    if "centiles" in args.stages:
+        results["centiles"] = _summary(_time(lambda: load_centiles(bundle_dir), args.repeats))
+
+    if "plot" in args.stages:
+        centiles = load_centiles(bundle_dir)
+        plot_path = os.path.join(workdir, "benchmark_centiles.png")
+        results["plot"] = _summary(_time(lambda: plot_centiles(bundle_df, args.metric, centiles, plot_path),
+                                         args.repeats))
+
+    if {"graph_metrics", "bootstrap"} & set(args.stages):
+        matrices = synthetic_connectomes(args.n_connectomes, args.n_nodes, seed=args.seed)
+        if "graph_metrics" in args.stages:
+            results["graph_metrics"] = _summary(_time(lambda: compute_graph_metrics(matrices), args.repeats))
+        if "bootstrap" in args.stages:
+            binary = binarize(matrices)
+            results["bootstrap"] = _summary(_time(
+                lambda: bootstrap_frequency(binary, len(binary), args.n_bootstrap, ci=95, seed=args.seed),
+                args.repeats))
+
+    if "startup" in args.stages:
+        scripts_dir = os.path.dirname(os.path.abspath(__file__))
+        startup = []
+        for module in dict.fromkeys(module for module, _, _ in COMMANDS.values()):
+            command = [sys.executable, os.path.join(scripts_dir, f"{module}.py"), "-h"]
+            times = _time(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True), args.repeats)
+            results[f"startup/{module}"] = _summary(times)
+            startup.append(times)
+        results["startup"] = _summary(np.sum(startup, axis=0).tolist())
+
+    return results
+
+
+def compare(results, baseline):
+    """
+    Print the median time of every stage next to the one of a previous run.
+    """
+    print(f"{'stage':<24}{'baseline (s)':>14}{'current (s)':>14}{'speedup':>10}")
+    for stage, summary in results.items():
+        if stage not in baseline:
+            continue
+        old, new = baseline[stage]["median"], summary["median"]
+        print(f"{stage:<24}{old:>14.3f}{new:>14.3f}{old / new:>9.2f}x")
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmark(args, workdir)
+
+    out = {
+        "meta": {
+            "commit": _commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "n_cpus": args.n_cpus,
+            "sizes": {k: getattr(args, k) for k in ("n_subjects", "n_bundles", "n_connectomes",
+                                                    "n_nodes", "n_bootstrap", "repeats", "seed")},
+            "metrics": args.metric,
+            "cohorts": COHORT_ORDER,
+        },
+        "stages": results,
+    }
+    with open(args.out_json, 'w') as f:
+        json.dump(out, f, indent=2)
+
+    for stage, summary in results.items():
+        print(f"{stage}: median {summary['median']:.3f} s over {len(summary['times'])} runs")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["sizes"] != out["meta"]["sizes"]:
+            print("Warning: the baseline was run with different sizes.")
+        compare(results, baseline["stages"])
+
+
+if __name__ == "__main__":
+    main()
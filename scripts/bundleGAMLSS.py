@@ -6,16 +6,22 @@ per bundle.
 """
 
 import argparse
-import subprocess
 import os
-import shutil
 
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib import axes, font_manager
-import seaborn as sns
 from tqdm import tqdm
 
+from cohort_qc import print_summary, run_qc
+from demographics import DemographicsRegistry
+from gamlss_args import add_fit_arguments
+from gamlss_bootstrap import report_incomplete, run_bootstrap
+from gamlss_cache import FitCache, cached_runner, file_hash, update_args
+from gamlss_io import bundle_row_groups, write_bundle_table
+from gamlss_jobs import FitJob, fit_runner, metric_fits, run_fit_jobs, write_timing_report
+from gamlss_manifest import new_run_id, reset_output_dir, write_manifest, write_records
+from gamlss_plots import PlotRenderer, plot_bundle
+from gamlss_shard import JobQueue, run_shard, write_atomic
+
 
 def _build_arg_parser():
     p = argparse.ArgumentParser(description=__doc__,
@@ -36,53 +42,189 @@ def _build_arg_parser():
                    help="Metric for which fit the GAMLSS model.",
                    nargs="+",
                    required=True)
-    p.add_argument("--rscript",
-                   help="Path to the R script that fits the GAMLSS model.",
-                   required=True)
-    p.add_argument("-n", "--n_cpus",
+    add_fit_arguments(p)
+    p.add_argument("--exchange",
+                   choices=["csv", "parquet"],
+                   help="Format of the data handed to gamlss.R. 'parquet' writes the input\n"
+                   "table once with one row group per bundle, each fit reading only its own\n"
+                   "slice and columns, and reads the centiles back in wide format.",
+                   default="csv")
+    p.add_argument("--plot_cpus",
                    type=int,
-                   help="Number of CPUs to use.",
+                   help="Number of processes rendering the figures (while the fits run, or with\n"
+                   "--plots_only and --merge).",
                    default=1)
-    p.add_argument("-f", "--force",
+    p.add_argument("--shard",
+                   action="store_true",
+                   help="Run as one of several workers sharing output_dir (e.g. job-array tasks):\n"
+                   "fits are claimed through lock files in output_dir/.queue, completed fits\n"
+                   "are skipped on restart and output_dir is never wiped. Workers may fit\n"
+                   "different --bundle subsets, but refuse to join a queue created with\n"
+                   "another input table or model options. Run --merge once every worker is done.",
+                   default=False)
+    p.add_argument("--merge",
+                   action="store_true",
+                   help="Assemble the results of the --shard workers: render the figures and\n"
+                   "write the timing report and the manifest.",
+                   default=False)
+    p.add_argument("--lock_timeout",
+                   type=float,
+                   help="Age (hours) after which the lock of a --shard fit is considered stale,\n"
+                   "e.g. left by a killed worker, and the fit is rerun. Running workers\n"
+                   "refresh the locks of their fits, however long these take.",
+                   default=24.0)
+    p.add_argument("--qc",
                    action="store_true",
-                   help="Overwrite output folder.",
+                   help="Quality-control the input table first (cohort_qc.py): drop the rows\n"
+                   "with NA, non-finite or non-positive values and the sessions with\n"
+                   "outliers. The filtered table (<in_dataframe>_qc.tsv) is reused as long\n"
+                   "as the input table does not change.",
+                   default=False)
+    p.add_argument("--plots_only", "--plots-only",
+                   action="store_true",
+                   help="Re-render every figure from the results already in output_dir,\n"
+                   "without running R.",
                    default=False)
 
     return p
 
 
-def fetch_font(font_name="Harding"):
+def load_table(args):
+    """
+    Load the input table, joined to the --demographics registry and
+    quality-controlled with --qc.
+    """
+    if not args.qc:
+        df = pd.read_csv(args.in_dataframe, sep="\t", dtype={"subject_id": str, "session_id": str})
+        if args.demographics is not None:
+            df = DemographicsRegistry.load(args.demographics).join(df)
+        return df
+    output = os.path.splitext(args.in_dataframe)[0] + "_qc.tsv"
+    df, summary = run_qc([args.in_dataframe], output, args.metric, demographics=args.demographics)
+    print_summary(output, summary)
+    return df
+
+
+def shard_spec(args):
+    """
+    Inputs and options the fits of the --shard workers depend on. Workers
+    may fit different --bundle or --metric subsets.
     """
-    Fetch a font from the matplotlib font manager.
+    return {
+        "in_dataframe": file_hash(args.in_dataframe),
+        "demographics": None if args.demographics is None else file_hash(args.demographics),
+        "qc": args.qc,
+        "rscript": file_hash(args.rscript),
+        "search": args.search,
+        "sbc_tol": args.sbc_tol,
+        "update": args.update,
+    }
+
+
+def render_existing(args):
     """
-    font_files = []
-    for font in font_manager.findSystemFonts(fontpaths=None, fontext='ttf'):
-        if font_name.lower() in font.lower():
-            font_files.append(font)
-    if not font_files:
-        raise ValueError(f"Font {font_name} not found in system fonts.")
+    Re-render the figure of every bundle that has results in the output
+    folder, without running R.
+    """
+    df = load_table(args)
+    bundles = df["bundle"].unique() if args.bundle is None else args.bundle
+    bundles = [b for b in bundles if os.path.isdir(os.path.join(args.output_dir, b))]
 
-    for font_file in font_files:
-        font_manager.fontManager.addfont(font_file)
+    with PlotRenderer(args.plot_cpus) as renderer:
+        for bundle in bundles:
+            renderer.submit(bundle, plot_bundle, bundle, df[df["bundle"] == bundle], args.metric,
+                            os.path.join(args.output_dir, bundle), args.output_dir)
+        paths, errors = renderer.wait()
 
+    print(f"Rendered {len(paths)} figures.")
+    for bundle, e in errors:
+        print(f"Plotting failed for bundle {bundle}: {e}")
 
-def main():
-    parser = _build_arg_parser()
-    args = parser.parse_args()
 
-    # Look if output folder exists.
-    if os.path.exists(args.output_dir):
+def merge_shards(args):
+    """
+    Assemble the results of the --shard workers: render the figure of every
+    bundle whose fits all succeeded, and write the timing report and the
+    manifest from the status of every fit.
+    """
+    df = load_table(args)
+    bundles = df["bundle"].unique() if args.bundle is None else args.bundle
+    job_queue = JobQueue(args.output_dir)
+
+    records = []
+    pending = []
+    with PlotRenderer(args.plot_cpus) as renderer:
+        for bundle in bundles:
+            bundle_df = df[df["bundle"] == bundle]
+            bundle_output_dir = os.path.join(args.output_dir, bundle)
+            statuses = [(metric, job_queue.status(FitJob(bundle, metric, "", bundle_output_dir)))
+                        for metric, _, _, _ in metric_fits(bundle_df, args.metric)]
+            pending += [f"{bundle}/{metric}" for metric, status in statuses if status is None]
+            records += [status for _, status in statuses if status is not None]
+            if all(status is not None and status["returncode"] == 0 for _, status in statuses):
+                renderer.submit(bundle, plot_bundle, bundle, bundle_df, args.metric,
+                                bundle_output_dir, args.output_dir)
+        paths, plot_errors = renderer.wait()
+
+    for record in records:
+        plot_time = renderer.render_times.get(record["bundle"])
+        record["plot_time_s"] = None if plot_time is None else round(plot_time, 3)
+    write_records(args.manifest or os.path.join(args.output_dir, "gamlss_manifest.jsonl"), records)
+
+    # Report per-job queue-wait and wall time.
+    timing = pd.DataFrame(records, columns=["bundle", "metric", "queue_wait_s", "wall_time_s",
+                                            "returncode", "cached"])
+    timing.sort_values("wall_time_s", ascending=False).to_csv(
+        os.path.join(args.output_dir, "gamlss_jobs_timing.tsv"), sep="\t", index=False, float_format="%.2f")
+
+    print(f"Rendered {len(paths)} figures.")
+    for bundle, e in plot_errors:
+        print(f"Plotting failed for bundle {bundle}: {e}")
+    for record in records:
+        if record["returncode"] != 0:
+            print(f"GAMLSS fit failed for {record['bundle']}/{record['metric']}, "
+                  f"see {os.path.join(args.output_dir, record['bundle'], record['metric'] + '_gamlss.log')}")
+    if pending:
+        print(f"{len(pending)} fits are not done yet: {', '.join(pending)}")
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    if args.plots_only:
+        render_existing(args)
+        return
+    if args.merge:
+        merge_shards(args)
+        return
+    if args.rscript is None:
+        parser.error("--rscript is required unless --plots_only is used.")
+    if args.bootstrap_only and args.bootstrap <= 0:
+        parser.error("--bootstrap_only needs the number of replicates (--bootstrap).")
+    run_id = new_run_id()
+
+    # Look if output folder exists. Shard workers share it and resume from it,
+    # updates and bootstraps start from the models in it.
+    if args.shard or args.update or args.bootstrap_only:
+        os.makedirs(args.output_dir, exist_ok=True)
+    elif os.path.exists(args.output_dir):
         if args.force:
-            shutil.rmtree(args.output_dir)
-            os.makedirs(args.output_dir)
+            reset_output_dir(args.output_dir)
         else:
             raise FileExistsError(f"Output folder {args.output_dir} exists."
                                   " Use -f to overwrite.")
     else:
         os.makedirs(args.output_dir)
 
+    # Shard workers resuming the queue must fit the same data with the same model.
+    if args.shard:
+        job_queue = JobQueue(args.output_dir, args.lock_timeout)
+        job_queue.check_spec(shard_spec(args))
+
     # Load dataframe.
-    df = pd.read_csv(args.in_dataframe, sep="\t")
+    df = load_table(args)
 
     # Get list of bundles.
     if args.bundle is None:
@@ -90,199 +232,115 @@ def main():
     else:
         bundles = args.bundle
 
-    # Iterate over bundles.
-    for bundle in tqdm(bundles, desc="Fitting GAMLSS models for each provided bundle", unit="bundle"):
+    # Fits restored from the cache skip R entirely.
+    cache = None
+    if args.cache_dir is not None:
+        cache = FitCache(args.cache_dir, args.rscript, args.cache_size)
+
+    # Extra gamlss.R arguments. Only the ones changing the fitted model
+    # are part of the cache key.
+    model_args = ["--search", args.search, "--sbc_tol", str(args.sbc_tol)]
+    r_args = model_args + ["--n_cores", str(args.search_cores)]
+
+    missing = set(bundles) - set(df["bundle"])
+    if missing:
+        raise ValueError(f"Bundles not found in {args.in_dataframe}: {', '.join(sorted(missing))}.")
+
+    # With the parquet exchange format, the input table is written once with
+    # one row group per bundle. Inputs are written atomically, and only once
+    # for all shard workers: the first one writes every bundle, and the row
+    # groups are read back from the file, as it may come from another worker.
+    if args.exchange == "parquet":
+        data_path = os.path.join(args.output_dir, "bundles_data.parquet")
+        file_bundles = df["bundle"].unique() if args.shard else bundles
+        write_atomic(data_path, lambda tmp: write_bundle_table(df, tmp, file_bundles), skip_existing=args.shard)
+        row_groups = bundle_row_groups(data_path)
+        missing = set(bundles) - set(row_groups)
+        if missing:
+            raise ValueError(f"Bundles not found in {data_path}: {', '.join(sorted(missing))}.")
+
+    # Build the full bundle x metric job graph up front.
+    jobs = []
+    bundle_dfs = {}
+    for bundle in bundles:
         bundle_df = df[df["bundle"] == bundle]
-
-        # Save temporary dataframe.
-        temp_csv = os.path.join(args.output_dir, f"{bundle}_data.csv")
-        bundle_df.to_csv(temp_csv, index=False)
+        bundle_dfs[bundle] = bundle_df
 
         # Check for NAs values in the metric, age, sex, and cohort columns
         if bundle_df[args.metric + ["age", "sex", "cohort"]].isnull().values.any():
             raise ValueError(f"Bundle {bundle} contains NA values in the metric, age, sex, or cohort columns."
-                             " Please remove these rows before fitting the GAMLSS model.")
+                             " Please remove these rows before fitting the GAMLSS model, or use --qc.")
+
+        if args.exchange == "parquet":
+            input_path, row_group = data_path, row_groups[bundle]
+        else:
+            # Save temporary dataframe.
+            input_path, row_group = os.path.join(args.output_dir, f"{bundle}_data.csv"), None
+            write_atomic(input_path, lambda tmp: bundle_df.to_csv(tmp, index=False), skip_existing=args.shard)
 
         # Build output paths, we need a folder per bundle.
         bundle_output_dir = os.path.join(args.output_dir, bundle)
         os.makedirs(bundle_output_dir, exist_ok=True)
 
-        # Let's build a list of command to be executed in R but in parallel.
-        cmd = []
-        for metric in args.metric:
-            if metric == "afd_fixel":
-                low_bval_df = bundle_df[bundle_df['cohort'].isin(["MYRNA", "GESTE", "PING"])]
-                low_bval_df = low_bval_df.rename(columns={"afd_fixel": "afd_fixel_lowb"}, inplace=False)
-                low_bval_df.to_csv(os.path.join(args.output_dir, f"{bundle}_low_bval_data.csv"), index=False)
-                high_bval_df = bundle_df[bundle_df['cohort'].isin(["BCP", "ABCD", "BANDA"])]
-                high_bval_df = high_bval_df.rename(columns={"afd_fixel": "afd_fixel_highb"}, inplace=False)
-                high_bval_df.to_csv(os.path.join(args.output_dir, f"{bundle}_high_bval_data.csv"), index=False)
-
-                cmd.append([
-                    "Rscript",
-                    args.rscript,
-                    "--input", os.path.join(args.output_dir, f"{bundle}_low_bval_data.csv"),
-                    "--output", bundle_output_dir,
-                    "--metric", "afd_fixel_lowb"
-                ])
-                cmd.append([
-                    "Rscript",
-                    args.rscript,
-                    "--input", os.path.join(args.output_dir, f"{bundle}_high_bval_data.csv"),
-                    "--output", bundle_output_dir,
-                    "--metric", "afd_fixel_highb"
-                ])
-            else:
-                cmd.append([
-                    "Rscript",
-                    args.rscript,
-                    "--input", temp_csv,
-                    "--output", bundle_output_dir,
-                    "--metric", metric
-                ])
-
-        # Execute all commands using the allocated number of CPUs from args.n_cpus.
-        processes = []
-        for i in range(0, len(cmd), args.n_cpus):
-            for j in range(i, min(i + args.n_cpus, len(cmd))):
-                metric_name = cmd[j][-1]  # Get the metric name from the command
-                log_file = os.path.join(bundle_output_dir, f"{metric_name}_gamlss.log")
-                with open(log_file, 'w') as f:
-                    processes.append(subprocess.Popen(cmd[j], stdout=f, stderr=subprocess.STDOUT))
-            for p in processes:
-                p.wait()
-            processes = []
-
-        # Plotting
-        fetch_font("Harding")
-        plt.rcParams['font.family'] = 'Harding Text Web'
-        rocket_cmap = sns.color_palette("rocket_r", 6)
-        cohort_cmap = [rocket_cmap[0], rocket_cmap[1], rocket_cmap[2], rocket_cmap[3], rocket_cmap[4], rocket_cmap[5]]  # six cohorts
-
-        # Load results (batch load in a dict all files ending by "_centiles_by_age.csv") and merge them.
-        results_files = [f for f in os.listdir(bundle_output_dir) if f.endswith("_centiles_by_age.csv")]
-        results_dfs = {}
-        metric_names = []
-        for rf in results_files:
-            metric_name = rf.replace("_centiles_by_age.csv", "")
-            metric_names.append(metric_name)
-            temp_df = pd.read_csv(os.path.join(bundle_output_dir, rf))
-            results_dfs[metric_name] = temp_df
-            results_dfs[metric_name] = results_dfs[metric_name].pivot(index="age", columns='prob', values="metric").reset_index()
-
-        # Dict of y labels for each metric.
-        y_labels = {
-            "fa": "FA",
-            "md": "MD (mm²/s)",
-            "rd": "RD (mm²/s)",
-            "ad": "AD (mm²/s)",
-            "afd_fixel": "Fixel-based AFD",
-            "afd_fixel_lowb": "Fixel-based AFD",
-            "afd_fixel_highb": "Fixel-based AFD",
-        }
-
-        # Let's plot the data.
-        fig, ax = plt.subplots(2, len(args.metric) if len(args.metric) > 1 else 2, figsize=(18, 6), sharex=True, squeeze=True)
-        for i, metric in enumerate(args.metric):
-
-            # Let's define the ylim based on the data
-            # Take the max/min, and round to the next 0.1, 0.01, 0.001 or 0.0001 depending on the range.
-            data_max = bundle_df[metric].max()
-            data_min = bundle_df[metric].min()
-            data_range = data_max - data_min
-            if data_range > 0.1:
-                ylim_max = round(data_max + 0.1, 1)
-                ylim_min = round(max(0, data_min - 0.1), 1)
-            elif data_range > 0.01:
-                ylim_max = round(data_max + 0.01, 2)
-                ylim_min = round(max(0, data_min - 0.01), 2)
-            elif data_range > 0.001:
-                ylim_max = round(data_max + 0.001, 3)
-                ylim_min = round(max(0, data_min - 0.001), 3)
-            else:
-                ylim_max = round(data_max + 0.0001, 4)
-                ylim_min = round(max(0, data_min - 0.0001), 4)
-
-            sns.scatterplot(data=bundle_df, x="age", y=metric, ax=ax[0, i],
-                            hue="cohort", style="sex", palette=cohort_cmap, legend=False,
-                            hue_order=["MYRNA", "BCP", "ABCD", "GESTE", "BANDA", "PING"])
-            ax[0, i].set_ylim(ylim_min, ylim_max)
-            ax[0, i].set_ylabel(y_labels.get(metric, metric), fontsize=14, fontweight='bold')
-            ax[0, i].set_xlabel("")
-            ax[0, i].set_xticks([0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
-            ax[0, i].tick_params(axis='both', which='major', labelsize=10)
-
-            # Plot the centiles.
-            if metric == "afd_fixel":
-
-                sns.lineplot(data=results_dfs["afd_fixel_lowb"], x="age", y=0.05, ax=ax[1, i], color=rocket_cmap[1], linestyle='--', linewidth=2, legend=False)
-                sns.lineplot(data=results_dfs["afd_fixel_lowb"], x="age", y=0.5, ax=ax[1, i], color=rocket_cmap[1], linestyle='-', linewidth=2, legend=False)
-                sns.lineplot(data=results_dfs["afd_fixel_lowb"], x="age", y=0.95, ax=ax[1, i], color=rocket_cmap[1], linestyle='--', linewidth=2, legend=False)
-                ax[1, i].fill_between(results_dfs["afd_fixel_lowb"]['age'], results_dfs["afd_fixel_lowb"][0.05], results_dfs["afd_fixel_lowb"][0.95], color=rocket_cmap[1], alpha=0.2, zorder=-1)
-
-                sns.lineplot(data=results_dfs["afd_fixel_highb"], x="age", y=0.05, ax=ax[1, i], color=rocket_cmap[4], linestyle='--', linewidth=2, legend=False)
-                sns.lineplot(data=results_dfs["afd_fixel_highb"], x="age", y=0.5, ax=ax[1, i], color=rocket_cmap[4], linestyle='-', linewidth=2, legend=False)
-                sns.lineplot(data=results_dfs["afd_fixel_highb"], x="age", y=0.95, ax=ax[1, i], color=rocket_cmap[4], linestyle='--', linewidth=2, legend=False)
-                ax[1, i].fill_between(results_dfs["afd_fixel_highb"]['age'], results_dfs["afd_fixel_highb"][0.05], results_dfs["afd_fixel_highb"][0.95], color=rocket_cmap[4], alpha=0.2, zorder=-1)
-
-                ax[1, i].set_ylim(ylim_min, ylim_max)
-                ax[1, i].set_xlabel("Age (years)", fontsize=14, fontweight='bold')
-                ax[1, i].set_ylabel(y_labels.get(metric, metric), fontsize=14, fontweight='bold')
-                ax[1, i].set_xticks([0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
-                ax[1, i].tick_params(axis='both', which='major', labelsize=10)
-
-            else:
-                # Plot the centiles.
-                sns.lineplot(data=results_dfs[metric], x="age", y=0.05, ax=ax[1, i], color=rocket_cmap[0], linestyle='--', linewidth=2, legend=False)
-                sns.lineplot(data=results_dfs[metric], x="age", y=0.5, ax=ax[1, i], color=rocket_cmap[5], linestyle='-', linewidth=2, legend=False)
-                sns.lineplot(data=results_dfs[metric], x="age", y=0.95, ax=ax[1, i], color=rocket_cmap[0], linestyle='--', linewidth=2, legend=False)
-                ax[1, i].fill_between(results_dfs[metric]['age'], results_dfs[metric][0.05], results_dfs[metric][0.95], color=rocket_cmap[0], alpha=0.4, zorder=-1)
-                ax[1, i].set_ylim(ylim_min, ylim_max)
-                ax[1, i].set_xlabel("Age (years)", fontsize=14, fontweight='bold')
-                ax[1, i].set_ylabel(y_labels.get(metric, metric), fontsize=14, fontweight='bold')
-                ax[1, i].set_xticks([0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
-                ax[1, i].tick_params(axis='both', which='major', labelsize=10)
-
-        for row in ax:
-            for a in row:
-                a.spines['top'].set_visible(False)
-                a.spines['right'].set_visible(False)
-                a.spines[["left", "bottom"]].set_linewidth(2)
-                if a.get_ylim()[1] < 0.01:
-                    a.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
-
-        # Add global legends: sex, cohorts and centile labels (compact)
-        handles_sex = [plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="o", markeredgewidth=1, markeredgecolor='black'),
-                    plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="x", markeredgewidth=3, markeredgecolor='black')]
-        labels_sex = ["Male", "Female"]
-        fig.legend(handles_sex, labels_sex, loc="upper left", bbox_to_anchor=(0.90, 0.86), ncol=1, fontsize=12, frameon=False, title="Sex", title_fontproperties={'size': 14, 'weight': 'bold'})
-
-        handles_cohort = [plt.Line2D([0], [0], color=cohort_cmap[i], markersize=8, lw=0, marker="o", markeredgewidth=1, markeredgecolor='dimgrey') for i in range(len(cohort_cmap))]
-        labels_cohort = ["MYRNA", "BCP", "ABCD", "GESTE", "BANDA", "PING"]
-        fig.legend(handles_cohort, labels_cohort, loc="upper left", bbox_to_anchor=(0.90, 0.69), ncol=1, fontsize=12, frameon=False, title="Cohort", title_fontproperties={'size': 14, 'weight': 'bold'})
-
-        handles_centile = [plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='-', label='Median'),
-                            plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='--', label='5th/95th Percentiles')]
-        labels_centile = ["Median", "5th/95th Percentiles"]
-        fig.legend(handles_centile, labels_centile, loc="upper left", bbox_to_anchor=(0.90, 0.36), ncol=1, fontsize=12, frameon=False)
-
-        if "afd_fixel" in args.metric:
-            handles_centile = [plt.Line2D([0], [0], color=cohort_cmap[4], markersize=8, lw=3, linestyle='-', label='Multi-shell'),
-                                plt.Line2D([0], [0], color=cohort_cmap[1], markersize=8, lw=3, linestyle='-', label='Single-shell')]
-            labels_centile = ["Multi-shell", "Single-shell"]
-            fig.legend(handles_centile, labels_centile, loc="upper left", bbox_to_anchor=(0.90, 0.26), ncol=1, fontsize=12, frameon=False)
-
-        row_labels = ['a', 'b']
-        ax[0, 0].text(-0.2, 1.07, row_labels[0], transform=ax[0, 0].transAxes, fontsize=18, fontweight='bold', va='top', ha='right')
-        ax[1, 0].text(-0.2, 1.07, row_labels[1], transform=ax[1, 0].transAxes, fontsize=18, fontweight='bold', va='top', ha='right')
-
-        # Some adjustements to space between subplots.
-        plt.subplots_adjust(wspace=0.25)
-
-        #plt.tight_layout(rect=[0, 0, 1, 0.97])
-        plot_path = os.path.join(args.output_dir, f"{bundle}_GAMLSS_centiles.png")
-        plt.savefig(plot_path, dpi=300, bbox_inches='tight', facecolor='white')
-        plt.close()
+        # Fits for this bundle as (metric, input column, data, cohorts).
+        fits = metric_fits(bundle_df, args.metric)
+
+        for metric, column, data, cohorts in fits:
+            prev_args, prev_key_args = update_args(bundle_output_dir, metric) if args.update else ([], [])
+            job = FitJob(bundle, metric, input_path, bundle_output_dir, r_args + prev_args,
+                         column=column, cohorts=cohorts, row_group=row_group, n_rows=len(data))
+            if cache is not None:
+                job.cache_key = cache.key(data, metric, model_args + prev_key_args)
+            jobs.append(job)
+
+    if args.bootstrap_only:
+        for job in jobs:
+            job.returncode = 0 if os.path.exists(os.path.join(job.output_dir, f"gamlss_model_{job.metric}.rds")) else 1
+        with fit_runner(args.rscript, args.n_cpus, args.persistent_r) as run_job:
+            report_incomplete(run_bootstrap(jobs, run_job, args.n_cpus, args.bootstrap,
+                                            args.bootstrap_chunk, args.bootstrap_seed))
+        return
+
+    if args.shard:
+        with fit_runner(args.rscript, args.n_cpus, args.persistent_r) as run_job:
+            ran = run_shard(jobs, cached_runner(run_job, cache), job_queue, args.n_cpus, run_id, "bundleGAMLSS")
+        failed = [job for job in ran if job.returncode != 0]
+        print(f"{job_queue.owner}: ran {len(ran)} fits ({len(failed)} failed).")
+        for job in failed:
+            print(f"GAMLSS fit failed for {job.bundle}/{job.metric}, see {job.log_file}")
+        return
+
+    # Render a bundle in the background as soon as all of its fits are
+    # done, while the remaining fits keep the workers busy.
+    def _on_bundle_done(bundle, bundle_jobs):
+        failed = [job.metric for job in bundle_jobs if job.returncode != 0]
+        if failed:
+            tqdm.write(f"Skipping plot for bundle {bundle}: fit failed for {', '.join(failed)}.")
+            return
+        renderer.submit(bundle, plot_bundle, bundle, bundle_dfs[bundle], args.metric,
+                        os.path.join(args.output_dir, bundle), args.output_dir)
+
+    incomplete = []
+    with PlotRenderer(args.plot_cpus) as renderer:
+        with fit_runner(args.rscript, args.n_cpus, args.persistent_r) as run_job:
+            run_fit_jobs(jobs, cached_runner(run_job, cache), args.n_cpus, on_bundle_done=_on_bundle_done)
+            # Bootstrap replicates reuse the same workers once the fits are done.
+            if args.bootstrap > 0:
+                incomplete = run_bootstrap(jobs, run_job, args.n_cpus, args.bootstrap,
+                                           args.bootstrap_chunk, args.bootstrap_seed)
+        _, plot_errors = renderer.wait()
+
+    for bundle, e in plot_errors:
+        print(f"Plotting failed for bundle {bundle}: {e}")
+
+    # Report per-job queue-wait and wall time.
+    failed = write_timing_report(jobs, os.path.join(args.output_dir, "gamlss_jobs_timing.tsv"))
+    write_manifest(args.manifest or os.path.join(args.output_dir, "gamlss_manifest.jsonl"), jobs,
+                   run_id, "bundleGAMLSS", renderer.render_times)
+    for job in failed:
+        print(f"GAMLSS fit failed for {job.bundle}/{job.metric}, see {job.log_file}")
+    report_incomplete(incomplete)
+
 
 if __name__ == "__main__":
     main()
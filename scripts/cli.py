@@ -0,0 +1,119 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Single entry point of the pipeline scripts:
+    python cli.py [--config config.json] COMMAND [options of the command]
+
+Only the module of the command is imported, so that e.g. `cli.py qc` or
+`cli.py fit -h` do not load the plotting (matplotlib, seaborn) or imaging
+(nibabel) stacks, and the GAMLSS drivers only load the plotting stack once
+they render. The options of a command are those of its script, see
+`cli.py COMMAND -h`.
+
+--config is a JSON file of option defaults, named after the options of the
+scripts (n_cpus, rscript, demographics, ...). The "defaults" section applies
+to every command having the option, the section named after a command only
+to that command, and takes precedence. Options given on the command line
+take precedence over both:
+    {"defaults": {"n_cpus": 16, "demographics": "demographics.csv"},
+     "fit": {"rscript": "scripts/gamlss.R", "persistent_r": true}}
+
+Startup times of the commands are part of benchmark.py (--stages startup).
+"""
+
+import argparse
+import importlib
+import json
+
+
+# Command: (module, defaults of the command, description).
+COMMANDS = {
+    "fit": ("bundleGAMLSS", {}, "Fit and plot the bundle-wise GAMLSS models."),
+    "fit-network": ("networkGAMLSS", {}, "Fit and plot the GAMLSS models of the network metrics."),
+    "plot": ("bundleGAMLSS", {"plots_only": True}, "Re-render the bundle figures of existing fits."),
+    "score": ("scoreGAMLSS", {}, "Score new subjects against the fitted models."),
+    "centiles": ("gamlss_centiles", {}, "Centiles and z-scores of the fitted models, without R."),
+    "qc": ("cohort_qc", {}, "Quality control of the cohort bundle tables."),
+    "demographics": ("demographics", {}, "Build the demographics registry of the cohorts."),
+    "manifest": ("gamlss_manifest", {}, "Rank the slowest and least stable fits of run manifests."),
+    "collect": ("collect_metrics", {}, "Collect the per-session metric files into a table."),
+    "priors": ("diffusion_priors", {}, "Extract the diffusivity priors of every session."),
+    "split-volume": ("extract_first_volume", {}, "Move the first volume of the DWIs to fieldmaps."),
+    "connectome": ("connectome_store", {}, "Memory-mapped store of connectivity matrices."),
+    "graph-metrics": ("graph_metrics", {}, "Graph metrics of the connectivity matrices."),
+    "frequency": ("connection_frequency", {}, "Bootstrapped connection frequencies within age bins."),
+    "dice": ("dice_score", {}, "Test-retest Dice scores of the bundles."),
+    "fix-sidecars": ("fix_sidecars", {}, "Fix the dwi/fmap JSON sidecars of a BIDS dataset."),
+}
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter,
+                                epilog="Commands:\n" + "\n".join(
+                                    f"  {name:<16}{description}"
+                                    for name, (_, _, description) in COMMANDS.items()))
+
+    p.add_argument("--config",
+                   help="JSON file of option defaults.",
+                   default=None)
+    p.add_argument("command",
+                   choices=list(COMMANDS),
+                   metavar="COMMAND",
+                   help="Command to run, see below.")
+    p.add_argument("options",
+                   nargs=argparse.REMAINDER,
+                   help="Options of the command.")
+
+    return p
+
+
+def load_config(path, command):
+    """
+    Option defaults of `command` from the config file at `path`, as
+    ({option: value} of the shared section, {option: value} of the command).
+    """
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - set(COMMANDS) - {"defaults"}
+    if unknown:
+        raise ValueError(f"Unknown sections in {path}: {', '.join(sorted(unknown))}.")
+    return config.get("defaults", {}), config.get(command, {})
+
+
+def command_parser(command, config=None):
+    """
+    Module and argument parser of `command`, with the defaults of the
+    command and of the (shared, command) `config` sections applied.
+    """
+    module_name, command_defaults, _ = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    parser = module._build_arg_parser()
+    parser.prog = f"cli.py {command}"
+
+    # Positionals stay required, only options take defaults.
+    options = {action.dest for action in parser._actions if action.option_strings}
+    shared, own = config or ({}, {})
+    unknown = set(own) - options
+    if unknown:
+        raise ValueError(f"Unknown options for {command}: {', '.join(sorted(unknown))}.")
+    defaults = {**{k: v for k, v in shared.items() if k in options}, **own, **command_defaults}
+    # Required options (e.g. --metric) can come from the config.
+    for action in parser._actions:
+        if action.dest in defaults:
+            action.required = False
+    parser.set_defaults(**defaults)
+    return module, parser
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    config = load_config(args.config, args.command) if args.config else None
+    module, command = command_parser(args.command, config)
+    module.main(command.parse_args(args.options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Quality control of the bundle tables of every cohort ahead of the GAMLSS
+fits (replaces the outlier loops of the bundleModels notebook).
+
+The cohort tables (bundles_mean_stats.tsv) are concatenated and every metric
+value is flagged as:
+    missing       NA metric
+    non-finite    infinite metric
+    non-positive  metric <= 0
+    outlier       outside median +/- --iqr_factor * IQR of its bundle
+the first three being the values gamlss.R drops before each fit. Missing
+age, sex and cohort and non-finite age are flagged as well. The robust
+bounds of every bundle and metric come from a single groupby, on the valid
+values only.
+
+Rows with an invalid value are dropped, and so are all the rows of a session
+with an outlier (or only the outlier rows, with --outlier_scope row). The
+filtered table is written to <output>, the flagged values to
+<output>_report.tsv and the bounds to <output>_bounds.tsv.
+
+The hash of the inputs and of the QC options is recorded next to the output
+(<output>.qc.json): a later run with the same inputs reuses the outputs
+instead of redoing the check. With --demographics, the age, sex and cohort of
+the registry (demographics.py) are joined to the table before the check.
+bundleGAMLSS.py --qc runs it on its input table.
+
+Usage:
+    python cohort_qc.py PING/bundles_mean_stats.tsv BCP/bundles_mean_stats.tsv ...
+        all_cohort_bundles_mean_stats.tsv [--metrics fa md rd ad afd_fixel]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from demographics import DemographicsRegistry
+from gamlss_shard import write_atomic
+
+
+METRICS = ["fa", "md", "rd", "ad", "afd_fixel"]
+
+# Covariates every fit needs.
+COVARIATES = ["age", "sex", "cohort"]
+
+# Identifier columns, read as strings (session 01 must not become 1).
+ID_DTYPES = {"subject_id": str, "session_id": str, "sample": str, "session": str}
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("inputs",
+                   help="Bundle tables (TSV) of the cohorts, in the long format:\n"
+                   "subject_id,session_id,bundle,metric1,metric2,...",
+                   nargs="+")
+    p.add_argument("output",
+                   help="Filtered table (TSV).")
+    p.add_argument("--metrics",
+                   help="Metric columns to check.",
+                   nargs="+",
+                   default=METRICS)
+    p.add_argument("--demographics",
+                   help="Demographics registry (demographics.py) joined to the tables.",
+                   default=None)
+    p.add_argument("--iqr_factor",
+                   type=float,
+                   help="Half-width of the bounds around the median, in IQR.",
+                   default=5.0)
+    p.add_argument("--outlier_scope",
+                   choices=["session", "row"],
+                   help="Drop every row of a session with an outlier, or only the\n"
+                   "outlier rows.",
+                   default="session")
+    p.add_argument("-f", "--force",
+                   action="store_true",
+                   help="Redo the check even if the inputs did not change.",
+                   default=False)
+
+    return p
+
+
+def _report_path(output, name):
+    return f"{os.path.splitext(output)[0]}_{name}.tsv"
+
+
+def inputs_hash(inputs, options):
+    """
+    Hash of the content of the input files and of the QC options.
+    """
+    h = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+    for path in inputs:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def read_table(path):
+    """
+    Read a bundle table with string identifiers and empty (not NA) missing
+    sessions.
+    """
+    df = pd.read_csv(path, sep="\t", dtype=ID_DTYPES)
+    df = df.rename(columns={"sample": "subject_id", "session": "session_id"})
+    if "session_id" in df:
+        df["session_id"] = df["session_id"].fillna("")
+    return df
+
+
+def load_tables(inputs):
+    """
+    Concatenate the cohort tables, which must have the same columns.
+    """
+    frames = []
+    for path in inputs:
+        df = read_table(path)
+        if frames and set(df.columns) != set(frames[0].columns):
+            raise ValueError(f"{path} does not have the columns of {inputs[0]}.")
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def robust_bounds(df, metrics, iqr_factor=5.0):
+    """
+    Lower and upper bounds (median -/+ iqr_factor * IQR) of every bundle
+    (rows) and metric (columns), from the finite, positive values only.
+    """
+    values = df[metrics].where(df[metrics].gt(0) & np.isfinite(df[metrics]))
+    quantiles = values.groupby(df["bundle"]).quantile([0.25, 0.5, 0.75]).unstack()
+    q1, median, q3 = (quantiles.xs(q, axis=1, level=1) for q in (0.25, 0.5, 0.75))
+    return median - iqr_factor * (q3 - q1), median + iqr_factor * (q3 - q1)
+
+
+def flag_values(df, metrics, iqr_factor=5.0):
+    """
+    Flag every invalid or outlier value of `df`. Returns the bounds and
+    the flagged values, one row per value.
+    """
+    lower, upper = robust_bounds(df, metrics, iqr_factor)
+    values = df[metrics].to_numpy(dtype=np.float64)
+    row_lower = lower.reindex(index=df["bundle"], columns=metrics).to_numpy()
+    row_upper = upper.reindex(index=df["bundle"], columns=metrics).to_numpy()
+
+    with np.errstate(invalid="ignore"):
+        reasons = np.select([np.isnan(values), np.isinf(values), values <= 0,
+                             (values < row_lower) | (values > row_upper)],
+                            ["missing", "non-finite", "non-positive", "outlier"], default="")
+    rows, cols = np.nonzero(reasons)
+    flagged = pd.DataFrame({"row": rows, "column": np.asarray(metrics)[cols],
+                            "value": values[rows, cols], "lower": row_lower[rows, cols],
+                            "upper": row_upper[rows, cols], "reason": reasons[rows, cols]})
+
+    # Covariates are only checked for missing (and infinite age) values.
+    covariates = [c for c in COVARIATES if c in df]
+    if covariates:
+        invalid = df[covariates].isnull()
+        if "age" in covariates:
+            invalid["age"] |= np.isinf(pd.to_numeric(df["age"], errors="coerce"))
+        rows, cols = np.nonzero(invalid.to_numpy())
+        flagged = pd.concat([flagged, pd.DataFrame({
+            "row": rows, "column": np.asarray(covariates)[cols],
+            "value": df[covariates].to_numpy()[rows, cols],
+            "reason": np.where(df[covariates].isnull().to_numpy()[rows, cols], "missing", "non-finite"),
+        })], ignore_index=True)
+
+    bounds = pd.concat({"lower": lower.stack(), "upper": upper.stack()}, axis=1)
+    bounds.index.names = ["bundle", "metric"]
+    return bounds, flagged.sort_values(["row", "column"], ignore_index=True)
+
+
+def filter_table(df, flagged, outlier_scope="session"):
+    """
+    Drop the rows with an invalid value and the sessions (or rows) with an
+    outlier.
+    """
+    keep = np.ones(len(df), dtype=bool)
+    keep[flagged.loc[flagged["reason"] != "outlier", "row"]] = False
+
+    outlier_rows = flagged.loc[flagged["reason"] == "outlier", "row"].unique()
+    if outlier_scope == "session":
+        sessions = df["subject_id"].astype(str) + "/" + df["session_id"].fillna("").astype(str)
+        keep &= ~sessions.isin(sessions.iloc[outlier_rows]).to_numpy()
+    else:
+        keep[outlier_rows] = False
+    return df[keep]
+
+
+def run_qc(inputs, output, metrics=METRICS, iqr_factor=5.0, outlier_scope="session", force=False,
+           demographics=None):
+    """
+    Check the inputs, joined to the `demographics` registry if given, and
+    write the filtered table and the QC reports, unless they are up to date
+    with the inputs. Returns the filtered table and the QC summary.
+    """
+    options = {"metrics": list(metrics), "iqr_factor": iqr_factor, "outlier_scope": outlier_scope}
+    digest = inputs_hash(list(inputs) + ([demographics] if demographics else []), options)
+    state_path = output + ".qc.json"
+    outputs = [output, _report_path(output, "report"), _report_path(output, "bounds")]
+
+    if not force and os.path.exists(state_path) and all(os.path.exists(p) for p in outputs):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state["hash"] == digest:
+            return read_table(output), {**state["summary"], "cached": True}
+
+    df = load_tables(inputs)
+    if demographics is not None:
+        df = DemographicsRegistry.load(demographics).join(df)
+    missing = [c for c in ["subject_id", "bundle"] + list(metrics) if c not in df]
+    if missing:
+        raise ValueError(f"Columns not found in the inputs: {', '.join(missing)}.")
+    if "session_id" not in df:
+        df["session_id"] = ""
+    df[metrics] = df[metrics].apply(pd.to_numeric, errors="coerce")
+
+    bounds, flagged = flag_values(df, metrics, iqr_factor)
+    filtered = filter_table(df, flagged, outlier_scope)
+
+    report = pd.concat([df.loc[flagged["row"], ["subject_id", "session_id", "bundle"]].reset_index(drop=True),
+                        flagged.drop(columns="row")], axis=1)
+    summary = {
+        "n_rows": len(df),
+        "n_rows_kept": len(filtered),
+        "n_subjects": int(df["subject_id"].nunique()),
+        "n_subjects_kept": int(filtered["subject_id"].nunique()),
+        "n_flagged": {reason: int(n) for reason, n in flagged["reason"].value_counts().items()},
+    }
+
+    write_atomic(outputs[0], lambda tmp: filtered.to_csv(tmp, sep="\t", index=False))
+    write_atomic(outputs[1], lambda tmp: report.to_csv(tmp, sep="\t", index=False))
+    write_atomic(outputs[2], lambda tmp: bounds.to_csv(tmp, sep="\t"))
+    # The state is written last, so that it never points to partial outputs.
+    write_atomic(state_path, lambda tmp: _dump_state(tmp, digest, inputs, options, summary))
+    return filtered.reset_index(drop=True), {**summary, "cached": False}
+
+
+def _dump_state(path, digest, inputs, options, summary):
+    with open(path, 'w') as f:
+        json.dump({"hash": digest, "inputs": [os.path.abspath(p) for p in inputs],
+                   "options": options, "summary": summary}, f, indent=2)
+
+
+def print_summary(output, summary):
+    if summary["cached"]:
+        print(f"Inputs unchanged, reusing the QC of {output}.")
+    flags = ", ".join(f"{n} {reason}" for reason, n in summary["n_flagged"].items()) or "none"
+    print(f"Flagged values: {flags}.")
+    print(f"Kept {summary['n_rows_kept']}/{summary['n_rows']} rows and "
+          f"{summary['n_subjects_kept']}/{summary['n_subjects']} subjects.")
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    _, summary = run_qc(args.inputs, args.output, args.metrics, args.iqr_factor,
+                        args.outlier_scope, args.force, args.demographics)
+    print_summary(args.output, summary)
+    print(f"Filtered table saved to {args.output}, flagged values to "
+          f"{_report_path(args.output, 'report')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Collect the per-session diffusivity/FA metric files of a derivatives folder
+into a single table (replaces cmd_csv.sh).
+
+For every sub-*[/ses-*]/dwi folder, reads the first non-comment line of
+    *_desc-ad_1fiber.txt, *_desc-rd_1fiber.txt  -> mean, min, max
+    *_desc-fa_1fiber.txt                        -> value
+    *_desc-md_ventricles.txt                    -> mean, min, max
+Missing files and fields give NA values (nulls in parquet, as are fields
+that are not numbers).
+
+Sessions are parsed in a thread pool, a bounded number ahead of the writer,
+and rows are streamed to the output in session order (CSV, or parquet if the
+output ends with .parquet). The size and modification
+time of every file are recorded next to the output (<output>.state.json), so
+that a later run only re-reads the sessions whose files changed.
+
+Usage:
+    python collect_metrics.py /path/to/dataset output.csv [--n_threads 8]
+"""
+
+import argparse
+import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+COLUMNS = ["subject_id", "session_id", "ad_mean", "ad_min", "ad_max", "rd_mean", "rd_min",
+           "rd_max", "fa_1fiber", "md_mean", "md_min", "md_max"]
+
+# Metric files of a session, as (suffix, number of values read).
+METRIC_FILES = [
+    ("desc-ad_1fiber.txt", 3),
+    ("desc-rd_1fiber.txt", 3),
+    ("desc-fa_1fiber.txt", 1),
+    ("desc-md_ventricles.txt", 3),
+]
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("dataset",
+                   help="Derivatives folder containing the sub-* folders.")
+    p.add_argument("output",
+                   help="Output table (.csv or .parquet).")
+    p.add_argument("-n", "--n_threads",
+                   type=int,
+                   help="Number of threads reading the metric files.",
+                   default=8)
+    p.add_argument("--full",
+                   action="store_true",
+                   help="Re-read every session, ignoring the state of the previous run.",
+                   default=False)
+
+    return p
+
+
+def find_sessions(dataset):
+    """
+    List (subject_id, session_id, dwi_dir) for every session of the dataset,
+    session_id being empty for subjects without sessions.
+    """
+    sessions = []
+    subjects = sorted((e for e in os.scandir(dataset) if e.is_dir() and e.name.startswith("sub-")),
+                      key=lambda e: e.name)
+    for sub in subjects:
+        ses_dirs = sorted(e.name for e in os.scandir(sub.path) if e.name.startswith("ses-") and e.is_dir())
+        if ses_dirs:
+            sessions += [(sub.name, ses, os.path.join(sub.path, ses, "dwi")) for ses in ses_dirs]
+        else:
+            sessions.append((sub.name, "", os.path.join(sub.path, "dwi")))
+    return sessions
+
+
+def _metric_paths(subject_id, session_id, dwi_dir):
+    prefix = f"{subject_id}_{session_id}_" if session_id else f"{subject_id}_"
+    return [os.path.join(dwi_dir, prefix + suffix) for suffix, _ in METRIC_FILES]
+
+
+def _signature(paths):
+    """
+    Size and modification time of each file, None for missing files.
+    """
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append([st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+
+def read_stats(path, n_values):
+    """
+    Mean (first column) and, for 3 values, min and max (third and fourth
+    columns) of the first non-comment line of a metric file. Missing fields
+    (truncated or malformed line) are NA.
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if fields and not fields[0].startswith("#"):
+                    fields += ["NA"] * (4 - len(fields))
+                    return [fields[0]] if n_values == 1 else [fields[0], fields[2], fields[3]]
+    except FileNotFoundError:
+        pass
+    return ["NA"] * n_values
+
+
+def read_session(session, previous=None):
+    """
+    Row of a session, and the signature of its files. The row of the previous
+    run is reused when no file changed.
+    """
+    subject_id, session_id, dwi_dir = session
+    paths = _metric_paths(subject_id, session_id, dwi_dir)
+    signature = _signature(paths)
+    if previous is not None and previous["signature"] == signature:
+        return previous["row"], signature, False
+
+    row = [subject_id, session_id]
+    for path, (_, n_values) in zip(paths, METRIC_FILES):
+        row += read_stats(path, n_values)
+    return row, signature, True
+
+
+def read_sessions(sessions, state, n_threads):
+    """
+    Yield (session, row, signature, read) in session order, with at most a
+    few sessions per thread read ahead, so that memory does not grow with
+    the number of sessions.
+    """
+    window = 4 * max(1, n_threads)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        for session in sessions:
+            pending.append((session, executor.submit(read_session, session,
+                                                     state.get(f"{session[0]}/{session[1]}"))))
+            if len(pending) >= window:
+                session, future = pending.popleft()
+                yield (session, *future.result())
+        while pending:
+            session, future = pending.popleft()
+            yield (session, *future.result())
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        # NA, or a malformed field.
+        return None
+
+
+class _ParquetRowWriter:
+    """
+    Write rows to a parquet file by batches, NA and malformed values as
+    nulls.
+    """
+
+    def __init__(self, path, batch_size=10000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self.schema = pa.schema([(c, pa.string()) for c in COLUMNS[:2]] +
+                                [(c, pa.float64()) for c in COLUMNS[2:]])
+        self._writer = pq.ParquetWriter(path, self.schema)
+        self._rows = []
+        self.batch_size = batch_size
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        columns = list(zip(*self._rows))
+        arrays = [self._pa.array(columns[i], self._pa.string()) for i in range(2)]
+        arrays += [self._pa.array([_to_float(v) for v in col], self._pa.float64())
+                   for col in columns[2:]]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self.schema))
+        self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    state_path = args.output + ".state.json"
+    state = {}
+    if os.path.exists(state_path) and not args.full:
+        with open(state_path) as f:
+            state = json.load(f)
+
+    sessions = find_sessions(args.dataset)
+    new_state = {}
+    n_read = 0
+
+    # Rows are written in session order as soon as they are available.
+    tmp = os.path.join(os.path.dirname(os.path.abspath(args.output)),
+                       "." + os.path.basename(args.output) + ".tmp")
+    if args.output.endswith(".parquet"):
+        writer = out = _ParquetRowWriter(tmp)
+    else:
+        out = open(tmp, 'w', newline='')
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(COLUMNS)
+
+    for session, row, signature, was_read in tqdm(read_sessions(sessions, state, args.n_threads),
+                                                  total=len(sessions), desc="Reading sessions",
+                                                  unit="session"):
+        writer.writerow(row)
+        new_state[f"{session[0]}/{session[1]}"] = {"signature": signature, "row": row}
+        n_read += was_read
+
+    out.close()
+    os.replace(tmp, args.output)
+    with open(state_path, 'w') as f:
+        json.dump(new_state, f)
+
+    print(f"{len(sessions)} sessions written to {args.output} ({n_read} read, "
+          f"{len(sessions) - n_read} unchanged).")
+
+
+if __name__ == "__main__":
+    main()
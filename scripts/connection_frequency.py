@@ -0,0 +1,153 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Bootstrap the frequency (in %) of every connection within age bins.
+
+Each bin is resampled with replacement to the size of the smallest bin, so
+that every bin has the same statistical power. All bootstrap samples are
+drawn at once and turned into per-subject multiplicities, so that the
+frequencies of every sample are a single matrix product with the binarized
+(n_subjects, N * N) connections of the bin, computed by chunks of
+connections to bound memory.
+
+Usage:
+    python connection_frequency.py <store_dir> graph_metrics.csv <out_dir>
+        [--bins 0 0.25 1 2 5 10 18] [--n_bootstrap 1000] [--ci 95] [--seed 0]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from connectome_store import ConnectomeStore
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("store_dir",
+                   help="Connectome store built by connectome_store.py.")
+    p.add_argument("in_dataframe",
+                   help="CSV file with participant_id, session_id and age columns\n"
+                   "(e.g. the graph metrics merged with demographics).")
+    p.add_argument("out_dir",
+                   help="Output directory for the frequency matrices (.npy).")
+    p.add_argument("--bins",
+                   help="Edges of the age bins.",
+                   nargs="+",
+                   type=float,
+                   default=[0, 0.25, 1, 2, 5, 10, 18])
+    p.add_argument("--n_bootstrap",
+                   type=int,
+                   help="Number of bootstrap iterations.",
+                   default=1000)
+    p.add_argument("--ci",
+                   type=float,
+                   help="Also save the lower/upper bounds of this confidence interval (%%).",
+                   default=None)
+    p.add_argument("--seed",
+                   type=int,
+                   help="Seed of the random generator.",
+                   default=None)
+    p.add_argument("--chunk_size",
+                   type=int,
+                   help="Number of connections processed at once.",
+                   default=4096)
+
+    return p
+
+
+def binarize(matrices):
+    """
+    Connections present (> 0) in each matrix, flattened to (n_subjects, N * N).
+    """
+    matrices = np.asarray(matrices)
+    return (matrices > 0).reshape(len(matrices), -1)
+
+
+def bootstrap_frequency(binary, n_samples, n_bootstrap=1000, ci=None, seed=None, chunk_size=4096):
+    """
+    Bootstrap frequency (in %) of every connection of `binary`, the output of
+    binarize(), resampling `n_samples` subjects with replacement.
+
+    Returns a dict with the mean frequency over bootstrap samples ("mean")
+    and, if `ci` (in %) is given, the percentile bounds of the interval
+    ("lower" and "upper"), each as a flat array of N * N connections.
+    """
+    rng = np.random.default_rng(seed)
+    n_subjects = len(binary)
+
+    # Number of times each subject is drawn in each bootstrap sample.
+    samples = rng.integers(0, n_subjects, size=(n_bootstrap, n_samples))
+    counts = np.zeros((n_bootstrap, n_subjects), dtype=np.float32)
+    np.add.at(counts, (np.arange(n_bootstrap)[:, None], samples), 1)
+    counts *= 100 / n_samples
+
+    weights = counts.mean(axis=0, dtype=np.float64)
+    alpha = None if ci is None else (100 - ci) / 2
+
+    # One chunk of connections at a time.
+    result = {name: np.empty(binary.shape[1]) for name in
+              (["mean"] if ci is None else ["mean", "lower", "upper"])}
+    for start in range(0, binary.shape[1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        block = binary[:, chunk].astype(np.float32)
+        result["mean"][chunk] = weights @ block
+        if ci is not None:
+            # Frequencies of every bootstrap sample.
+            freq = counts @ block
+            result["lower"][chunk], result["upper"][chunk] = np.percentile(freq, [alpha, 100 - alpha], axis=0)
+
+    return result
+
+
+def age_bin_frequencies(store, df, bins, n_bootstrap=1000, ci=None, seed=None, chunk_size=4096):
+    """
+    Bootstrap connection frequencies of every age bin of `df` (participant_id,
+    session_id and age), resampled to the size of the smallest bin. Returns
+    the results of bootstrap_frequency() keyed by bin label, reshaped to
+    (N, N).
+    """
+    labels = [f"{low:g}-{high:g}" for low, high in zip(bins[:-1], bins[1:])]
+    df = df.assign(session_id=df["session_id"].fillna(""),
+                   age_bin=pd.cut(df["age"], bins=bins, labels=labels))
+    rows = store.index.merge(df[["participant_id", "session_id", "age_bin"]],
+                             on=["participant_id", "session_id"])
+
+    groups = {label: group.sort_values("offset") for label, group in rows.groupby("age_bin", observed=True)}
+    min_bin_size = min(len(group) for group in groups.values())
+
+    rng = np.random.default_rng(seed)
+    frequencies = {}
+    for label, group in groups.items():
+        n_nodes = int(group["n_nodes"].iloc[0])
+        result = bootstrap_frequency(binarize(store.get(group)), min_bin_size, n_bootstrap,
+                                     ci, rng, chunk_size)
+        frequencies[label] = {k: v.reshape(n_nodes, n_nodes) for k, v in result.items()}
+
+    return frequencies
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    store = ConnectomeStore(args.store_dir)
+    df = pd.read_csv(args.in_dataframe, dtype={"session_id": str})
+    frequencies = age_bin_frequencies(store, df, args.bins, args.n_bootstrap, args.ci,
+                                      args.seed, args.chunk_size)
+
+    for label, result in frequencies.items():
+        print(f"Bin {label}: mean frequency = {result['mean'].mean():.2f}%, max = {result['mean'].max():.2f}%")
+        for name, freq in result.items():
+            np.save(os.path.join(args.out_dir, f"frequency_{label}_{name}.npy"), freq)
+
+
+if __name__ == "__main__":
+    main()
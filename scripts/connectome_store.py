@@ -0,0 +1,263 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Consolidated, memory-mapped store of connectivity matrices.
+
+Every matrix of a given atlas size (e.g. 83 or 227 nodes) is stored in a
+single raw array (connectomes_<N>.dat) that is memory-mapped on open, and
+an index table (index.csv) gives the participant, session, cohort and row
+of each matrix. Matrices are min-max normalized when added, as done before
+computing graph metrics.
+
+Building is incremental: matrices whose source file is unchanged are
+skipped, new ones are appended at the end of their array.
+
+Usage:
+    python connectome_store.py <store_dir> --add MYRNA <MYRNAConnectivityMats> \
+        --add BCP <BCPConnectivityMats> ...
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+INDEX_COLUMNS = ["participant_id", "session_id", "cohort", "n_nodes", "offset", "source", "mtime"]
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("store_dir",
+                   help="Folder of the store, created if needed.")
+    p.add_argument("--add",
+                   help="Cohort name and folder of .npy matrices (sub-XXXX[_ses-XXXX]_*.npy)\n"
+                   "to add to the store. Can be repeated.",
+                   nargs=2,
+                   metavar=("COHORT", "DIR"),
+                   action="append",
+                   required=True)
+    p.add_argument("--dtype",
+                   help="Data type of a new store.",
+                   choices=["float32", "float64"],
+                   default="float64")
+    p.add_argument("--no_normalization",
+                   action="store_true",
+                   help="Store the matrices as they are, without min-max normalization\n"
+                   "(new store only).",
+                   default=False)
+
+    return p
+
+
+def normalize(mat):
+    """
+    Normalize between 0 and 1.
+    """
+    return (mat - np.min(mat)) / (np.max(mat) - np.min(mat))
+
+
+class ConnectomeStore:
+    """
+    Memory-mapped matrices and their index. Matrices are looked up by rows of
+    the index, and contiguous selections (e.g. a cohort added in one go, or
+    an age bin once the store is sorted by age with `reorder`) are returned
+    as views of the memory map without any copy.
+    """
+
+    def __init__(self, store_dir, dtype="float64", normalized=True):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        meta_path = os.path.join(store_dir, "store.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            meta = {"dtype": dtype, "normalized": normalized}
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        self.dtype = np.dtype(meta["dtype"])
+        self.normalized = meta["normalized"]
+
+        index_path = os.path.join(store_dir, "index.csv")
+        if os.path.exists(index_path):
+            self.index = pd.read_csv(index_path, dtype={"session_id": str}, keep_default_na=False)
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS)
+        self._maps = {}
+
+    def _data_path(self, n_nodes):
+        return os.path.join(self.store_dir, f"connectomes_{n_nodes}.dat")
+
+    def _save_index(self):
+        tmp = os.path.join(self.store_dir, ".index.csv.tmp")
+        self.index.to_csv(tmp, index=False)
+        os.replace(tmp, os.path.join(self.store_dir, "index.csv"))
+
+    @property
+    def sizes(self):
+        return sorted(int(n) for n in self.index["n_nodes"].unique())
+
+    def matrices(self, n_nodes):
+        """
+        Read-only memory map of every matrix with `n_nodes` nodes, in offset
+        order.
+        """
+        if n_nodes not in self._maps:
+            count = int((self.index["n_nodes"] == n_nodes).sum())
+            self._maps[n_nodes] = np.memmap(self._data_path(n_nodes), dtype=self.dtype, mode='r',
+                                            shape=(count, n_nodes, n_nodes))
+        return self._maps[n_nodes]
+
+    def get(self, rows):
+        """
+        Matrices of a selection of index rows (a boolean mask or a sub-table
+        of the index), which must all have the same size. A view of the
+        memory map is returned when the rows are contiguous in the store.
+        """
+        if not isinstance(rows, pd.DataFrame):
+            rows = self.index[rows]
+        sizes = rows["n_nodes"].unique()
+        if len(sizes) != 1:
+            raise ValueError(f"Selection mixes matrices of sizes {sorted(sizes)}, select one size.")
+
+        data = self.matrices(int(sizes[0]))
+        offsets = rows["offset"].to_numpy()
+        if len(offsets) and np.array_equal(offsets, np.arange(offsets[0], offsets[0] + len(offsets))):
+            return data[offsets[0]:offsets[0] + len(offsets)]
+        return data[offsets]
+
+    def to_dict(self):
+        """
+        Matrices keyed by (participant_id, session_id), as views of the
+        memory maps.
+        """
+        return {(row.participant_id, row.session_id): self.matrices(row.n_nodes)[row.offset]
+                for row in self.index.itertuples()}
+
+    def add(self, cohort, folder):
+        """
+        Add (or update) every matrix of a folder. Unchanged files are skipped.
+        Returns the number of matrices written.
+        """
+        known = {(row.participant_id, row.session_id): row for row in self.index.itertuples()}
+        new_rows = []
+        updated = []
+        handles = {}
+        counts = {}
+        sizes = {}
+        try:
+            for f in tqdm(sorted(os.listdir(folder)), desc=f"Adding {cohort}"):
+                if not f.endswith(".npy"):
+                    continue
+                source = os.path.abspath(os.path.join(folder, f))
+                mtime = os.stat(source).st_mtime_ns
+                sub = re.search(r'sub-[a-zA-Z0-9]+', f).group(0)
+                ses = re.search(r'ses-[a-zA-Z0-9]+', f)
+                key = (sub, ses.group(0) if ses else "")
+
+                row = known.get(key)
+                if row is not None and row.source == source and row.mtime == mtime:
+                    continue
+
+                mat = np.load(source)
+                if self.normalized:
+                    mat = normalize(mat)
+                mat = np.ascontiguousarray(mat, dtype=self.dtype)
+                n_nodes = mat.shape[0]
+
+                if row is not None:
+                    if row.n_nodes != n_nodes:
+                        raise ValueError(f"{source} has {n_nodes} nodes, the stored matrix of "
+                                         f"{key} has {row.n_nodes}.")
+                    # Overwrite the stored matrix in place.
+                    data = np.memmap(self._data_path(n_nodes), dtype=self.dtype, mode='r+',
+                                     offset=row.offset * mat.nbytes, shape=mat.shape)
+                    data[:] = mat
+                    data.flush()
+                    updated.append((row.Index, cohort, source, mtime))
+                    continue
+
+                # Append to the array of this atlas size, after the indexed matrices
+                # only: bytes left behind by an interrupted add are dropped.
+                if n_nodes not in handles:
+                    counts[n_nodes] = int((self.index["n_nodes"] == n_nodes).sum())
+                    handles[n_nodes] = open(self._data_path(n_nodes), 'ab')
+                    handles[n_nodes].truncate(counts[n_nodes] * mat.nbytes)
+                    sizes[n_nodes] = counts[n_nodes] * mat.nbytes
+                handles[n_nodes].write(mat.tobytes())
+                offset = counts[n_nodes]
+                counts[n_nodes] += 1
+                new_rows.append({"participant_id": key[0], "session_id": key[1], "cohort": cohort,
+                                 "n_nodes": n_nodes, "offset": offset, "source": source, "mtime": mtime})
+        except BaseException:
+            # Drop the matrices appended without index rows.
+            for n_nodes, handle in handles.items():
+                handle.truncate(sizes[n_nodes])
+            raise
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+        for i, cohort_name, source, mtime in updated:
+            self.index.loc[i, ["cohort", "source", "mtime"]] = [cohort_name, source, mtime]
+        if new_rows:
+            self.index = pd.concat([self.index, pd.DataFrame(new_rows, columns=INDEX_COLUMNS)],
+                                   ignore_index=True)
+        self._maps = {}
+        self._save_index()
+        return len(new_rows) + len(updated)
+
+    def reorder(self, keys):
+        """
+        Rewrite the store so that the matrices follow the order of `keys`, a
+        list of (participant_id, session_id), e.g. sorted by age so that age
+        bins become contiguous. Matrices missing from `keys` are kept after
+        them, in their current order.
+        """
+        position = {key: i for i, key in enumerate(keys)}
+        order = sorted(range(len(self.index)), key=lambda i: (
+            position.get((self.index.at[i, "participant_id"], self.index.at[i, "session_id"]),
+                         len(position)), self.index.at[i, "n_nodes"], self.index.at[i, "offset"]))
+        index = self.index.iloc[order].reset_index(drop=True)
+
+        for n_nodes in self.sizes:
+            rows = index["n_nodes"] == n_nodes
+            old = self.matrices(n_nodes)
+            tmp = self._data_path(n_nodes) + ".tmp"
+            new = np.memmap(tmp, dtype=self.dtype, mode='w+', shape=old.shape)
+            for new_offset, old_offset in enumerate(index.loc[rows, "offset"]):
+                new[new_offset] = old[old_offset]
+            new.flush()
+            del new
+            os.replace(tmp, self._data_path(n_nodes))
+            index.loc[rows, "offset"] = np.arange(rows.sum())
+
+        self.index = index
+        self._maps = {}
+        self._save_index()
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    store = ConnectomeStore(args.store_dir, args.dtype, not args.no_normalization)
+    for cohort, folder in args.add:
+        n = store.add(cohort, folder)
+        print(f"{cohort}: {n} matrices added or updated.")
+
+    for n_nodes in store.sizes:
+        print(f"{n_nodes} nodes: {len(store.matrices(n_nodes))} matrices.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Registry of the demographics (age, sex, cohort) of every cohort, keyed on
+subject and session, and a join of it onto any metric table.
+
+The registry is built once from the participants/demographics table of each
+cohort (participants.tsv, <COHORT>_demographics.csv, ...), with --fill tables
+supplying the values missing from a source (e.g. the sex of BCP and GESTE,
+matched on subject). Identifiers are normalized on the way in:
+participant_id/src_subject_id/sample -> subject_id with a "sub-" prefix,
+session/NA -> session_id with a "ses-" prefix or empty. The result is saved
+as a CSV table (subject_id, session_id, age, sex, cohort).
+
+bundleGAMLSS.py, networkGAMLSS.py, graph_metrics.py, cohort_qc.py and
+diffusion_priors.py take it with --demographics and call
+DemographicsRegistry.join on their table. A row is matched on its subject
+and session, or on its subject alone if the cohort has a single
+(session-less) row per subject.
+
+Usage:
+    python demographics.py demographics.csv --source MYRNA MYRNA_demographics.csv \
+        --source BCP BCPConnectivityMats/participants.tsv --fill BCP BCP_demographics.csv ...
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+KEYS = ["subject_id", "session_id"]
+VALUES = ["age", "sex", "cohort"]
+
+# Column names of the identifiers in the sources.
+ID_ALIASES = {"participant_id": "subject_id", "src_subject_id": "subject_id", "sample": "subject_id",
+              "session": "session_id"}
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("output",
+                   help="Registry table (CSV).")
+    p.add_argument("--source",
+                   help="Cohort name and participants/demographics table (CSV or TSV).\n"
+                   "Can be repeated.",
+                   nargs=2,
+                   metavar=("COHORT", "TABLE"),
+                   action="append",
+                   required=True)
+    p.add_argument("--fill",
+                   help="Cohort name and table whose values (matched on subject) replace\n"
+                   "those of the cohort's source. Can be repeated.",
+                   nargs=2,
+                   metavar=("COHORT", "TABLE"),
+                   action="append",
+                   default=[])
+
+    return p
+
+
+def normalize_subjects(subjects):
+    subjects = subjects.astype(str).str.strip()
+    return subjects.where(subjects.str.startswith("sub-"), "sub-" + subjects)
+
+
+def normalize_sessions(sessions):
+    sessions = sessions.fillna("").astype(str).str.strip()
+    return sessions.where((sessions == "") | sessions.str.startswith("ses-"), "ses-" + sessions)
+
+
+def read_table(path):
+    """
+    Read a CSV or TSV table with normalized identifier columns.
+    """
+    sep = "\t" if path.endswith(".tsv") else ","
+    df = pd.read_csv(path, sep=sep, dtype={c: str for c in ID_ALIASES.keys() | set(KEYS)})
+    df = df.rename(columns={k: v for k, v in ID_ALIASES.items() if k in df and v not in df})
+    if "subject_id" not in df:
+        raise ValueError(f"No participant_id or subject_id column in {path}.")
+    df = df.dropna(subset=["subject_id"])
+    df["subject_id"] = normalize_subjects(df["subject_id"])
+    df["session_id"] = normalize_sessions(df["session_id"] if "session_id" in df else
+                                          pd.Series("", index=df.index))
+    return df
+
+
+def build_registry(sources, fills=()):
+    """
+    Registry table of the (cohort, path) sources. The (cohort, path) fills
+    replace the values of their cohort, matched on subject.
+    """
+    fills_by_cohort = {}
+    for cohort, path in fills:
+        fills_by_cohort.setdefault(cohort, []).append(path)
+
+    tables = []
+    for cohort, path in sources:
+        df = read_table(path)
+        for fill_path in fills_by_cohort.get(cohort, []):
+            fill = read_table(fill_path).drop_duplicates("subject_id").set_index("subject_id")
+            for column in set(VALUES) & set(fill.columns):
+                df[column] = df["subject_id"].map(fill[column]).combine_first(
+                    df[column] if column in df else pd.Series(np.nan, index=df.index))
+
+        df = df.reindex(columns=KEYS + VALUES)
+        df["cohort"] = df["cohort"].fillna(cohort)
+        tables.append(df)
+
+    table = pd.concat(tables, ignore_index=True)
+    table["age"] = pd.to_numeric(table["age"], errors="coerce")
+    return table
+
+
+class DemographicsRegistry:
+    """
+    Demographics keyed on (subject_id, session_id).
+    """
+
+    def __init__(self, table):
+        duplicated = table.duplicated(KEYS)
+        if duplicated.any():
+            print(f"Keeping the first of the {int(duplicated.sum())} duplicated subject/session rows.")
+        self.table = table[~duplicated].set_index(KEYS)[VALUES]
+
+    @classmethod
+    def load(cls, path):
+        return cls(pd.read_csv(path, dtype={"subject_id": str, "session_id": str}, keep_default_na=False,
+                               na_values={"age": [""], "sex": [""], "cohort": [""]}))
+
+    def save(self, path):
+        tmp = f"{path}.tmp"
+        self.table.reset_index().to_csv(tmp, index=False)
+        os.replace(tmp, path)
+
+    def join(self, df, how="left"):
+        """
+        Add the age, sex and cohort columns to `df` (replacing existing ones),
+        matching its rows on subject (subject_id or participant_id) and
+        session, or on subject alone for session-less cohorts. With
+        how="inner", unmatched rows are dropped. The row order is kept.
+        """
+        id_column = "subject_id" if "subject_id" in df else "participant_id"
+        subjects = normalize_subjects(df[id_column])
+        sessions = normalize_sessions(df["session_id"] if "session_id" in df else
+                                      pd.Series("", index=df.index))
+
+        # Fall back on the session-less row of the subject.
+        with_session = pd.MultiIndex.from_arrays([subjects, sessions]).isin(self.table.index)
+        keys = pd.MultiIndex.from_arrays([subjects, sessions.where(with_session, "")])
+        matched = keys.isin(self.table.index)
+        values = self.table.reindex(keys)
+
+        df = df.drop(columns=[c for c in VALUES if c in df])
+        df = df.assign(**{c: values[c].to_numpy() for c in VALUES})
+        return df[matched] if how == "inner" else df
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    registry = DemographicsRegistry(build_registry(args.source, args.fill))
+    registry.save(args.output)
+
+    counts = registry.table.groupby("cohort").size()
+    print(f"{len(registry.table)} subject/sessions saved to {args.output}:")
+    print(counts.to_string())
+
+
+if __name__ == "__main__":
+    main()
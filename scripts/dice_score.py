@@ -0,0 +1,309 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Test-retest agreement of bundles: voxel Dice, density-weighted voxel Dice
+and streamline Dice of every subject x test/retest pair x hemisphere
+(replaces dice_score.sh and its per-pair scil_bundle_pairwise_comparison
+container runs).
+
+Tractograms (.trk) are memory-mapped: only the streamline counts are read
+up front, and the points are read in chunks. Streamline points are taken
+in voxel space (corner origin). For the voxel Dice, each bundle becomes a
+density map counting the streamlines going through each voxel. For the
+streamline Dice, each streamline is keyed by its first and last 5 points
+(all its points below 10 points) rounded to `--precision` decimals, as
+scilpy hashes streamlines. Pairs are compared in a process pool, and the
+results go to a single table. Dice scores of two empty bundles are NaN.
+
+Expected files:
+    <input>/<sub>/ses-<test>/dwi/bundles/<sub>_ses-<test>_space-<space>_tract-<bundle>_hemi-<hemi>_track-<track>_tractogram.trk
+
+Usage:
+    python dice_score.py <input_folder> dice_scores.csv [--n_procs 4]
+        [--pairs test1:retest1 test2:retest2] [--hemispheres left right]
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+COLUMNS = ["subject_id", "test_session", "retest_session", "bundle", "hemi", "status",
+           "n_streamlines_test", "n_streamlines_retest", "n_voxels_test", "n_voxels_retest",
+           "dice_voxels", "w_dice_voxels", "dice_streamlines"]
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("input_folder",
+                   help="Derivatives folder containing the sub-* folders.")
+    p.add_argument("out_table",
+                   help="Output CSV file with one row per comparison.")
+    p.add_argument("--pairs",
+                   help="Test:retest session pairs to compare.",
+                   nargs="+",
+                   default=["test1:retest1", "test2:retest2"])
+    p.add_argument("--hemispheres",
+                   help="Hemispheres to compare.",
+                   nargs="+",
+                   default=["left", "right"])
+    p.add_argument("--bundle",
+                   help="Bundle (tract- entity) to compare.",
+                   default="PyramidalTract")
+    p.add_argument("--space",
+                   help="Space (space- entity) of the tractograms.",
+                   default="MNIPediatricAsym")
+    p.add_argument("--track",
+                   help="Tracking (track- entity) of the tractograms.",
+                   default="sdstream")
+    p.add_argument("--precision",
+                   type=int,
+                   help="Decimals kept when matching streamlines (voxel units).",
+                   default=0)
+    p.add_argument("-n", "--n_procs",
+                   type=int,
+                   help="Number of comparisons run in parallel.",
+                   default=1)
+
+    return p
+
+
+def _tractogram_path(input_folder, subject, session, bundle, hemi, space, track):
+    return os.path.join(input_folder, subject, f"ses-{session}", "dwi", "bundles",
+                        f"{subject}_ses-{session}_space-{space}_tract-{bundle}_hemi-{hemi}"
+                        f"_track-{track}_tractogram.trk")
+
+
+# Streamlines with fewer points are keyed on all their points, others on
+# their first and last KEY_POINTS points (scilpy's MIN_NB_POINTS and
+# KEY_INDEX).
+MIN_KEY_POINTS = 10
+KEY_POINTS = 5
+
+# Number of points read at once when building the density maps.
+CHUNK_POINTS = 1 << 20
+
+
+class TrkFile:
+    """
+    Memory-mapped streamlines of a .trk file. Only the streamline counts are
+    read when opening, points are read on demand, in voxel space (corner
+    origin).
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            raw_header = f.read(1000)
+        endian = "<" if np.frombuffer(raw_header, "<i4", 1, 996)[0] == 1000 else ">"
+        self.dims = tuple(int(d) for d in np.frombuffer(raw_header, endian + "i2", 3, 6))
+        self.voxel_size = np.frombuffer(raw_header, endian + "f4", 3, 12)
+        n_scalars = int(np.frombuffer(raw_header, endian + "i2", 1, 36)[0])
+        n_properties = int(np.frombuffer(raw_header, endian + "i2", 1, 238)[0])
+
+        self._data = np.memmap(path, dtype=endian + "f4", mode='r', offset=1000)
+        self._point_size = 3 + n_scalars
+
+        # Each streamline is its point count, its points (x, y, z and the
+        # scalars) and its properties. Scalar reads are much faster on a
+        # memoryview than on the memmap.
+        counts = self._data.view(endian + "i4")
+        if counts.dtype.isnative:
+            counts = memoryview(counts)
+        first, lengths = [], []
+        i, end = 0, len(self._data)
+        while i < end:
+            n = int(counts[i])
+            first.append(i + 1)
+            lengths.append(n)
+            i += 1 + n * self._point_size + n_properties
+        # Position in the file of the first point of every streamline.
+        self._first = np.asarray(first, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def points(self, streamlines, index):
+        """
+        Points `index` (point indices, same shape as `streamlines`) of the
+        `streamlines`, shape (*index.shape, 3).
+        """
+        rows = self._first[streamlines] + self._point_size * np.asarray(index, dtype=np.int64)
+        return np.asarray(self._data[rows[..., None] + np.arange(3)], dtype=np.float32) / self.voxel_size
+
+    def chunks(self, max_points=CHUNK_POINTS):
+        """
+        Streamline ids and points of consecutive groups of streamlines of at
+        most `max_points` points (or a single longer streamline).
+        """
+        ends = np.cumsum(self.lengths)
+        start = 0
+        while start < len(self):
+            stop = max(start + 1, int(np.searchsorted(ends, ends[start] - self.lengths[start] + max_points,
+                                                      side="right")))
+            lengths = self.lengths[start:stop]
+            streamlines = np.repeat(np.arange(start, stop), lengths)
+            index = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            yield streamlines, self.points(streamlines, index)
+            start = stop
+
+
+def traversed_voxels(streamlines, points):
+    """
+    Streamline ids and voxels of the points and of every voxel boundary
+    crossing (the voxel entered), i.e. every voxel a streamline goes
+    through.
+    """
+    points = points.astype(np.float64)
+    same = streamlines[1:] == streamlines[:-1]
+    start, direction = points[:-1][same], (points[1:] - points[:-1])[same]
+
+    # Boundaries k crossed along each axis, at t = (k - start) / direction.
+    low = np.floor(np.minimum(start, start + direction))
+    n_crossings = (np.floor(np.maximum(start, start + direction)) - low).astype(np.int64).ravel()
+    segments, axes = np.divmod(np.repeat(np.arange(n_crossings.size), n_crossings), 3)
+    k = low.ravel()[segments * 3 + axes] + 1 + (
+        np.arange(n_crossings.sum()) - np.repeat(np.cumsum(n_crossings) - n_crossings, n_crossings))
+    step = direction[segments, axes]
+    t = (k - start[segments, axes]) / step
+    entered = np.floor(start[segments] + t[:, None] * direction[segments])
+    entered[np.arange(len(k)), axes] = np.where(step > 0, k, k - 1)
+
+    return (np.r_[streamlines, streamlines[:-1][same][segments]],
+            np.concatenate([np.floor(points), entered]).astype(np.int64))
+
+
+def density_map(trk):
+    """
+    Number of streamlines going through each voxel, as scilpy's
+    compute_tract_counts_map.
+    """
+    n_voxels = int(np.prod(trk.dims))
+    density = np.zeros(n_voxels, dtype=np.int64)
+    for streamlines, points in trk.chunks():
+        streamlines, voxels = traversed_voxels(streamlines, points)
+        voxels = np.ravel_multi_index(np.clip(voxels, 0, np.asarray(trk.dims) - 1).T, trk.dims)
+        # Count each streamline once per voxel.
+        keys = np.sort(streamlines * n_voxels + voxels)
+        keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+        density += np.bincount(keys % n_voxels, minlength=n_voxels)
+    return density
+
+
+def streamline_keys(trk, precision=0):
+    """
+    Set of keys of the streamlines, made of their first and last 5 points
+    (all points below 10 points) rounded to `precision` decimals.
+    """
+    if not len(trk):
+        return set()
+    lengths = trk.lengths[:, None]
+    index = np.where(lengths < MIN_KEY_POINTS, np.arange(MIN_KEY_POINTS),
+                     np.r_[np.arange(KEY_POINTS), np.arange(-1, -KEY_POINTS - 1, -1)] % np.maximum(lengths, 1))
+    valid = index < lengths
+    values = trk.points(np.arange(len(trk))[:, None], np.where(valid, index, 0))
+    # Short streamlines are padded with NaN, which no point of a longer one has.
+    values = np.where(valid[..., None], np.round(values, precision) + 0.0, np.nan).astype(np.float32)
+    key_size = MIN_KEY_POINTS * 3 * 4
+    return set(values.reshape(len(trk), -1).view(np.dtype((np.void, key_size))).ravel().tolist())
+
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else np.nan
+
+
+def compare_bundles(test_file, retest_file, precision=0):
+    """
+    Voxel Dice, density-weighted voxel Dice and streamline Dice of two
+    tractograms of the same space. Dice scores of two empty bundles are NaN.
+    """
+    test, retest = TrkFile(test_file), TrkFile(retest_file)
+    if test.dims != retest.dims:
+        raise ValueError(f"Grids differ: {test.dims} vs {retest.dims}.")
+
+    density_test = density_map(test)
+    density_retest = density_map(retest)
+    overlap = (density_test > 0) & (density_retest > 0)
+    n_test, n_retest = int((density_test > 0).sum()), int((density_retest > 0).sum())
+
+    keys_test = streamline_keys(test, precision)
+    keys_retest = streamline_keys(retest, precision)
+
+    return {
+        "n_streamlines_test": len(test),
+        "n_streamlines_retest": len(retest),
+        "n_voxels_test": n_test,
+        "n_voxels_retest": n_retest,
+        "dice_voxels": _ratio(2 * overlap.sum(), n_test + n_retest),
+        "w_dice_voxels": _ratio(density_test[overlap].sum() + density_retest[overlap].sum(),
+                                density_test.sum() + density_retest.sum()),
+        "dice_streamlines": _ratio(2 * len(keys_test & keys_retest), len(test) + len(retest)),
+    }
+
+
+def find_comparisons(input_folder, pairs, hemispheres):
+    """
+    (subject, test session, retest session, hemisphere) of every subject
+    with both sessions of a pair.
+    """
+    jobs = []
+    for subject in sorted(os.listdir(input_folder)):
+        if not subject.startswith("sub-"):
+            continue
+        for pair in pairs:
+            test, retest = pair.split(":")
+            if (os.path.isdir(os.path.join(input_folder, subject, f"ses-{test}")) and
+                    os.path.isdir(os.path.join(input_folder, subject, f"ses-{retest}"))):
+                jobs += [(subject, test, retest, hemi) for hemi in hemispheres]
+    return jobs
+
+
+def _run_comparison(job, args):
+    subject, test, retest, hemi = job
+    row = {"subject_id": subject, "test_session": test, "retest_session": retest,
+           "bundle": args.bundle, "hemi": hemi}
+    files = [_tractogram_path(args.input_folder, subject, session, args.bundle, hemi,
+                              args.space, args.track) for session in (test, retest)]
+    missing = [name for name, f in zip(("test", "retest"), files) if not os.path.isfile(f)]
+    if missing:
+        return {**row, "status": f"skipped: {missing[0]} file not found"}
+    return {**row, "status": "success", **compare_bundles(*files, args.precision)}
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    jobs = find_comparisons(args.input_folder, args.pairs, args.hemispheres)
+    print(f"Found {len(jobs)} comparisons to perform.")
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max(1, args.n_procs)) as executor:
+        futures = {executor.submit(_run_comparison, job, args): job for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Comparing bundles"):
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                subject, test, retest, hemi = futures[future]
+                rows.append({"subject_id": subject, "test_session": test, "retest_session": retest,
+                             "bundle": args.bundle, "hemi": hemi, "status": f"failed: {e}"})
+
+    df = pd.DataFrame(rows, columns=COLUMNS).sort_values(
+        ["subject_id", "test_session", "hemi"]).reset_index(drop=True)
+    df = df.astype({c: "Int64" for c in COLUMNS if c.startswith("n_")})
+    df.to_csv(args.out_table, index=False)
+
+    status = df["status"].str.split(":").str[0]
+    print(f"Successful: {(status == 'success').sum()}, failed: {(status == 'failed').sum()}, "
+          f"skipped: {(status == 'skipped').sum()}. Results saved to {args.out_table}")
+
+
+if __name__ == "__main__":
+    main()
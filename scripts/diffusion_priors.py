@@ -0,0 +1,157 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Extract the diffusivity priors of every session of a derivatives folder in a
+single pass (replaces cmd_diffusivity.sh, i.e. scil_NODDI_priors followed by
+scil_volume_stats_in_ROI).
+
+As scil_NODDI_priors does, the priors are taken in a cube of --roi_radius
+voxels around the center of the volume (or --roi_center):
+    1-fiber voxels:  fa_min_single_fiber < FA < fa_max_single_fiber
+                     -> AD and RD mean, min and max, and mean FA
+    ventricles:      MD > md_min_ventricle and FA < fa_max_ventricle
+                     -> MD mean, min and max
+
+Only the ROI of each DTI map (*_desc-{fa,ad,rd,md}.nii.gz) is read, once, and
+every statistic is computed from the same in-memory masks, without writing
+the masks or text files. Sessions are processed in a process pool and
+written to a single table with the columns of collect_metrics.py and the
+status of the session (success, skipped: missing map, failed: error), joined to
+the --demographics registry (demographics.py) when given, so it can be fed
+to gamlss.R directly.
+
+Usage:
+    python diffusion_priors.py /path/to/derivatives priors.csv [--n_procs 8]
+        [--demographics demographics.csv]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from collect_metrics import COLUMNS, find_sessions
+from demographics import DemographicsRegistry
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("dataset",
+                   help="Derivatives folder containing the sub-* folders.")
+    p.add_argument("output",
+                   help="Output CSV file with one row per session.")
+    p.add_argument("--demographics",
+                   help="Demographics registry (demographics.py) joined to the priors.",
+                   default=None)
+    p.add_argument("--fa_min_single_fiber",
+                   type=float,
+                   help="Minimal FA of the 1-fiber voxels.",
+                   default=0.65)
+    p.add_argument("--fa_max_single_fiber",
+                   type=float,
+                   help="Maximal FA of the 1-fiber voxels.",
+                   default=0.95)
+    p.add_argument("--md_min_ventricle",
+                   type=float,
+                   help="Minimal MD of the ventricle voxels.",
+                   default=0.002)
+    p.add_argument("--fa_max_ventricle",
+                   type=float,
+                   help="Maximal FA of the ventricle voxels.",
+                   default=0.1)
+    p.add_argument("--roi_radius",
+                   type=int,
+                   help="Half-width (in voxels) of the cube the priors are taken from.",
+                   default=20)
+    p.add_argument("--roi_center",
+                   type=int,
+                   nargs=3,
+                   help="Center of the cube (in voxels), the center of the volume by default.",
+                   default=None)
+    p.add_argument("-n", "--n_procs",
+                   type=int,
+                   help="Number of sessions processed in parallel.",
+                   default=1)
+
+    return p
+
+
+def _roi(shape, center, radius):
+    if center is None:
+        center = [s // 2 for s in shape[:3]]
+    return tuple(slice(max(c - radius, 0), min(c + radius, s)) for c, s in zip(center, shape[:3]))
+
+
+def _stats(values):
+    if values.size == 0:
+        return [np.nan] * 3
+    return [values.mean(dtype=np.float64), values.min(), values.max()]
+
+
+def session_priors(maps, fa_min_single_fiber=0.65, fa_max_single_fiber=0.95, md_min_ventricle=0.002,
+                   fa_max_ventricle=0.1, roi_radius=20, roi_center=None):
+    """
+    AD, RD (mean, min, max), FA (mean) of the 1-fiber voxels and MD (mean,
+    min, max) of the ventricles, from the FA, AD, RD and MD maps (paths, in
+    this order). Only the ROI of each map is read.
+    """
+    images = [nib.load(path) for path in maps]
+    roi = _roi(images[0].shape, roi_center, roi_radius)
+    fa, ad, rd, md = (np.asarray(img.dataobj[roi], dtype=np.float32) for img in images)
+
+    single_fiber = (fa > fa_min_single_fiber) & (fa < fa_max_single_fiber)
+    ventricles = (md > md_min_ventricle) & (fa < fa_max_ventricle)
+
+    fa_values = fa[single_fiber]
+    return (_stats(ad[single_fiber]) + _stats(rd[single_fiber]) +
+            [fa_values.mean(dtype=np.float64) if fa_values.size else np.nan] +
+            _stats(md[ventricles]))
+
+
+def _run_session(session, kwargs):
+    subject_id, session_id, dwi_dir = session
+    prefix = f"{subject_id}_{session_id}_" if session_id else f"{subject_id}_"
+    maps = [f"{dwi_dir}/{prefix}desc-{m}.nii.gz" for m in ("fa", "ad", "rd", "md")]
+    return [subject_id, session_id] + session_priors(maps, **kwargs)
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    kwargs = {k: getattr(args, k) for k in ("fa_min_single_fiber", "fa_max_single_fiber",
+                                            "md_min_ventricle", "fa_max_ventricle",
+                                            "roi_radius", "roi_center")}
+    sessions = find_sessions(args.dataset)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max(1, args.n_procs)) as executor:
+        futures = [executor.submit(_run_session, session, kwargs) for session in sessions]
+        for session, future in tqdm(zip(sessions, futures), total=len(sessions),
+                                    desc="Extracting priors", unit="session"):
+            # A session that fails is reported in its row, the others are kept.
+            try:
+                rows.append(future.result() + ["success"])
+            except (FileNotFoundError, nib.filebasedimages.ImageFileError) as e:
+                rows.append(list(session[:2]) + [np.nan] * (len(COLUMNS) - 2) + [f"skipped: {e}"])
+            except Exception as e:
+                rows.append(list(session[:2]) + [np.nan] * (len(COLUMNS) - 2) + [f"failed: {e!r}"])
+
+    df = pd.DataFrame(rows, columns=COLUMNS + ["status"])
+    if args.demographics is not None:
+        df = DemographicsRegistry.load(args.demographics).join(df)
+    df.to_csv(args.output, index=False)
+
+    status = df["status"].str.split(":").str[0]
+    print(f"Successful: {(status == 'success').sum()}, failed: {(status == 'failed').sum()}, "
+          f"skipped: {(status == 'skipped').sum()}. Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
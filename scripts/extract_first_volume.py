@@ -1,28 +1,76 @@
 #!/usr/bin/env python3
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import nibabel as nib
+from nibabel.openers import Opener
+from nibabel.volumeutils import seek_tell
 import numpy as np
-import argparse
+
+# Bytes copied at once when streaming the volumes.
+CHUNK_SIZE = 64 * 1024 ** 2
+
+
+def _read_header(path):
+    """
+    Header of a NIfTI file as stored on disk, including its scaling (which
+    nib.load resets on the image header).
+    """
+    header_class = nib.load(path).header_class
+    with Opener(path) as f:
+        return header_class.from_fileobj(f)
+
+
+def _copy_bytes(src, dst, n_bytes):
+    while n_bytes > 0:
+        block = src.read(min(CHUNK_SIZE, n_bytes))
+        if not block:
+            raise ValueError("Unexpected end of file while copying the DWI volumes.")
+        dst.write(block)
+        n_bytes -= len(block)
 
 
-def remove_first_volume(dwi_file, bval_file, bvec_file, out_prefix, dir_orig, dir_new):
-    # --- Load DWI ---
-    img = nib.load(dwi_file)
-    data = img.get_fdata()
-    affine = img.affine
-    header = img.header
+def _write_header(f, header, shape):
+    header = header.copy()
+    header.set_data_shape(shape)
+    header.write_to(f)
+    seek_tell(f, header.get_data_offset(), write0=True)
 
-    # Remove first volume
-    first_vol = data[..., 0]
-    new_data = data[..., 1:]
 
-    # Save first image.
-    first_img = nib.Nifti1Image(first_vol, affine, header)
-    nib.save(first_img, f"{out_prefix}/fmap/{out_prefix}_dir-{dir_new}_epi.nii.gz")
+def split_first_volume(dwi_file, b0_file, rest_file):
+    """
+    Split a 4D NIfTI into its first volume and the remaining ones, streaming
+    the raw voxel data so that the on-disk dtype and scaling are kept and only
+    one chunk is held in memory. `rest_file` may be `dwi_file` itself.
+    Returns the number of remaining volumes.
+    """
+    header = _read_header(dwi_file)
+    shape = header.get_data_shape()
+    if len(shape) != 4:
+        raise ValueError(f"{dwi_file} is not a 4D image (shape {shape}).")
+    volume_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
 
-    # Save new DWI
-    new_img = nib.Nifti1Image(new_data, affine, header)
-    nib.save(new_img, f"{out_prefix}/dwi/{out_prefix}_dir-{dir_orig}_dwi.nii.gz")
+    # Write next to the output, then move in place (the input may be overwritten).
+    tmp_file = os.path.join(os.path.dirname(rest_file), ".tmp_" + os.path.basename(rest_file))
+    with Opener(dwi_file) as src, Opener(b0_file, 'wb') as b0, Opener(tmp_file, 'wb') as rest:
+        seek_tell(src, header.get_data_offset())
 
+        _write_header(b0, header, shape[:3])
+        _copy_bytes(src, b0, volume_bytes)
+
+        _write_header(rest, header, shape[:3] + (shape[3] - 1,))
+        _copy_bytes(src, rest, volume_bytes * (shape[3] - 1))
+
+    os.replace(tmp_file, rest_file)
+    return shape[3] - 1
+
+
+def remove_first_volume(dwi_file, bval_file, bvec_file, out_prefix, dir_orig, dir_new, root="."):
     # --- Load bvals/bvecs ---
     bvals = np.loadtxt(bval_file)
     bvecs = np.loadtxt(bvec_file)
@@ -32,26 +80,124 @@ def remove_first_volume(dwi_file, bval_file, bvec_file, out_prefix, dir_orig, di
     new_bvecs = bvecs[:, 1:] if bvecs.ndim > 1 else bvecs[1:]
 
     # Add a small check to ensure the length of the bvals and bvecs match the new data.
-    if len(new_bvals) != new_data.shape[-1]:
+    n_volumes = _read_header(dwi_file).get_data_shape()[-1] - 1
+    if len(new_bvals) != n_volumes:
         raise ValueError("Mismatch between number of volumes in DWI and bvals/bvecs.")
-    if new_bvecs.shape[1] != new_data.shape[-1]:
+    if new_bvecs.shape[1] != n_volumes:
         raise ValueError("Mismatch between number of volumes in DWI and bvecs.")
 
+    # Save the first image in fmap/ and the new DWI in dwi/.
+    folder = os.path.join(root, out_prefix)
+    split_first_volume(dwi_file,
+                       f"{folder}/fmap/{out_prefix}_dir-{dir_new}_epi.nii.gz",
+                       f"{folder}/dwi/{out_prefix}_dir-{dir_orig}_dwi.nii.gz")
+
     # Save updated bvals/bvecs
-    np.savetxt(f"{out_prefix}/dwi/{out_prefix}_dir-{dir_orig}_dwi.bval", new_bvals, fmt="%.6f")
-    np.savetxt(f"{out_prefix}/dwi/{out_prefix}_dir-{dir_orig}_dwi.bvec", new_bvecs, fmt="%.6f")
+    np.savetxt(f"{folder}/dwi/{out_prefix}_dir-{dir_orig}_dwi.bval", new_bvals, fmt="%.6f")
+    np.savetxt(f"{folder}/dwi/{out_prefix}_dir-{dir_orig}_dwi.bvec", new_bvecs, fmt="%.6f")
 
 
-if __name__ == "__main__":
+def reorganize_subject(root, subj, dir_orig, dir_new):
+    """
+    Move the first volume of the dir_orig DWI to a flipped dir_new fieldmap,
+    with its sidecar and phase encoding direction.
+    """
+    folder = os.path.join(root, subj)
+    dwi = f"{folder}/dwi/{subj}_dir-{dir_orig}_dwi"
+    epi = f"{folder}/fmap/{subj}_dir-{dir_new}_epi"
+    os.makedirs(f"{folder}/fmap", exist_ok=True)
+
+    remove_first_volume(f"{dwi}.nii.gz", f"{dwi}.bval", f"{dwi}.bvec", subj, dir_orig, dir_new, root=root)
+    subprocess.run(["scil_volume_flip", f"{epi}.nii.gz", f"{epi}.nii.gz", "x", "y", "-f"], check=True)
+
+    # Copy the sidecar and set the PhaseEncodingDirection of the new direction.
+    with open(f"{dwi}.json") as f:
+        sidecar = json.load(f)
+    orient = "j" if dir_new == "PA" else "j-"
+    sidecar["PhaseEncodingDirection"] = orient + sidecar["PhaseEncodingDirection"][2:]
+    with open(f"{epi}.json", 'w') as f:
+        json.dump(sidecar, f, indent=2)
+
+
+def process_subject(root, subj):
+    """
+    Turn the first volumes of the AP and PA DWIs of a subject into fieldmaps,
+    then concatenate both DWIs into the AP one.
+    """
+    folder = os.path.join(root, subj)
+    ap_dwi = f"{folder}/dwi/{subj}_dir-AP_dwi"
+    if not (os.path.isfile(f"{ap_dwi}.nii.gz") and os.path.isfile(f"{folder}/dwi/{subj}_dir-PA_dwi.nii.gz")):
+        return f"Skipping {subj}, AP and PA DWIs are not both present."
+    if os.path.isdir(f"{folder}/fmap") and os.listdir(f"{folder}/fmap"):
+        return f"Skipping {subj} because fmap folder is not empty."
+
+    reorganize_subject(root, subj, "AP", "PA")
+    reorganize_subject(root, subj, "PA", "AP")
+
+    dwis = sorted(glob.glob(f"{folder}/dwi/*nii.gz"))
+    subprocess.run(["scil_dwi_concatenate", f"{ap_dwi}.nii.gz", f"{ap_dwi}.bval", f"{ap_dwi}.bvec",
+                    "--in_dwis"] + dwis +
+                   ["--in_bvals"] + sorted(glob.glob(f"{folder}/dwi/*bval")) +
+                   ["--in_bvecs"] + sorted(glob.glob(f"{folder}/dwi/*bvec")) + ["-f"], check=True)
+
+    # Remove the PA DWI and the AP fieldmap.
+    for path in glob.glob(f"{folder}/dwi/*PA*") + glob.glob(f"{folder}/fmap/*AP*"):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return f"Processed {subj}."
+
+
+def process_dataset(root, n_procs=1):
+    """
+    Process every sub-* folder of a BIDS root on a pool of processes.
+    """
+    subjects = sorted(d for d in os.listdir(root) if d.startswith("sub-") and os.path.isdir(os.path.join(root, d)))
+    failed = []
+    with ProcessPoolExecutor(max_workers=max(1, n_procs)) as executor:
+        futures = {executor.submit(process_subject, root, subj): subj for subj in subjects}
+        for future in as_completed(futures):
+            try:
+                print(future.result())
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Failed {futures[future]}: {e}")
+    return failed
+
+
+def _build_arg_parser():
     parser = argparse.ArgumentParser(
-        description="Remove first volume from DWI and adjust bval/bvec."
+        description="Remove first volume from DWI and adjust bval/bvec. With --bids_root, "
+                    "move the first volume of the AP/PA DWIs of every subject to fieldmaps "
+                    "and concatenate the DWIs."
     )
-    parser.add_argument("dwi", help="Input diffusion MRI (4D .nii.gz)")
-    parser.add_argument("bval", help="Input .bval file")
-    parser.add_argument("bvec", help="Input .bvec file")
-    parser.add_argument("out_prefix", help="Output prefix for new files")
-    parser.add_argument("dir_orig", help="Original direction (AP or PA)")
-    parser.add_argument("dir_new", help="New direction (AP or PA)")
-    args = parser.parse_args()
-
-    remove_first_volume(args.dwi, args.bval, args.bvec, args.out_prefix, args.dir_orig, args.dir_new)
+    parser.add_argument("dwi", nargs="?", help="Input diffusion MRI (4D .nii.gz)")
+    parser.add_argument("bval", nargs="?", help="Input .bval file")
+    parser.add_argument("bvec", nargs="?", help="Input .bvec file")
+    parser.add_argument("out_prefix", nargs="?", help="Output prefix for new files")
+    parser.add_argument("dir_orig", nargs="?", help="Original direction (AP or PA)")
+    parser.add_argument("dir_new", nargs="?", help="New direction (AP or PA)")
+    parser.add_argument("--bids_root", help="Process every sub-* of this BIDS root (batch mode)")
+    parser.add_argument("--n_procs", type=int, default=1, help="Number of subjects processed in parallel")
+    return parser
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    if args.bids_root is not None:
+        failed = process_dataset(args.bids_root, args.n_procs)
+        if failed:
+            raise SystemExit(f"Failed subjects: {', '.join(sorted(failed))}")
+    else:
+        if args.dir_new is None:
+            parser.error("dwi, bval, bvec, out_prefix, dir_orig and dir_new are required "
+                         "without --bids_root.")
+        remove_first_volume(args.dwi, args.bval, args.bvec, args.out_prefix, args.dir_orig, args.dir_new)
+
+
+if __name__ == "__main__":
+    main()
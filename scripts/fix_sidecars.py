@@ -0,0 +1,331 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Fix the dwi/fmap JSON sidecars of a BIDS dataset in a single pass (replaces
+phase_encoding.sh, bind_fmaps.sh, round_totalreadouttime.sh and the sidecar
+part of split_fmaps.sh).
+
+Every *_dwi.json and *_epi.json of the sub-*[/ses-*]/{dwi,fmap} folders is
+read once, then the selected rules are applied in memory, in this order:
+    split_fmaps     Split 2-volume dir-AP fieldmaps into dir-AP and dir-PA
+                    fieldmaps, the dir-PA sidecar being a copy of the dir-AP
+                    one with PhaseEncodingDirection "j".
+    phase_encoding  Add PhaseEncodingDirection to the DWI sidecars missing it
+                    (j- for dir-AP, j for dir-PA).
+    intended_for    Bind the fieldmap of opposite direction to the first DWI
+                    of the session (IntendedFor, relative to the subject).
+    readout_time    Round the TotalReadoutTime of the DWI and of its opposite
+                    fieldmap to 3 decimals when they then agree.
+
+Each changed sidecar is written exactly once, atomically (temporary file
+then rename), from a thread pool. With --dry_run, nothing is written and the
+diff of every change is printed instead.
+
+Usage:
+    python fix_sidecars.py <bids_root> [--rules phase_encoding intended_for readout_time]
+        [--dry_run] [--n_threads 8]
+"""
+
+import argparse
+import difflib
+import json
+import os
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+OPPOSITE = {"AP": "PA", "PA": "AP"}
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("bids_root",
+                   help="Root of the BIDS dataset.")
+    p.add_argument("--rules",
+                   help="Rules to apply, always in the order listed above.",
+                   nargs="+",
+                   choices=["split_fmaps", "phase_encoding", "intended_for", "readout_time"],
+                   default=["phase_encoding", "intended_for", "readout_time"])
+    p.add_argument("--dry_run", "--dry-run",
+                   action="store_true",
+                   help="Print the diff of every change without writing anything.",
+                   default=False)
+    p.add_argument("-n", "--n_threads",
+                   type=int,
+                   help="Number of threads reading and writing the sidecars.",
+                   default=8)
+
+    return p
+
+
+def direction(name):
+    """
+    Phase encoding direction (AP or PA) from the dir- entity of a filename.
+    """
+    if "dir-AP" in name:
+        return "AP"
+    if "dir-PA" in name:
+        return "PA"
+    return None
+
+
+class Sidecar:
+    """
+    JSON sidecar loaded in memory. `data` is edited by the rules, and the
+    file is written only if it differs from what was read.
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        self.text = None
+        if data is None:
+            with open(path) as f:
+                self.text = f.read()
+            data = json.loads(self.text)
+        self.original = json.loads(json.dumps(data))
+        self.data = data
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def changed(self):
+        return self.text is None or self.data != self.original
+
+    def dumps(self):
+        return json.dumps(self.data, indent=2, ensure_ascii=False) + "\n"
+
+    def diff(self):
+        old = [] if self.text is None else self.text.splitlines(keepends=True)
+        return "".join(difflib.unified_diff(old, self.dumps().splitlines(keepends=True),
+                                            "/dev/null" if self.text is None else self.path,
+                                            self.path))
+
+    def write(self):
+        """
+        Write to a temporary file of the same folder, then rename over the
+        sidecar, keeping its permissions. New sidecars get the default ones
+        (0o666 less the umask, applied when the file is created).
+        """
+        tmp = os.path.join(os.path.dirname(self.path), f".{self.name}.{uuid.uuid4().hex}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.dumps())
+            if self.text is not None:
+                os.chmod(tmp, os.stat(self.path).st_mode & 0o7777)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+class Session:
+    """
+    DWI and fieldmap sidecars of one sub-*[/ses-*] folder.
+    """
+
+    def __init__(self, subject_dir, folder):
+        self.subject_dir = subject_dir
+        self.folder = folder
+        self.dwi = []
+        self.dwi_images = []
+        self.fmaps = []
+        self.fmap_images = []
+
+    @property
+    def label(self):
+        return os.path.relpath(self.folder, os.path.dirname(self.subject_dir))
+
+    def fmap(self, dir_label):
+        """
+        First fieldmap sidecar with the given direction.
+        """
+        return next((s for s in self.fmaps if direction(s.name) == dir_label), None)
+
+
+def _list(folder, suffix):
+    try:
+        return sorted(e.path for e in os.scandir(folder) if e.name.endswith(suffix) and e.is_file())
+    except FileNotFoundError:
+        return []
+
+
+def index_sessions(bids_root, n_threads=8):
+    """
+    Sessions of the dataset with every dwi/fmap sidecar loaded, read in a
+    thread pool.
+    """
+    sessions = []
+    for sub in sorted(os.scandir(bids_root), key=lambda e: e.name):
+        if not (sub.name.startswith("sub-") and sub.is_dir()):
+            continue
+        folders = sorted(e.path for e in os.scandir(sub.path) if e.name.startswith("ses-") and e.is_dir())
+        for folder in [sub.path] + folders:
+            session = Session(sub.path, folder)
+            session.dwi_images = _list(os.path.join(folder, "dwi"), "dwi.nii.gz")
+            session.fmap_images = _list(os.path.join(folder, "fmap"), "_epi.nii.gz")
+            session.dwi = _list(os.path.join(folder, "dwi"), "_dwi.json")
+            session.fmaps = _list(os.path.join(folder, "fmap"), "_epi.json")
+            if session.dwi or session.fmaps or session.dwi_images:
+                sessions.append(session)
+
+    paths = [p for session in sessions for p in session.dwi + session.fmaps]
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        sidecars = dict(zip(paths, executor.map(Sidecar, paths)))
+    for session in sessions:
+        session.dwi = [sidecars[p] for p in session.dwi]
+        session.fmaps = [sidecars[p] for p in session.fmaps]
+    return sessions
+
+
+def split_fmaps(session, dry_run=False):
+    """
+    Split a 2-volume dir-AP fieldmap into its dir-AP (first volume) and
+    dir-PA (second volume) fieldmaps, when no dir-PA fieldmap exists.
+    """
+    ap_image = next((p for p in session.fmap_images if direction(os.path.basename(p)) == "AP"), None)
+    if ap_image is None or any(direction(os.path.basename(p)) == "PA" for p in session.fmap_images):
+        return []
+    ap_json = session.fmap("AP")
+    if ap_json is None:
+        return [f"Warning: {session.label}: no sidecar for {os.path.basename(ap_image)}."]
+
+    # Imported here so that the sidecar rules do not require nibabel.
+    from extract_first_volume import _read_header, split_first_volume
+
+    shape = _read_header(ap_image).get_data_shape()
+    if len(shape) != 4 or shape[3] != 2:
+        return []
+
+    pa_image = ap_image.replace("dir-AP", "dir-PA")
+    if not dry_run:
+        tmp = os.path.join(os.path.dirname(ap_image), ".tmp_" + os.path.basename(ap_image))
+        split_first_volume(ap_image, tmp, pa_image)
+        os.replace(tmp, ap_image)
+    session.fmap_images.append(pa_image)
+
+    data = json.loads(json.dumps(ap_json.data))
+    data["PhaseEncodingDirection"] = "j" + data.get("PhaseEncodingDirection", "")[2:]
+    session.fmaps.append(Sidecar(ap_json.path.replace("dir-AP", "dir-PA"), data))
+    return [f"{session.label}: split {os.path.basename(ap_image)} into dir-AP and dir-PA fieldmaps."]
+
+
+def phase_encoding(session):
+    """
+    Add the PhaseEncodingDirection of the DWI sidecars missing it.
+    """
+    messages = []
+    for sidecar in session.dwi:
+        if "PhaseEncodingDirection" in sidecar.data:
+            continue
+        dir_label = direction(sidecar.name)
+        if dir_label is None:
+            messages.append(f"Warning: cannot determine PhaseEncodingDirection for {sidecar.path}")
+            continue
+        sidecar.data["PhaseEncodingDirection"] = "j-" if dir_label == "AP" else "j"
+        messages.append(f"{sidecar.path}: PhaseEncodingDirection = "
+                        f"{sidecar.data['PhaseEncodingDirection']}")
+    return messages
+
+
+def intended_for(session):
+    """
+    Set the IntendedFor of the fieldmap of opposite direction to the first
+    DWI of the session.
+    """
+    if not session.dwi_images or not session.fmaps:
+        return []
+    dwi_image = session.dwi_images[0]
+    dir_label = direction(os.path.basename(dwi_image))
+    if dir_label is None:
+        return [f"Warning: could not detect direction for {dwi_image}"]
+    fmap = session.fmap(OPPOSITE[dir_label])
+    if fmap is None:
+        return [f"Warning: no fmap for {session.label} with dir-{OPPOSITE[dir_label]}"]
+
+    # Path relative to the subject folder, as BIDS requires.
+    fmap.data["IntendedFor"] = [os.path.relpath(dwi_image, session.subject_dir)]
+    return [f"{fmap.path}: IntendedFor = {fmap.data['IntendedFor'][0]}"]
+
+
+def readout_time(session):
+    """
+    Set the TotalReadoutTime of each DWI and of its opposite fieldmap to
+    their value rounded to 3 decimals, if both agree once rounded.
+    """
+    messages = []
+    for sidecar in session.dwi:
+        dir_label = direction(sidecar.name)
+        fmap = session.fmap(OPPOSITE[dir_label]) if dir_label else None
+        if fmap is None:
+            continue
+        if "TotalReadoutTime" not in sidecar.data or "TotalReadoutTime" not in fmap.data:
+            messages.append(f"Warning: {session.label}: TotalReadoutTime missing in "
+                            f"{sidecar.name} or {fmap.name}")
+            continue
+
+        dwi_round = float(f"{sidecar.data['TotalReadoutTime']:.3f}")
+        fmap_round = float(f"{fmap.data['TotalReadoutTime']:.3f}")
+        if dwi_round != fmap_round:
+            messages.append(f"Warning: {session.label}: mismatch after rounding "
+                            f"({dwi_round} vs {fmap_round})")
+            continue
+        sidecar.data["TotalReadoutTime"] = dwi_round
+        fmap.data["TotalReadoutTime"] = dwi_round
+        messages.append(f"{session.label}: TotalReadoutTime = {dwi_round}")
+    return messages
+
+
+RULES = {
+    "phase_encoding": phase_encoding,
+    "intended_for": intended_for,
+    "readout_time": readout_time,
+}
+
+
+def fix_sidecars(sessions, rules, dry_run=False):
+    """
+    Apply the rules to every session in memory. Returns the changed sidecars
+    and the messages of the rules.
+    """
+    messages = []
+    for session in sessions:
+        if "split_fmaps" in rules:
+            messages += split_fmaps(session, dry_run)
+        for name, rule in RULES.items():
+            if name in rules:
+                messages += rule(session)
+
+    changed = [s for session in sessions for s in session.dwi + session.fmaps if s.changed]
+    return changed, messages
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    sessions = index_sessions(args.bids_root, args.n_threads)
+    changed, messages = fix_sidecars(sessions, args.rules, args.dry_run)
+
+    for message in messages:
+        print(message, file=sys.stderr if message.startswith("Warning") else sys.stdout)
+
+    if args.dry_run:
+        for sidecar in changed:
+            sys.stdout.write(sidecar.diff())
+        print(f"{len(changed)} sidecars would be written.")
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, args.n_threads)) as executor:
+        list(executor.map(Sidecar.write, changed))
+    print(f"{len(changed)} sidecars written.")
+
+
+if __name__ == "__main__":
+    main()
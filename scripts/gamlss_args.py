@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line options shared by the GAMLSS drivers (bundleGAMLSS.py and
+networkGAMLSS.py).
+"""
+
+
+def add_fit_arguments(p):
+    """
+    Add the R, worker, cache, manifest, demographics, update and bootstrap
+    options of the fits to the parser `p`.
+    """
+    p.add_argument("--rscript",
+                   help="Path to the R script that fits the GAMLSS model. Required unless\n"
+                   "--plots_only is used.")
+    p.add_argument("-n", "--n_cpus",
+                   type=int,
+                   help="Number of CPUs to use.",
+                   default=1)
+    p.add_argument("--search",
+                   choices=["sequential", "parallel"],
+                   help="Model-order search used by gamlss.R. 'parallel' fits the fp\n"
+                   "candidates in waves across --search_cores, warm-started from their\n"
+                   "lower-order neighbours, and prunes higher orders once SBC stops improving.",
+                   default="sequential")
+    p.add_argument("--sbc_tol",
+                   type=float,
+                   help="Minimum SBC improvement for --search parallel to try higher orders.",
+                   default=0.0)
+    p.add_argument("--search_cores",
+                   type=int,
+                   help="Number of cores used by each fit with --search parallel.",
+                   default=1)
+    p.add_argument("--persistent_r",
+                   action="store_true",
+                   help="Fit the models on a pool of long-lived R workers (gamlss_worker.R)\n"
+                   "instead of starting a new Rscript process for every fit.",
+                   default=False)
+    p.add_argument("--cache_dir",
+                   help="Folder of the content-addressed fit cache. Fits whose input rows\n"
+                   "and model specification are unchanged are restored from it instead\n"
+                   "of being refit. Disabled by default.",
+                   default=None)
+    p.add_argument("--cache_size",
+                   type=float,
+                   help="Maximum size of the fit cache in GB, least recently used fits\n"
+                   "are evicted first.",
+                   default=10.0)
+    p.add_argument("--manifest",
+                   help="Run manifest (JSONL) the record of every fit is appended to.\n"
+                   "Defaults to <output_dir>/gamlss_manifest.jsonl, which -f keeps, see\n"
+                   "gamlss_manifest.py.",
+                   default=None)
+    p.add_argument("--demographics",
+                   help="Demographics registry (demographics.py) whose age, sex and cohort\n"
+                   "replace those of the input table.",
+                   default=None)
+    p.add_argument("--update",
+                   action="store_true",
+                   help="Update the models already in output_dir (e.g. after adding a cohort):\n"
+                   "gamlss.R refits their selected fp orders on the new data, warm-started\n"
+                   "from the previous fit, and only runs the full search if the update does\n"
+                   "not converge or fits poorly. output_dir is never wiped.",
+                   default=False)
+    p.add_argument("--bootstrap",
+                   type=int,
+                   help="Number of bootstrap replicates of the centiles of every fit (subjects\n"
+                   "resampled within cohort, selected model refitted warm-started from the\n"
+                   "full fit), giving <metric>_centile_bands.csv. Replicates run in chunks on\n"
+                   "the fit workers, and an interrupted bootstrap resumes from the chunks done.",
+                   default=0)
+    p.add_argument("--bootstrap_chunk",
+                   type=int,
+                   help="Number of bootstrap replicates per job.",
+                   default=25)
+    p.add_argument("--bootstrap_seed",
+                   type=int,
+                   help="Seed of the bootstrap.",
+                   default=0)
+    p.add_argument("--bootstrap_only",
+                   action="store_true",
+                   help="Only run (or resume) the --bootstrap of the fits already in output_dir.",
+                   default=False)
+    p.add_argument("-f", "--force",
+                   action="store_true",
+                   help="Overwrite output folder.",
+                   default=False)
+
+    return p
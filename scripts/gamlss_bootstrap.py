@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Bootstrap confidence bands of the fitted centile curves.
+
+The replicates of every successful fit are split in chunks, each one a job
+run by the same workers as the fits (gamlss.R --bootstrap_from, see
+run_bootstrap in gamlss.R): subjects are resampled within cohort and the
+selected model is refitted, warm-started from the full-data fit. A chunk
+writes the centiles of its replicates to <bundle>/bootstrap/ as a float32
+array, so an interrupted run resumes from the chunks already done. Chunk
+files are named after the hash of the fitted model and the seed, so that a
+refit never reuses stale replicates.
+
+Once every chunk of a fit is done, the chunks are streamed one at a time
+into <metric>_centiles_bootstrap.npy, (replicate, age, centile) float32,
+and the per-age bands are computed over blocks of ages into
+<metric>_centile_bands.csv (age, prob, lower, median, upper), so memory
+stays bounded by a chunk or a block whatever the number of replicates.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from gamlss_cache import file_hash
+from gamlss_jobs import FitJob, run_fit_jobs
+
+
+# Centiles and number of ages of the centile curves written by gamlss.R.
+CENTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+N_AGES = 1000
+
+
+class Bootstrap:
+    """
+    Bootstrap chunks and results of a fit.
+    """
+
+    def __init__(self, fit, n_replicates, chunk_size=25, seed=0):
+        self.fit = fit
+        self.n_replicates = n_replicates
+        self.seed = seed
+        self.chunks = [(first, min(first + chunk_size - 1, n_replicates))
+                       for first in range(1, n_replicates + 1, chunk_size)]
+        self.model = os.path.abspath(os.path.join(fit.output_dir, f"gamlss_model_{fit.metric}.rds"))
+        self.key = hashlib.sha256(f"{file_hash(self.model)} {seed}".encode()).hexdigest()[:12]
+        self.chunk_dir = os.path.join(fit.output_dir, "bootstrap")
+        self.array_path = os.path.join(fit.output_dir, f"{fit.metric}_centiles_bootstrap.npy")
+        self.bands_path = os.path.join(fit.output_dir, f"{fit.metric}_centile_bands.csv")
+        self.state_path = os.path.join(fit.output_dir, f"{fit.metric}_centiles_bootstrap.json")
+
+    def chunk_path(self, first, last):
+        return os.path.join(self.chunk_dir, f"{self.fit.metric}_{self.key}_{first}-{last}.f32")
+
+    @property
+    def done(self):
+        if not (os.path.exists(self.state_path) and os.path.exists(self.bands_path)):
+            return False
+        with open(self.state_path) as f:
+            state = json.load(f)
+        return state["key"] == self.key and state["n_replicates"] == self.n_replicates
+
+    def jobs(self):
+        """
+        Jobs of the chunks not done yet.
+        """
+        fit = self.fit
+        jobs = []
+        for first, last in self.chunks:
+            if self._chunk_done(first, last):
+                continue
+            path = self.chunk_path(first, last)
+            args = fit.extra_args + ["--bootstrap_from", self.model, "--replicates", f"{first}:{last}",
+                                     "--seed", str(self.seed), "--bootstrap_out", path]
+            jobs.append(FitJob(fit.bundle, fit.metric, fit.input_path, self.chunk_dir, args,
+                               column=fit.column, cohorts=fit.cohorts, row_group=fit.row_group,
+                               n_rows=fit.n_rows, log_name=f"{fit.metric}_{first}-{last}.log"))
+        return jobs
+
+    def _chunk_done(self, first, last):
+        """
+        True if the chunk is there with the size of its replicates. A chunk of
+        another size (e.g. written by a worker that lost replicates) is
+        removed, so that it is run again.
+        """
+        path = self.chunk_path(first, last)
+        if not os.path.exists(path):
+            return False
+        if os.path.getsize(path) != (last - first + 1) * N_AGES * len(CENTILES) * 4:
+            os.remove(path)
+            return False
+        return True
+
+    def assemble(self, level=0.95, block_size=100):
+        """
+        Stream the chunks into the replicate array and write the bands.
+        Returns False if a chunk is missing or invalid.
+        """
+        if not all([self._chunk_done(*chunk) for chunk in self.chunks]):
+            return False
+
+        shape = (self.n_replicates, N_AGES, len(CENTILES))
+        tmp = f"{self.array_path}.tmp"
+        replicates = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=shape)
+        for first, last in self.chunks:
+            replicates[first - 1:last] = np.fromfile(self.chunk_path(first, last), dtype="<f4").reshape(
+                (last - first + 1,) + shape[1:])
+        replicates.flush()
+        del replicates
+        os.replace(tmp, self.array_path)
+
+        # Bands over blocks of ages, as (prob, age) to match <metric>_centiles_by_age.csv.
+        replicates = np.load(self.array_path, mmap_mode="r")
+        bands = np.empty((3,) + shape[1:], dtype=np.float32)
+        for start in range(0, N_AGES, block_size):
+            block = np.asarray(replicates[:, start:start + block_size])
+            bands[:, start:start + block_size] = np.nanquantile(block, [(1 - level) / 2, 0.5, (1 + level) / 2],
+                                                                axis=0)
+        n_valid = int(np.isfinite(replicates[:, 0, 0]).sum())
+        del replicates
+
+        centiles = pd.read_csv(os.path.join(self.fit.output_dir, f"{self.fit.metric}_centiles_by_age.csv"))
+        ages = centiles["age"].to_numpy()[:N_AGES]
+        pd.DataFrame({
+            "age": np.tile(ages, len(CENTILES)),
+            "prob": np.repeat(CENTILES, N_AGES),
+            "lower": bands[0].T.ravel(),
+            "median": bands[1].T.ravel(),
+            "upper": bands[2].T.ravel(),
+        }).to_csv(self.bands_path, index=False)
+
+        with open(self.state_path, 'w') as f:
+            json.dump({"key": self.key, "n_replicates": self.n_replicates, "seed": self.seed,
+                       "n_converged": n_valid, "level": level}, f, indent=2)
+        for first, last in self.chunks:
+            os.remove(self.chunk_path(first, last))
+            log = os.path.join(self.chunk_dir, f"{self.fit.metric}_{first}-{last}.log")
+            if os.path.exists(log):
+                os.remove(log)
+        if not os.listdir(self.chunk_dir):
+            os.rmdir(self.chunk_dir)
+        return True
+
+
+def run_bootstrap(fit_jobs, run_job, n_workers, n_replicates, chunk_size=25, seed=0, level=0.95):
+    """
+    Bootstrap the centiles of every successful fit of `fit_jobs` on `n_workers`
+    workers, assembling the results of a bundle as soon as all of its chunks
+    are done. Returns the bootstraps left incomplete (a chunk failed).
+    """
+    bootstraps = {}
+    for fit in fit_jobs:
+        if fit.returncode != 0:
+            continue
+        bootstrap = Bootstrap(fit, n_replicates, chunk_size, seed)
+        if not bootstrap.done:
+            bootstraps[(fit.bundle, fit.metric)] = bootstrap
+
+    incomplete = []
+
+    def _assemble(bundle_bootstraps):
+        for bootstrap in bundle_bootstraps:
+            if not bootstrap.assemble(level):
+                incomplete.append(bootstrap)
+
+    # Bootstraps whose chunks are all done only need to be assembled.
+    jobs = []
+    for bootstrap in bootstraps.values():
+        os.makedirs(bootstrap.chunk_dir, exist_ok=True)
+        bootstrap_jobs = bootstrap.jobs()
+        if bootstrap_jobs:
+            jobs += bootstrap_jobs
+        else:
+            _assemble([bootstrap])
+
+    def _on_bundle_done(bundle, bundle_jobs):
+        metrics = dict.fromkeys(job.metric for job in bundle_jobs)
+        _assemble([bootstraps[(bundle, metric)] for metric in metrics])
+
+    run_fit_jobs(jobs, run_job, n_workers, on_bundle_done=_on_bundle_done, desc="Bootstrapping centiles")
+    return incomplete
+
+
+def report_incomplete(incomplete):
+    for bootstrap in incomplete:
+        print(f"Bootstrap incomplete for {bootstrap.fit.bundle}/{bootstrap.fit.metric}, rerun with "
+              f"--bootstrap_only to resume, see the logs in {bootstrap.chunk_dir}")
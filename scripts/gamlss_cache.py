@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of GAMLSS fits.
+
+A fit is keyed on a hash of the rows it is fitted on (metric, age, sex and
+cohort columns), of the metric name, of the extra gamlss.R arguments and of
+the R script itself, which holds the model specification (GG family, fp
+degrees, random cohort effect) and the age grid used for the centiles.
+Unchanged bundle/metric models are restored from the cache instead of being
+refit.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import pandas as pd
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def update_args(output_dir, metric):
+    """
+    gamlss.R arguments updating the previous model of `metric` in
+    `output_dir` (none if there is no previous model), and the same
+    arguments for the cache key, with the hash of the model for its path.
+    """
+    previous = os.path.join(output_dir, f"gamlss_model_{metric}.rds")
+    if not os.path.exists(previous):
+        return [], []
+    return ["--update_from", os.path.abspath(previous)], ["--update_from", file_hash(previous)]
+
+
+def fit_artifacts(metric):
+    """
+    Files written by gamlss.R for a metric, relative to the output folder.
+    """
+    return [
+        f"gamlss_model_{metric}.rds",
+        f"gamlss_search_{metric}.csv",
+        f"{metric}_gamlss_params.csv",
+        f"{metric}_gamlss_coefs.csv",
+        f"{metric}_centiles_by_age.csv",
+        f"{metric}_centiles_by_age.parquet",
+        f"{metric}_centiles_by_age.png",
+        f"{metric}_gamlss.log",
+    ]
+
+
+def required_artifacts(metric):
+    """
+    Artifacts of `fit_artifacts` written by every successful fit.
+    """
+    return [
+        f"gamlss_model_{metric}.rds",
+        f"gamlss_search_{metric}.csv",
+        f"{metric}_gamlss_params.csv",
+        f"{metric}_gamlss_coefs.csv",
+        f"{metric}_centiles_by_age.csv",
+    ]
+
+
+class FitCache:
+    """
+    Size-bounded, least-recently-used store of fit artifacts, which can be
+    shared by several threads and processes (e.g. --shard workers). Entries
+    are written aside and renamed in place complete, and renamed aside
+    before being removed, so that an entry is either complete or absent.
+    """
+
+    def __init__(self, cache_dir, rscript, max_size_gb=10.0):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._spec_hash = file_hash(rscript)
+
+    def key(self, data, metric, extra_args=()):
+        """
+        Hash the rows used to fit `metric` together with the model spec and
+        any extra gamlss.R arguments.
+        """
+        cols = [metric, "age", "sex", "cohort"]
+        h = hashlib.sha256()
+        h.update(self._spec_hash.encode())
+        h.update(metric.encode())
+        h.update(" ".join(extra_args).encode())
+        h.update(",".join(cols).encode())
+        h.update(pd.util.hash_pandas_object(data[cols], index=False).values.tobytes())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _discard(self, entry):
+        """
+        Rename an entry aside, so that it disappears at once for every
+        reader, then remove it.
+        """
+        trash = os.path.join(self.cache_dir, f".evict_{uuid.uuid4().hex}")
+        try:
+            os.rename(entry, trash)
+        except FileNotFoundError:
+            # Already evicted by another thread or process.
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def fetch(self, job):
+        """
+        Copy the cached artifacts of a job into its output folder. Returns
+        False on a cache miss, which includes an entry evicted while it is
+        copied or missing an artifact.
+        """
+        if job.cache_key is None:
+            return False
+        entry = self._entry(job.cache_key)
+        if not os.path.isdir(entry):
+            return False
+
+        # Copy to a staging folder, so that a partial copy never reaches the output folder.
+        os.makedirs(job.output_dir, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=job.output_dir, prefix=".cache_")
+        try:
+            try:
+                for name in os.listdir(entry):
+                    shutil.copy2(os.path.join(entry, name), os.path.join(staging, name))
+            except FileNotFoundError:
+                return False
+            names = os.listdir(staging)
+            if not set(required_artifacts(job.metric)) <= set(names):
+                self._discard(entry)
+                return False
+            for name in names:
+                os.replace(os.path.join(staging, name), os.path.join(job.output_dir, name))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, job):
+        """
+        Store the artifacts of a successful fit, then evict the least
+        recently used entries until the cache fits in its size budget.
+        """
+        if job.cache_key is None:
+            return
+
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        for name in fit_artifacts(job.metric):
+            path = os.path.join(job.output_dir, name)
+            if os.path.exists(path):
+                shutil.copy2(path, os.path.join(tmp, name))
+
+        try:
+            os.rename(tmp, self._entry(job.cache_key))
+        except OSError:
+            # Another worker stored the same fit in the meantime.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                entry = os.path.join(self.cache_dir, name)
+                if name.startswith("."):
+                    continue
+                # Skip the entries evicted by another process in the meantime.
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                total += size
+
+            for _, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                self._discard(entry)
+                total -= size
+
+
+def cached_runner(run_job, cache):
+    """
+    Wrap a job runner so that cache hits skip the fit entirely.
+    """
+    if cache is None:
+        return run_job
+
+    def _run(job):
+        if cache.fetch(job):
+            job.cached = True
+            return 0
+        returncode = run_job(job)
+        if returncode == 0:
+            cache.store(job)
+        return returncode
+
+    return _run
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate fitted GAMLSS GG models in Python, without R.
+
+gamlss.R exports the mu, sigma and nu parameters of every fit over its age
+grid for each sex and cohort level (<metric>_gamlss_params.csv). The
+parameters are interpolated on their link scale (log for mu and sigma,
+identity for nu) at any age inside the grid, and centiles, z-scores and
+percentiles are computed with the closed form of the GG distribution, for
+whole arrays of ages at once.
+
+Usage:
+    python gamlss_centiles.py --params <metric>_gamlss_params.csv --output centiles.csv
+        [--age_min 0 --age_max 18 --n_ages 1000] [--sex M] [--cohort BCP]
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import special
+
+DEFAULT_PROBS = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+# Below this |nu| the GG distribution is evaluated as its lognormal limit,
+# as done by gamlss.dist.
+NU_EPS = 1e-06
+
+
+def gg_quantile(p, mu, sigma, nu):
+    """
+    Quantile function of the generalized gamma distribution (qGG).
+    """
+    p, mu, sigma, nu = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (p, mu, sigma, nu)))
+    small = np.abs(nu) <= NU_EPS
+    nu_safe = np.where(small, 1.0, nu)
+    theta = 1.0 / (sigma ** 2 * nu_safe ** 2)
+    p_gamma = np.where(nu_safe > 0, p, 1.0 - p)
+    z = special.gammaincinv(theta, p_gamma) / theta
+    y = mu * z ** (1.0 / nu_safe)
+    return np.where(small, mu * np.exp(sigma * special.ndtri(p)), y)
+
+
+def gg_cdf(y, mu, sigma, nu):
+    """
+    Cumulative distribution function of the generalized gamma distribution
+    (pGG).
+    """
+    y, mu, sigma, nu = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (y, mu, sigma, nu)))
+    small = np.abs(nu) <= NU_EPS
+    nu_safe = np.where(small, 1.0, nu)
+    theta = 1.0 / (sigma ** 2 * nu_safe ** 2)
+    cdf = special.gammainc(theta, theta * (y / mu) ** nu_safe)
+    cdf = np.where(nu_safe > 0, cdf, 1.0 - cdf)
+    return np.where(small, special.ndtr((np.log(y) - np.log(mu)) / sigma), cdf)
+
+
+class GAMLSSModel:
+    """
+    Tabulated GG parameters of one fitted model, indexed by sex, cohort and
+    age.
+    """
+
+    def __init__(self, params):
+        params = params.astype({"sex": str, "cohort": str})
+        self.sexes = pd.Index(sorted(params["sex"].unique()))
+        self.cohorts = pd.Index(sorted(params["cohort"].unique()))
+        self.ages = np.sort(params["age"].unique())
+
+        # Parameters on their link scale, shape (n_sex, n_cohort, n_age).
+        params = params.set_index(["sex", "cohort", "age"]).sort_index()
+        full_index = pd.MultiIndex.from_product([self.sexes, self.cohorts, self.ages])
+        params = params.reindex(full_index)
+        shape = (len(self.sexes), len(self.cohorts), len(self.ages))
+        self._eta = {
+            "mu": np.log(params["mu"].to_numpy()).reshape(shape),
+            "sigma": np.log(params["sigma"].to_numpy()).reshape(shape),
+            "nu": params["nu"].to_numpy().reshape(shape),
+        }
+
+    @classmethod
+    def load(cls, path):
+        return cls(pd.read_csv(path))
+
+    def _levels(self, index, values, n, name):
+        if values is None:
+            return np.zeros(n, dtype=int)
+        values = np.broadcast_to(np.asarray(values).astype(str), (n,))
+        idx = index.get_indexer(values)
+        if (idx < 0).any():
+            unknown = sorted(set(values[idx < 0]))
+            raise KeyError(f"Unknown {name} level(s) {unknown}, expected one of {list(index)}.")
+        return idx
+
+    def params(self, ages, sex=None, cohort=None):
+        """
+        Interpolate mu, sigma and nu at `ages`. `sex` and `cohort` are a level
+        or an array of levels matching `ages`, and default to the reference
+        (first) level used for the centile curves of gamlss.R. Ages outside
+        the fitted grid give NaN.
+        """
+        ages = np.asarray(ages, dtype=float).ravel()
+        n = len(ages)
+        s = self._levels(self.sexes, sex, n, "sex")
+        c = self._levels(self.cohorts, cohort, n, "cohort")
+
+        # Linear interpolation between the two surrounding grid ages.
+        i = np.clip(np.searchsorted(self.ages, ages) - 1, 0, len(self.ages) - 2)
+        w = (ages - self.ages[i]) / (self.ages[i + 1] - self.ages[i])
+        outside = (ages < self.ages[0]) | (ages > self.ages[-1])
+
+        out = {}
+        for name, eta in self._eta.items():
+            value = (1 - w) * eta[s, c, i] + w * eta[s, c, i + 1]
+            out[name] = np.where(outside, np.nan, value)
+        out["mu"] = np.exp(out["mu"])
+        out["sigma"] = np.exp(out["sigma"])
+        return out
+
+    def quantile(self, p, ages, sex=None, cohort=None):
+        """
+        Metric value of the centile `p` at every age.
+        """
+        return gg_quantile(p, **self.params(ages, sex, cohort))
+
+    def cdf(self, y, ages, sex=None, cohort=None):
+        """
+        Percentile (between 0 and 1) of each observed value `y`.
+        """
+        return gg_cdf(y, **self.params(ages, sex, cohort))
+
+    def zscore(self, y, ages, sex=None, cohort=None):
+        """
+        Normalized quantile residual (z-score) of each observed value `y`.
+        """
+        return special.ndtri(self.cdf(y, ages, sex, cohort))
+
+    def centiles(self, ages, probs=DEFAULT_PROBS, sex=None, cohort=None):
+        """
+        Centile curves in the wide format of load_centiles: age and one column
+        per centile.
+        """
+        ages = np.asarray(ages, dtype=float).ravel()
+        p = self.params(ages, sex, cohort)
+        values = gg_quantile(np.asarray(probs, dtype=float)[None, :],
+                             p["mu"][:, None], p["sigma"][:, None], p["nu"][:, None])
+        centiles = pd.DataFrame(values, columns=[float(prob) for prob in probs])
+        centiles.insert(0, "age", ages)
+        return centiles
+
+
+def load_models(folder):
+    """
+    Load every exported model of a folder, keyed by metric.
+    """
+    return {
+        f.replace("_gamlss_params.csv", ""): GAMLSSModel.load(os.path.join(folder, f))
+        for f in sorted(os.listdir(folder)) if f.endswith("_gamlss_params.csv")
+    }
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('--params', required=True,
+                   help="Parameter table written by gamlss.R (<metric>_gamlss_params.csv).")
+    p.add_argument('--output', required=True,
+                   help="Output CSV with one column per centile.")
+    p.add_argument('--age_min', type=float, default=None,
+                   help="First age of the grid (default: first fitted age).")
+    p.add_argument('--age_max', type=float, default=None,
+                   help="Last age of the grid (default: last fitted age).")
+    p.add_argument('--n_ages', type=int, default=1000,
+                   help="Number of ages in the grid.")
+    p.add_argument('--probs', type=float, nargs='+', default=DEFAULT_PROBS,
+                   help="Centiles to compute.")
+    p.add_argument('--sex', default=None,
+                   help="Sex level (default: reference level).")
+    p.add_argument('--cohort', default=None,
+                   help="Cohort level (default: reference level).")
+    return p
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    model = GAMLSSModel.load(args.params)
+    age_min = model.ages[0] if args.age_min is None else args.age_min
+    age_max = model.ages[-1] if args.age_max is None else args.age_max
+    ages = np.linspace(age_min, age_max, args.n_ages)
+
+    centiles = model.centiles(ages, args.probs, sex=args.sex, cohort=args.cohort)
+    centiles.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Data exchange between the Python drivers and gamlss.R.
+
+With the parquet exchange format, the input table is written once with one
+row group per bundle, so that every fit only reads its own slice and columns,
+and gamlss.R writes its centiles back in wide format.
+"""
+
+import os
+
+import pandas as pd
+
+
+def write_bundle_table(df, path, bundles):
+    """
+    Write the rows of every bundle to a single parquet file, one row group
+    per bundle. Returns the row group index of each bundle.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    row_groups = {}
+    with pq.ParquetWriter(path, schema) as writer:
+        for i, bundle in enumerate(bundles):
+            table = pa.Table.from_pandas(df[df["bundle"] == bundle], schema=schema,
+                                         preserve_index=False)
+            writer.write_table(table, row_group_size=max(1, table.num_rows))
+            row_groups[bundle] = i
+
+    return row_groups
+
+
+def bundle_row_groups(path):
+    """
+    Row group index of every bundle of a file written by write_bundle_table,
+    read from the file itself (e.g. written by another shard worker, for
+    other bundles or in another order).
+    """
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(path)
+    row_groups = {}
+    for i in range(parquet.num_row_groups):
+        for bundle in parquet.read_row_group(i, columns=["bundle"]).column("bundle").unique().to_pylist():
+            row_groups[bundle] = i
+    return row_groups
+
+
+def load_centiles(folder):
+    """
+    Load every centile table of a folder in wide format (age and one column
+    per centile), keyed by metric. Parquet tables are used when available,
+    otherwise the long-format CSVs are pivoted.
+    """
+    results = {}
+    files = sorted(os.listdir(folder))
+    for f in files:
+        if f.endswith("_centiles_by_age.parquet"):
+            wide = pd.read_parquet(os.path.join(folder, f))
+            results[f.replace("_centiles_by_age.parquet", "")] = wide.rename(
+                columns={c: float(c) for c in wide.columns if c != "age"})
+
+    for f in files:
+        metric = f.replace("_centiles_by_age.csv", "")
+        if f.endswith("_centiles_by_age.csv") and metric not in results:
+            long_df = pd.read_csv(os.path.join(folder, f))
+            results[metric] = long_df.pivot(index="age", columns='prob', values="metric").reset_index()
+
+    return results
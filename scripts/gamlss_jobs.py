@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Job scheduling helpers shared by the GAMLSS drivers.
+
+The whole bundle x metric job graph is built up front and handed to a bounded
+pool of workers, so a slow fit never holds back the remaining cores.
+"""
+
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from tqdm import tqdm
+
+
+# Cohorts acquired with a single low b-value shell or with multiple shells,
+# fitted separately for the fixel-based AFD.
+LOW_BVAL_COHORTS = ["MYRNA", "GESTE", "PING"]
+HIGH_BVAL_COHORTS = ["BCP", "ABCD", "BANDA"]
+
+
+@dataclass
+class FitJob:
+    """
+    A single GAMLSS fit (one metric of one bundle).
+
+    `column` is the input column to fit when it differs from the output
+    name `metric`, `cohorts` restricts the fit to some cohorts and
+    `row_group` selects the bundle slice of a parquet input. `cpu_time`
+    and `max_rss_mb` are the resources used by the fit, when the runner
+    can measure them. `log_name` overrides the name of the log file.
+    """
+    bundle: str
+    metric: str
+    input_path: str
+    output_dir: str
+    extra_args: list = field(default_factory=list)
+    column: Optional[str] = None
+    cohorts: Optional[list] = None
+    row_group: Optional[int] = None
+    submit_time: float = 0.0
+    start_time: float = 0.0
+    end_time: float = 0.0
+    returncode: Optional[int] = None
+    cache_key: Optional[str] = None
+    cached: bool = False
+    n_rows: Optional[int] = None
+    cpu_time: Optional[float] = None
+    max_rss_mb: Optional[float] = None
+    log_name: Optional[str] = None
+
+    @property
+    def log_file(self):
+        return os.path.join(self.output_dir, self.log_name or f"{self.metric}_gamlss.log")
+
+    @property
+    def queue_wait(self):
+        return self.start_time - self.submit_time
+
+    @property
+    def wall_time(self):
+        return self.end_time - self.start_time
+
+    def args(self):
+        args = [
+            "--input", self.input_path,
+            "--output", self.output_dir,
+            "--metric", self.column or self.metric
+        ]
+        if self.column is not None and self.column != self.metric:
+            args += ["--label", self.metric]
+        if self.cohorts:
+            args += ["--cohorts", ",".join(self.cohorts)]
+        if self.row_group is not None:
+            args += ["--row_group", str(self.row_group)]
+        return args + self.extra_args
+
+    def command(self, rscript):
+        return ["Rscript", rscript] + self.args()
+
+
+def metric_fits(df, metrics):
+    """
+    Fits needed for `metrics` on `df`, as (metric, input column, data,
+    cohorts). The fixel-based AFD is fitted separately on the single-shell
+    and multi-shell cohorts.
+    """
+    fits = []
+    for metric in metrics:
+        if metric == "afd_fixel":
+            low_bval_df = df[df['cohort'].isin(LOW_BVAL_COHORTS)]
+            low_bval_df = low_bval_df.rename(columns={"afd_fixel": "afd_fixel_lowb"}, inplace=False)
+            high_bval_df = df[df['cohort'].isin(HIGH_BVAL_COHORTS)]
+            high_bval_df = high_bval_df.rename(columns={"afd_fixel": "afd_fixel_highb"}, inplace=False)
+
+            fits.append(("afd_fixel_lowb", "afd_fixel", low_bval_df, LOW_BVAL_COHORTS))
+            fits.append(("afd_fixel_highb", "afd_fixel", high_bval_df, HIGH_BVAL_COHORTS))
+        else:
+            fits.append((metric, None, df, None))
+    return fits
+
+
+def run_rscript(job, rscript):
+    """
+    Run a fit in a fresh Rscript process, logging stdout/stderr to the job
+    log. The CPU time and peak RSS of the process are recorded on the job.
+    """
+    with open(job.log_file, 'w') as f:
+        proc = subprocess.Popen(job.command(rscript), stdout=f, stderr=subprocess.STDOUT)
+        # Reap the child ourselves to get its own resource usage.
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    job.cpu_time = usage.ru_utime + usage.ru_stime
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    job.max_rss_mb = usage.ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+    return proc.returncode
+
+
+class RWorkerPool:
+    """
+    Pool of long-lived R processes (gamlss_worker.R) that load the GAMLSS
+    libraries once and serve fit requests over stdin/stdout, so that a fit
+    does not pay for R startup and package loading.
+    """
+
+    def __init__(self, rscript, n_workers):
+        self.worker_script = os.path.join(os.path.dirname(os.path.abspath(rscript)),
+                                          "gamlss_worker.R")
+        self._idle = queue.Queue()
+        self._procs = []
+        self._lock = threading.Lock()
+        # Start every worker first so that the libraries load concurrently.
+        procs = [self._start() for _ in range(max(1, n_workers))]
+        try:
+            for proc in procs:
+                self._idle.put(self._wait_ready(proc))
+        except RuntimeError:
+            self.close()
+            raise
+
+    def _start(self):
+        proc = subprocess.Popen(["Rscript", self.worker_script],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                text=True, bufsize=1)
+        with self._lock:
+            self._procs.append(proc)
+        return proc
+
+    def _wait_ready(self, proc):
+        # Skip anything printed while loading the libraries.
+        for line in proc.stdout:
+            if line.strip() == "READY":
+                return proc
+        raise RuntimeError(f"R worker {self.worker_script} exited during startup.")
+
+    def _reap(self, proc):
+        if proc.poll() is None:
+            proc.kill()
+        for pipe in (proc.stdin, proc.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        proc.wait()
+        with self._lock:
+            self._procs.remove(proc)
+
+    def _replace(self, proc):
+        """
+        Reap a dead worker and start a new one in its place. The pool shrinks
+        if the new worker does not start.
+        """
+        self._reap(proc)
+        new_proc = self._start()
+        try:
+            self._idle.put(self._wait_ready(new_proc))
+            return
+        except RuntimeError as e:
+            self._reap(new_proc)
+            with self._lock:
+                n_left = len(self._procs)
+            tqdm.write(f"Could not restart a dead R worker ({e}), {n_left} workers left.",
+                       file=sys.stderr)
+        if n_left == 0:
+            # Wake up the callers waiting for a worker: every fit now fails.
+            self._idle.put(None)
+
+    def run(self, job):
+        """
+        Run a fit on the next idle worker and return 0 on success. A worker
+        that dies only fails its own fit, and is replaced.
+        """
+        proc = self._idle.get()
+        if proc is None:
+            self._idle.put(None)
+            return 1
+        try:
+            proc.stdin.write("\t".join([job.log_file] + job.args()) + "\n")
+            proc.stdin.flush()
+            reply = proc.stdout.readline()
+        except BrokenPipeError:
+            reply = ""
+
+        if not reply:
+            # The worker died (e.g. killed by the OOM killer).
+            self._replace(proc)
+            return 1
+
+        self._idle.put(proc)
+        if not reply.startswith("OK"):
+            return 1
+        # OK<TAB>elapsed<TAB>CPU seconds<TAB>peak R memory (MB)
+        fields = reply.rstrip("\n").split("\t")
+        if len(fields) >= 4:
+            job.cpu_time, job.max_rss_mb = float(fields[2]), float(fields[3])
+        return 0
+
+    def close(self, timeout=30.0):
+        """
+        Ask every worker to exit and kill those still running after `timeout`
+        seconds.
+        """
+        with self._lock:
+            procs = list(self._procs)
+        for proc in procs:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        for proc in procs:
+            try:
+                proc.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def fit_runner(rscript, n_workers, persistent=False):
+    """
+    Yield a callable running a FitJob, either on a pool of persistent R
+    workers or in a fresh Rscript process per fit.
+    """
+    if persistent:
+        with RWorkerPool(rscript, n_workers) as pool:
+            yield pool.run
+    else:
+        yield lambda job: run_rscript(job, rscript)
+
+
+def _timed(run_job, job):
+    job.start_time = time.perf_counter()
+    try:
+        job.returncode = run_job(job)
+    finally:
+        job.end_time = time.perf_counter()
+    return job
+
+
+def run_fit_jobs(jobs, run_job, n_workers, on_bundle_done=None,
+                 desc="Fitting GAMLSS models"):
+    """
+    Run every job on a pool of `n_workers` workers. Idle workers pick the
+    next queued job as soon as they are free.
+
+    `on_bundle_done(bundle, bundle_jobs)` is called from the calling thread
+    once every job of a bundle has finished, while the remaining fits keep
+    running in the background.
+    """
+    remaining = Counter(job.bundle for job in jobs)
+    done = {}
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = {}
+        for job in jobs:
+            job.submit_time = time.perf_counter()
+            futures[executor.submit(_timed, run_job, job)] = job
+
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           desc=desc, unit="fit"):
+            job = futures[future]
+            future.result()
+            done.setdefault(job.bundle, []).append(job)
+            remaining[job.bundle] -= 1
+            if remaining[job.bundle] == 0 and on_bundle_done is not None:
+                on_bundle_done(job.bundle, done[job.bundle])
+
+    return jobs
+
+
+def write_timing_report(jobs, path):
+    """
+    Write per-job queue-wait and wall time to a TSV file and return the
+    jobs that failed.
+    """
+    with open(path, 'w') as f:
+        f.write("bundle\tmetric\tqueue_wait_s\twall_time_s\treturncode\tcached\n")
+        for job in sorted(jobs, key=lambda j: j.wall_time, reverse=True):
+            f.write(f"{job.bundle}\t{job.metric}\t{job.queue_wait:.2f}\t"
+                    f"{job.wall_time:.2f}\t{job.returncode}\t{job.cached}\n")
+
+    return [job for job in jobs if job.returncode != 0]
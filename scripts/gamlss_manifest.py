@@ -0,0 +1,203 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Structured run manifest of the GAMLSS drivers, and a summary of it.
+
+bundleGAMLSS.py and networkGAMLSS.py append one JSON record per fit to a
+manifest (JSONL, <output_dir>/gamlss_manifest.jsonl by default, see
+--manifest; it is kept when -f wipes the output folder) with the run id,
+bundle, metric, row count, queue wait, wall time, CPU time and peak memory
+of the R process, the selected mu/sigma degrees and SBC from the search
+report, the number of failed candidates and the render time of the bundle
+figure.
+
+Run as a script, it ranks the slowest and least stable fits of one or more
+manifests, over every run or only the last one:
+    python gamlss_manifest.py results/gamlss_manifest.jsonl [--top 20] [--last_run]
+
+Stability is the number of failed or non-converged candidates, and, over
+several runs, the number of distinct selected models and the spread of the
+selected SBC.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
+import pandas as pd
+
+
+# Fields that are missing from the records of failed or unmeasured fits.
+OPTIONAL_FIELDS = ["cpu_time_s", "max_rss_mb", "plot_time_s", "n_candidates", "n_failed",
+                   "n_not_converged", "mu_degree", "sigma_degree", "sbc"]
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("manifests",
+                   help="Manifest files (JSONL) written by the drivers.",
+                   nargs="+")
+    p.add_argument("--top",
+                   type=int,
+                   help="Number of fits listed in each ranking.",
+                   default=20)
+    p.add_argument("--last_run",
+                   action="store_true",
+                   help="Only summarize the last run of each manifest.",
+                   default=False)
+
+    return p
+
+
+def new_run_id():
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+
+
+def _search_summary(job):
+    """
+    Selected degrees and SBC, and number of failed candidates, from the
+    search report written by gamlss.R.
+    """
+    path = os.path.join(job.output_dir, f"gamlss_search_{job.metric}.csv")
+    if not os.path.exists(path):
+        return {}
+    report = pd.read_csv(path)
+    summary = {
+        "n_candidates": int((report["status"] != "pruned").sum()),
+        "n_failed": int((report["status"] == "failed").sum()),
+        "n_not_converged": int((report["status"] == "not_converged").sum()),
+    }
+    selected = report[report["selected"].astype(str).str.upper() == "TRUE"]
+    if len(selected):
+        row = selected.iloc[0]
+        summary.update(mu_degree=int(row["mu_degree"]), sigma_degree=int(row["sigma_degree"]),
+                       sbc=float(row["sbc"]))
+    return summary
+
+
+def reset_output_dir(output_dir):
+    """
+    Empty `output_dir` for a new run (-f), keeping its manifest so that it
+    holds the records of every run. The manifest is moved next to the folder
+    while it is wiped.
+    """
+    manifest = os.path.join(output_dir, "gamlss_manifest.jsonl")
+    kept = f"{os.path.normpath(output_dir)}.gamlss_manifest.jsonl"
+    if os.path.exists(manifest):
+        os.replace(manifest, kept)
+    shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    if os.path.exists(kept):
+        os.replace(kept, manifest)
+
+
+def fit_record(job, run_id, driver, plot_time=None):
+    """
+    Manifest record of a finished FitJob.
+    """
+    record = {
+        "run_id": run_id,
+        "driver": driver,
+        "bundle": job.bundle,
+        "metric": job.metric,
+        "n_rows": job.n_rows,
+        "queue_wait_s": round(job.queue_wait, 3),
+        "wall_time_s": round(job.wall_time, 3),
+        "cpu_time_s": None if job.cpu_time is None else round(job.cpu_time, 3),
+        "max_rss_mb": None if job.max_rss_mb is None else round(job.max_rss_mb, 1),
+        "returncode": job.returncode,
+        "cached": job.cached,
+        "plot_time_s": None if plot_time is None else round(plot_time, 3),
+    }
+    if job.returncode == 0:
+        record.update(_search_summary(job))
+    return record
+
+
+def write_manifest(path, jobs, run_id, driver, plot_times=None):
+    """
+    Append the record of every job to the manifest at `path`. `plot_times`
+    gives the render time of the figure of each bundle.
+    """
+    plot_times = plot_times or {}
+    write_records(path, [fit_record(job, run_id, driver, plot_times.get(job.bundle)) for job in jobs])
+
+
+def write_records(path, records):
+    """
+    Append manifest records to the manifest at `path`.
+    """
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def load_manifests(paths, last_run=False):
+    frames = []
+    for path in paths:
+        df = pd.read_json(path, lines=True, dtype={"run_id": str})
+        if last_run:
+            df = df[df["run_id"] == df["run_id"].max()]
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    return df.reindex(columns=list(df.columns) + [c for c in OPTIONAL_FIELDS if c not in df])
+
+
+def summarize(df, top=20):
+    """
+    Tables ranking the bundles by total fit time, the slowest fits and the
+    least stable fits.
+    """
+    fits = df[~df["cached"].astype(bool)]
+
+    runs = fits.groupby(["bundle", "run_id"])[["wall_time_s", "cpu_time_s"]].sum(min_count=1)
+    # The render time is repeated on every fit of a bundle.
+    runs["plot_time_s"] = fits.drop_duplicates(["run_id", "bundle"]).set_index(
+        ["bundle", "run_id"])["plot_time_s"]
+    # Averaged over the runs where the time was measured.
+    bundles = runs.groupby("bundle").mean()
+    bundles["share_%"] = 100 * bundles["wall_time_s"] / bundles["wall_time_s"].sum()
+    bundles = bundles.sort_values("wall_time_s", ascending=False)
+
+    by_fit = fits.groupby(["bundle", "metric"])
+    slowest = by_fit.agg(runs=("run_id", "nunique"), n_rows=("n_rows", "max"),
+                         wall_time_s=("wall_time_s", "median"), cpu_time_s=("cpu_time_s", "median"),
+                         max_rss_mb=("max_rss_mb", "max")).sort_values("wall_time_s", ascending=False)
+
+    # Only successful fits have a selected model.
+    selected = (fits["returncode"] == 0) & fits["mu_degree"].notna() & fits["sigma_degree"].notna()
+    fits = fits.assign(model=(fits["mu_degree"].astype("Int64").astype(str) + "/" +
+                              fits["sigma_degree"].astype("Int64").astype(str)).where(selected),
+                       failed_fit=fits["returncode"] != 0)
+    unstable = fits.groupby(["bundle", "metric"]).agg(
+        failed_fits=("failed_fit", "sum"),
+        failed_candidates=("n_failed", "sum"),
+        not_converged=("n_not_converged", "sum"),
+        selected_models=("model", "nunique"),
+        sbc_std=("sbc", "std"))
+    unstable = unstable.sort_values(["failed_fits", "failed_candidates", "not_converged",
+                                     "selected_models", "sbc_std"], ascending=False)
+
+    return {"Time per run by bundle": bundles.head(top),
+            "Slowest fits (median over runs)": slowest.head(top),
+            "Least stable fits": unstable.head(top)}
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    df = load_manifests(args.manifests, args.last_run)
+    print(f"{len(df)} fits from {df['run_id'].nunique()} runs ({int(df['cached'].sum())} restored from cache).")
+    for title, table in summarize(df, args.top).items():
+        print(f"\n{title}:")
+        print(table.round(2).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering stage of the GAMLSS drivers.
+
+Figures are rendered from the centile tables written by gamlss.R, in a pool
+of processes that each discover and register the font once, so that plotting
+stays off the critical path of the fits and can be rerun on its own
+(--plots_only).
+
+matplotlib and seaborn are only imported by the functions that need them
+(_load_backend), so that the drivers can import this module, and start the
+PlotRenderer, without paying for them. The font files found for each font
+name are cached on disk (FONT_CACHE) so that the system fonts are not
+scanned again by every run; the cache is refreshed when a cached file is
+gone.
+"""
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from multiprocessing import get_context
+
+from gamlss_io import load_centiles
+
+
+# Set by _load_backend.
+plt = sns = font_manager = None
+
+FONT_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                          "sf-pediatric", "fonts.json")
+
+COHORT_ORDER = ["MYRNA", "BCP", "ABCD", "GESTE", "BANDA", "PING"]
+
+# Dict of y labels for each metric.
+Y_LABELS = {
+    "fa": "FA",
+    "md": "MD (mm²/s)",
+    "rd": "RD (mm²/s)",
+    "ad": "AD (mm²/s)",
+    "afd_fixel": "Fixel-based AFD",
+    "afd_fixel_lowb": "Fixel-based AFD",
+    "afd_fixel_highb": "Fixel-based AFD",
+    "GlobalEfficiency": "Global Efficiency",
+    "LocalEfficiency": "Local Efficiency",
+    "AverageStrength": "Average Strength",
+    "Modularity": "Modularity",
+    "AverageBetweennessCentrality": "Average BC",
+    "RichClubCoefficient": "Rich Club Coefficient",
+}
+
+
+def _load_backend():
+    """
+    Import matplotlib (with the Agg backend) and seaborn on first use.
+    """
+    global plt, sns, font_manager
+    if plt is not None:
+        return
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+    import matplotlib.font_manager
+    import seaborn
+    sns, font_manager = seaborn, matplotlib.font_manager
+    plt = matplotlib.pyplot
+
+
+def _read_font_cache():
+    try:
+        with open(FONT_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_font_cache(cache):
+    # Best effort, the fonts are simply scanned again if the cache cannot be written.
+    tmp = f"{FONT_CACHE}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(FONT_CACHE), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, FONT_CACHE)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+@lru_cache(maxsize=None)
+def find_font_files(font_name="Harding"):
+    """
+    Font files of the system matching `font_name`. The system fonts are only
+    scanned if the files cached on disk are missing or gone.
+    """
+    cache = _read_font_cache()
+    font_files = tuple(cache.get(font_name, ()))
+    if font_files and all(os.path.exists(font) for font in font_files):
+        return font_files
+
+    _load_backend()
+    font_files = tuple(font for font in font_manager.findSystemFonts(fontpaths=None, fontext='ttf')
+                       if font_name.lower() in font.lower())
+    if not font_files:
+        raise ValueError(f"Font {font_name} not found in system fonts.")
+    cache[font_name] = list(font_files)
+    _write_font_cache(cache)
+    return font_files
+
+
+def fetch_font(font_name="Harding"):
+    """
+    Fetch a font from the matplotlib font manager.
+    """
+    _load_backend()
+    for font_file in find_font_files(font_name):
+        font_manager.fontManager.addfont(font_file)
+
+
+def setup_fonts(font_name="Harding", font_family="Harding Text Web"):
+    fetch_font(font_name)
+    plt.rcParams['font.family'] = font_family
+
+
+def _ylim(values):
+    """
+    Take the max/min, and round to the next 0.1, 0.01, 0.001 or 0.0001
+    depending on the range.
+    """
+    data_max = values.max()
+    data_min = values.min()
+    data_range = data_max - data_min
+    if data_range > 0.1:
+        return round(max(0, data_min - 0.1), 1), round(data_max + 0.1, 1)
+    elif data_range > 0.01:
+        return round(max(0, data_min - 0.01), 2), round(data_max + 0.01, 2)
+    elif data_range > 0.001:
+        return round(max(0, data_min - 0.001), 3), round(data_max + 0.001, 3)
+    return round(max(0, data_min - 0.0001), 4), round(data_max + 0.0001, 4)
+
+
+def _plot_band(ax, centiles, color, median_color, alpha):
+    """
+    Plot the 5th/95th centiles (dashed), the median and the band between them.
+    """
+    age = centiles["age"].to_numpy()
+    ax.plot(age, centiles[0.05].to_numpy(), color=color, linestyle='--', linewidth=2)
+    ax.plot(age, centiles[0.5].to_numpy(), color=median_color, linestyle='-', linewidth=2)
+    ax.plot(age, centiles[0.95].to_numpy(), color=color, linestyle='--', linewidth=2)
+    ax.fill_between(age, centiles[0.05], centiles[0.95], color=color, alpha=alpha, zorder=-1)
+
+
+def _set_age_axis(ax, log_age):
+    if log_age:
+        ax.set_xscale('log')
+        ax.set_xticks([0.1, 0.5, 1, 2, 5, 10, 18])
+        ax.set_xticklabels(['0.1', '0.5', '1', '2', '5', '10', '18'])
+    else:
+        ax.set_xticks([0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
+
+
+def _finish_figure(fig, ax, cohort_cmap, log_y=False, afd_fixel=False, wspace=0.25):
+    """
+    Axis styling, global legends and panel labels shared by every figure.
+    """
+    for row in ax:
+        for a in row:
+            a.spines['top'].set_visible(False)
+            a.spines['right'].set_visible(False)
+            a.spines[["left", "bottom"]].set_linewidth(2)
+            if a.get_ylim()[1] < 0.01 and not log_y:
+                a.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
+
+    # Add global legends: sex, cohorts and centile labels (compact)
+    handles_sex = [plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="o", markeredgewidth=1, markeredgecolor='black'),
+                plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="x", markeredgewidth=3, markeredgecolor='black')]
+    labels_sex = ["Male", "Female"]
+    fig.legend(handles_sex, labels_sex, loc="upper left", bbox_to_anchor=(0.90, 0.86), ncol=1, fontsize=12, frameon=False, title="Sex", title_fontproperties={'size': 14, 'weight': 'bold'})
+
+    handles_cohort = [plt.Line2D([0], [0], color=cohort_cmap[i], markersize=8, lw=0, marker="o", markeredgewidth=1, markeredgecolor='dimgrey') for i in range(len(cohort_cmap))]
+    fig.legend(handles_cohort, COHORT_ORDER, loc="upper left", bbox_to_anchor=(0.90, 0.69), ncol=1, fontsize=12, frameon=False, title="Cohort", title_fontproperties={'size': 14, 'weight': 'bold'})
+
+    handles_centile = [plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='-', label='Median'),
+                        plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='--', label='5th/95th Percentiles')]
+    labels_centile = ["Median", "5th/95th Percentiles"]
+    fig.legend(handles_centile, labels_centile, loc="upper left", bbox_to_anchor=(0.90, 0.36), ncol=1, fontsize=12, frameon=False)
+
+    if afd_fixel:
+        handles_centile = [plt.Line2D([0], [0], color=cohort_cmap[4], markersize=8, lw=3, linestyle='-', label='Multi-shell'),
+                            plt.Line2D([0], [0], color=cohort_cmap[1], markersize=8, lw=3, linestyle='-', label='Single-shell')]
+        labels_centile = ["Multi-shell", "Single-shell"]
+        fig.legend(handles_centile, labels_centile, loc="upper left", bbox_to_anchor=(0.90, 0.26), ncol=1, fontsize=12, frameon=False)
+
+    row_labels = ['a', 'b']
+    ax[0, 0].text(-0.2, 1.07, row_labels[0], transform=ax[0, 0].transAxes, fontsize=18, fontweight='bold', va='top', ha='right')
+    ax[1, 0].text(-0.2, 1.07, row_labels[1], transform=ax[1, 0].transAxes, fontsize=18, fontweight='bold', va='top', ha='right')
+
+    # Some adjustements to space between subplots.
+    plt.subplots_adjust(wspace=wspace)
+
+
+def plot_centiles(data, metrics, results_dfs, plot_path, log_age=False, log_y=False, wspace=0.25):
+    """
+    Plot the observed data (top row) and the fitted centiles (bottom row) of
+    every metric, and save the figure to `plot_path`.
+    """
+    _load_backend()
+    rocket_cmap = sns.color_palette("rocket_r", 6)
+    cohort_cmap = list(rocket_cmap)  # six cohorts
+
+    fig, ax = plt.subplots(2, len(metrics) if len(metrics) > 1 else 2, figsize=(18, 6), sharex=True, squeeze=True)
+    for i, metric in enumerate(metrics):
+        ylim = _ylim(data[metric])
+
+        sns.scatterplot(data=data, x="age", y=metric, ax=ax[0, i],
+                        hue="cohort", style="sex", palette=cohort_cmap, legend=False,
+                        hue_order=COHORT_ORDER)
+        ax[0, i].set_xlabel("")
+
+        # Plot the centiles.
+        if metric == "afd_fixel":
+            _plot_band(ax[1, i], results_dfs["afd_fixel_lowb"], rocket_cmap[1], rocket_cmap[1], 0.2)
+            _plot_band(ax[1, i], results_dfs["afd_fixel_highb"], rocket_cmap[4], rocket_cmap[4], 0.2)
+        else:
+            _plot_band(ax[1, i], results_dfs[metric], rocket_cmap[0], rocket_cmap[5], 0.4)
+        ax[1, i].set_xlabel("Age (years)", fontsize=14, fontweight='bold')
+
+        for a in ax[:, i]:
+            if log_y:
+                a.set_yscale('log')
+            else:
+                a.set_ylim(*ylim)
+            a.set_ylabel(Y_LABELS.get(metric, metric), fontsize=14, fontweight='bold')
+            _set_age_axis(a, log_age)
+            a.tick_params(axis='both', which='major', labelsize=10)
+
+    _finish_figure(fig, ax, cohort_cmap, log_y=log_y, afd_fixel="afd_fixel" in metrics, wspace=wspace)
+
+    plt.savefig(plot_path, dpi=300, bbox_inches='tight', facecolor='white')
+    plt.close(fig)
+    return plot_path
+
+
+def plot_bundle(bundle, bundle_df, metrics, bundle_output_dir, output_dir):
+    """
+    Plot the observed data and the fitted centiles of every metric for a
+    single bundle.
+    """
+    results_dfs = load_centiles(bundle_output_dir)
+    return plot_centiles(bundle_df, metrics, results_dfs,
+                         os.path.join(output_dir, f"{bundle}_GAMLSS_centiles.png"))
+
+
+def plot_network(df, metrics, output_dir, log_age=False, log_y=False):
+    """
+    Plot the observed data and the fitted centiles of every network metric.
+    """
+    results_dfs = load_centiles(output_dir)
+    return plot_centiles(df, metrics, results_dfs,
+                         os.path.join(output_dir, "network_GAMLSS_centiles.png"),
+                         log_age=log_age, log_y=log_y, wspace=0.30)
+
+
+def _timed_plot(plot_fn, *args, **kwargs):
+    start = time.perf_counter()
+    return plot_fn(*args, **kwargs), time.perf_counter() - start
+
+
+class PlotRenderer:
+    """
+    Pool of rendering processes. Each process registers the font once, then
+    renders the figures submitted to it while the caller keeps going. The
+    render time of every figure is kept in `render_times`, keyed by name.
+
+    The processes are spawned rather than forked: they are started on the
+    first figure, once the persistent R workers run, and forked ones would
+    hold the stdin pipes of the R workers open, so that these never see EOF
+    on close.
+    """
+
+    def __init__(self, n_workers, font_name="Harding", font_family="Harding Text Web"):
+        # Fail early if the font is missing (and fill the font cache for the workers).
+        find_font_files(font_name)
+        self._executor = ProcessPoolExecutor(max_workers=max(1, n_workers),
+                                             mp_context=get_context("spawn"),
+                                             initializer=setup_fonts,
+                                             initargs=(font_name, font_family))
+        self._futures = []
+        self.render_times = {}
+
+    def submit(self, name, plot_fn, *args, **kwargs):
+        self._futures.append((name, self._executor.submit(_timed_plot, plot_fn, *args, **kwargs)))
+
+    def wait(self):
+        """
+        Wait for every submitted figure and return the paths of the rendered
+        figures and the (name, error) of the failed ones.
+        """
+        paths, errors = [], []
+        for name, future in self._futures:
+            try:
+                path, self.render_times[name] = future.result()
+                paths.append(path)
+            except Exception as e:
+                errors.append((name, e))
+        self._futures = []
+        return paths, errors
+
+    def close(self, cancel=False):
+        """
+        Wait for the pending figures and stop the processes. With `cancel`,
+        the figures not started yet are dropped, with a warning naming them.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        cancelled = [name for name, future in self._futures if future.cancelled()]
+        if cancelled:
+            print(f"Warning: {len(cancelled)} figures were not rendered: {', '.join(map(str, cancelled))}.",
+                  file=sys.stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # On error (e.g. a failed fit stage), do not render what is left.
+        self.close(cancel=exc_type is not None)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Shared on-disk job queue for running the GAMLSS fits on several independent
+workers (job-array tasks on different nodes, or local processes).
+
+The queue lives in <output_dir>/.queue. A worker claims a fit by creating its
+lock file exclusively (O_CREAT | O_EXCL), runs it in a private staging folder,
+moves the artifacts in place and then writes the status file of the fit,
+which marks it as done. Workers skip fits with a successful status, so a
+restarted run only does the remaining work. Fits that failed before a worker
+started are retried, and locks older than a timeout (a worker killed
+mid-fit) are broken. Workers refresh the locks of their running fits, so
+that these never look stale, and only release or complete a fit whose
+lock they still hold. The inputs and model options of the worker creating
+the queue are recorded in it (run.json), and workers with different ones
+refuse to join it.
+"""
+
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from gamlss_cache import fit_artifacts
+from gamlss_jobs import _timed
+from gamlss_manifest import fit_record
+
+
+# Age (seconds) after which the breaker lock of a worker killed while breaking
+# a stale lock is removed.
+BREAK_TIMEOUT = 60
+
+
+def write_atomic(path, write_fn, skip_existing=False):
+    """
+    Call `write_fn(tmp_path)`, then rename the temporary file to `path`, so
+    that readers never see a partial file. With `skip_existing`, nothing is
+    done if `path` already exists (e.g. written by another worker).
+    """
+    if skip_existing and os.path.exists(path):
+        return
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write_fn(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class JobQueue:
+    """
+    Lock and status files of the fits of an output folder.
+    """
+
+    def __init__(self, output_dir, lock_timeout_h=24.0):
+        self.queue_dir = os.path.join(output_dir, ".queue")
+        self.lock_timeout = lock_timeout_h * 3600
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        # Seconds between two refreshes of the locks held.
+        self.heartbeat = min(60.0, self.lock_timeout / 4)
+        # Token of every lock held, keyed by path.
+        self._held = {}
+        self._held_lock = threading.Lock()
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    def check_spec(self, spec):
+        """
+        Record the inputs and options of the run (`spec`, a dict of JSON
+        values) when the queue is created, and raise a ValueError if a later
+        worker has different ones: its fits would not be those of the queue.
+        """
+        path = os.path.join(self.queue_dir, "run.json")
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        _dump_json(spec, tmp)
+        try:
+            # Only the first worker creates it.
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+
+        with open(path) as f:
+            recorded = json.load(f)
+        changed = sorted(k for k in spec.keys() | recorded.keys() if spec.get(k) != recorded.get(k))
+        if changed:
+            raise ValueError(f"The queue in {self.queue_dir} was created with a different "
+                             f"{', '.join(changed)}. Use another output folder, or remove the queue "
+                             "to start over.")
+
+    def _path(self, job, ext):
+        return os.path.join(self.queue_dir, f"{job.bundle}__{job.metric}.{ext}")
+
+    def status(self, job):
+        """
+        Status record of a finished fit, None if it never finished.
+        """
+        try:
+            with open(self._path(job, "json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def is_done(self, job, since=None):
+        """
+        True if the fit succeeded, or failed after `since` (a timestamp),
+        i.e. during the current run.
+        """
+        path = self._path(job, "json")
+        status = self.status(job)
+        if status is None:
+            return False
+        return status["returncode"] == 0 or (since is not None and os.path.getmtime(path) >= since)
+
+    def claim(self, job):
+        """
+        Try to take the lock of a fit. Returns False if another worker holds
+        it and it is not stale.
+        """
+        path = self._path(job, "lock")
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                if age < self.lock_timeout:
+                    return False
+                self._break_stale(path)
+                continue
+            token = uuid.uuid4().hex
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"owner": self.owner, "token": token, "time": time.time()}, f)
+            with self._held_lock:
+                self._held[path] = token
+            return True
+        return False
+
+    def _token(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f).get("token")
+        except (FileNotFoundError, ValueError):
+            # Missing, or being written by the worker that just claimed it.
+            return None
+
+    def holds(self, job):
+        """
+        True if the lock of the fit is still the one taken by this worker,
+        i.e. it was not broken as stale and claimed by another worker.
+        """
+        path = self._path(job, "lock")
+        with self._held_lock:
+            token = self._held.get(path)
+        return token is not None and self._token(path) == token
+
+    def refresh(self):
+        """
+        Touch the locks held by this worker, so that they do not become
+        stale while their fits run.
+        """
+        with self._held_lock:
+            held = list(self._held.items())
+        for path, token in held:
+            if self._token(path) == token:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+    def _break_stale(self, path):
+        """
+        Remove the lock at `path` if it is stale. Breaking goes through a
+        second, exclusive lock under which the age is checked again, so that
+        a worker that saw the same stale lock never removes the fresh lock
+        taken by the worker that broke it first.
+        """
+        breaker = f"{path}.break"
+        try:
+            fd = os.open(breaker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another worker is breaking it, or was killed doing so.
+            try:
+                if time.time() - os.path.getmtime(breaker) > BREAK_TIMEOUT:
+                    os.remove(breaker)
+            except FileNotFoundError:
+                pass
+            return
+        try:
+            if time.time() - os.path.getmtime(path) >= self.lock_timeout:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
+            os.remove(breaker)
+
+    def release(self, job):
+        """
+        Remove the lock of a fit if this worker still holds it.
+        """
+        path = self._path(job, "lock")
+        held = self.holds(job)
+        with self._held_lock:
+            self._held.pop(path, None)
+        if held:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def complete(self, job, record):
+        """
+        Write the status of a finished fit, then release its lock. Returns
+        False, writing nothing, if the lock was lost to another worker.
+        """
+        if not self.holds(job):
+            self.release(job)
+            return False
+        write_atomic(self._path(job, "json"), lambda tmp: _dump_json(record, tmp))
+        self.release(job)
+        return True
+
+
+def _dump_json(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def _run_staged(run_job, job, owner):
+    """
+    Run a fit in a private staging folder, then move its artifacts to the
+    output folder of the job.
+    """
+    output_dir = job.output_dir
+    staging = os.path.join(output_dir, f".staging-{job.metric}-{owner}")
+    os.makedirs(staging, exist_ok=True)
+    job.output_dir = staging
+    try:
+        _timed(run_job, job)
+    finally:
+        job.output_dir = output_dir
+        for name in fit_artifacts(job.metric):
+            if os.path.exists(os.path.join(staging, name)):
+                os.replace(os.path.join(staging, name), os.path.join(output_dir, name))
+        shutil.rmtree(staging, ignore_errors=True)
+    return job
+
+
+def run_shard(jobs, run_job, job_queue, n_workers, run_id, driver):
+    """
+    Run, on `n_workers` threads, every job that is neither done nor claimed
+    by another worker. Returns the jobs run by this worker.
+    """
+    start = time.time()
+    pending = iter(jobs)
+    pending_lock = threading.Lock()
+    ran = []
+    progress = tqdm(total=len(jobs), desc=f"Fitting GAMLSS models ({job_queue.owner})", unit="fit")
+
+    def _worker():
+        while True:
+            with pending_lock:
+                job = next(pending, None)
+            if job is None:
+                return
+            if job_queue.is_done(job, start) or not job_queue.claim(job):
+                progress.update()
+                continue
+            # Another worker may have finished it between the check and the claim.
+            if job_queue.is_done(job, start):
+                job_queue.release(job)
+                progress.update()
+                continue
+
+            job.submit_time = time.perf_counter()
+            try:
+                _run_staged(run_job, job, job_queue.owner)
+            except Exception:
+                job.returncode = 1
+                tqdm.write(f"Fit {job.bundle}/{job.metric} failed:\n{traceback.format_exc()}",
+                           file=sys.stderr)
+            if not job_queue.complete(job, fit_record(job, run_id, driver)):
+                tqdm.write(f"Lost the lock of {job.bundle}/{job.metric} to another worker "
+                           "(stale after --lock_timeout), its status is left to that worker.",
+                           file=sys.stderr)
+            ran.append(job)
+            progress.update()
+
+    # Keep the locks of the running fits fresh.
+    stop = threading.Event()
+
+    def _heartbeat():
+        while not stop.wait(job_queue.heartbeat):
+            job_queue.refresh()
+
+    heartbeat = threading.Thread(target=_heartbeat, daemon=True)
+    heartbeat.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+            for future in [executor.submit(_worker) for _ in range(max(1, n_workers))]:
+                future.result()
+    finally:
+        stop.set()
+        heartbeat.join()
+    progress.close()
+    return ran
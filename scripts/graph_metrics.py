@@ -0,0 +1,329 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Compute graph metrics of connectivity matrices, on stacks of subjects at once.
+
+Computes the same metrics as networkx on the graph of every matrix
+(nx.from_numpy_array, an edge for every non-zero entry), as used to build the
+input of networkGAMLSS.py:
+    Density, GlobalEfficiency, LocalEfficiency, AverageStrength, Modularity,
+    AverageBetweennessCentrality and RichClubCoefficient.
+
+Shortest paths are computed for all sources at once by breadth-first search
+with boolean matrix products over (n_subjects, N, N) stacks, instead of
+building a networkx graph per subject. Matrices are expected to be symmetric
+with an empty diagonal.
+
+Usage:
+    python graph_metrics.py graph_metrics.csv --in_dirs <dir_with_npy> [<dir_with_npy> ...]
+    python graph_metrics.py graph_metrics.csv --store <store_dir>
+"""
+
+import argparse
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from connectome_store import ConnectomeStore, normalize
+from demographics import DemographicsRegistry
+
+
+METRICS = ["Density", "GlobalEfficiency", "LocalEfficiency", "AverageStrength",
+           "Modularity", "AverageBetweennessCentrality", "RichClubCoefficient"]
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("out_csv",
+                   help="Output CSV file with one row per matrix.")
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--in_dirs",
+                   help="Folders containing the connectivity matrices (.npy), named like\n"
+                   "sub-XXXX[_ses-XXXX]_*.npy.",
+                   nargs="+")
+    g.add_argument("--store",
+                   help="Connectome store built by connectome_store.py (already normalized).")
+    p.add_argument("--demographics",
+                   help="Demographics registry (demographics.py) joined to the metrics. Matrices\n"
+                   "without age or sex are dropped.",
+                   default=None)
+    p.add_argument("--batch_size",
+                   type=int,
+                   help="Number of matrices processed together.",
+                   default=32)
+    p.add_argument("--no_normalization",
+                   action="store_true",
+                   help="Do not min-max normalize the matrices of --in_dirs before computing\n"
+                   "the metrics.",
+                   default=False)
+
+    return p
+
+
+def shortest_path_lengths(adj):
+    """
+    Unweighted shortest path length between every pair of nodes of a stack of
+    adjacency matrices (..., n, n), inf for unreachable pairs.
+    """
+    adj = adj.astype(np.float32)
+    n = adj.shape[-1]
+    dist = np.full(adj.shape, np.inf, dtype=float)
+    reached = np.broadcast_to(np.eye(n, dtype=bool), adj.shape).copy()
+    dist[reached] = 0
+
+    # Breadth-first search from every source at once, one level per product.
+    frontier = reached.astype(np.float32)
+    for d in range(1, n):
+        new = (frontier @ adj > 0) & ~reached
+        if not new.any():
+            break
+        dist[new] = d
+        reached |= new
+        frontier = new.astype(np.float32)
+
+    return dist
+
+
+def _efficiency(dist, n_nodes):
+    """
+    Average inverse shortest path length over the ordered pairs of nodes, as
+    nx.global_efficiency, for graphs of `n_nodes` nodes padded to dist.shape.
+    """
+    with np.errstate(divide="ignore"):
+        inv = np.where(dist > 0, 1.0 / dist, 0.0)
+    denom = n_nodes * (n_nodes - 1.0)
+    return np.divide(inv.sum(axis=(-2, -1)), denom, out=np.zeros(denom.shape), where=denom > 0)
+
+
+def global_efficiency(dist):
+    n = dist.shape[-1]
+    return _efficiency(dist, np.full(dist.shape[:-2], n, dtype=float))
+
+
+def local_efficiency(adj):
+    """
+    Average over nodes of the global efficiency of the subgraph induced by
+    their neighbours, as nx.local_efficiency, for a single adjacency matrix.
+    """
+    n = adj.shape[-1]
+    degree = adj.sum(axis=-1)
+    k_max = int(degree.max())
+    if k_max < 2:
+        return 0.0
+
+    # Neighbours of every node first, padded to the largest degree.
+    neighbours = np.argsort(~adj, axis=-1, kind="stable")[:, :k_max]
+    valid = np.arange(k_max)[None, :] < degree[:, None]
+    sub = adj[neighbours[:, :, None], neighbours[:, None, :]]
+    sub &= valid[:, :, None] & valid[:, None, :]
+
+    return _efficiency(shortest_path_lengths(sub), degree.astype(float)).sum() / n
+
+
+def average_betweenness(dist):
+    """
+    Mean normalized (unweighted) betweenness centrality over nodes, as
+    np.mean(nx.betweenness_centrality(G, weight=None)). Every shortest path
+    between s and t goes through d(s, t) - 1 other nodes, so the sum of the
+    betweenness over nodes only depends on the path lengths.
+    """
+    n = dist.shape[-1]
+    if n <= 2:
+        return np.zeros(dist.shape[:-2])
+    interior = np.where(np.isfinite(dist) & (dist > 0), dist - 1, 0).sum(axis=(-2, -1))
+    return interior / ((n - 1) * (n - 2)) / n
+
+
+def average_rich_club(adj):
+    """
+    Mean unnormalized rich-club coefficient over degrees, as
+    np.mean(nx.rich_club_coefficient(G, normalized=False)).
+    """
+    n_batch, n = adj.shape[:2]
+    degree = adj.sum(axis=-1)
+    rows = np.arange(n_batch)[:, None]
+
+    # Number of nodes with degree > k, for every k.
+    deg_hist = np.zeros((n_batch, n + 1))
+    np.add.at(deg_hist, (rows, degree), 1)
+    n_k = n - np.cumsum(deg_hist, axis=1)[:, :n]
+
+    # Number of edges whose endpoints both have degree > k, for every k.
+    i, j = np.triu_indices(n, k=1)
+    edges = adj[:, i, j]
+    min_degree = np.minimum(degree[:, i], degree[:, j])
+    edge_hist = np.zeros((n_batch, n + 1))
+    np.add.at(edge_hist, (np.broadcast_to(rows, edges.shape)[edges], min_degree[edges]), 1)
+    e_k = edges.sum(axis=1, keepdims=True) - np.cumsum(edge_hist, axis=1)[:, :n]
+
+    valid = n_k > 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rc = np.where(valid, 2 * e_k / (n_k * (n_k - 1)), 0)
+    return np.divide(rc.sum(axis=1), valid.sum(axis=1), out=np.full(n_batch, np.nan),
+                     where=valid.any(axis=1))
+
+
+def greedy_modularity_labels(adj):
+    """
+    Community of every node found by Clauset-Newman-Moore greedy modularity
+    maximization on the unweighted graphs, as
+    nx.community.greedy_modularity_communities(G). Communities are merged one
+    pair at a time, in every graph of the stack at once, while the modularity
+    does not decrease. The modularity changes are updated with the same
+    arithmetic and ties broken the same way as networkx.
+    """
+    n_batch, n = adj.shape[:2]
+    degree = adj.sum(axis=-1)
+    m = degree.sum(axis=-1) / 2
+    q0 = np.divide(1.0, m, out=np.zeros(n_batch), where=m > 0)
+
+    # Fraction of edge ends per community, and modularity change of merging
+    # every pair of connected communities (-inf when not connected).
+    a = degree * q0[:, None] * 0.5
+    aa = a[:, :, None] * a[:, None, :]
+    dq = np.where(adj, q0[:, None, None] - (aa + aa), -np.inf)
+    dq[:, np.arange(n), np.arange(n)] = -np.inf
+    labels = np.tile(np.arange(n), (n_batch, 1))
+    active = m > 0
+    rows = np.arange(n_batch)
+
+    for _ in range(n - 1):
+        best = dq.reshape(n_batch, -1).argmax(axis=1)
+        merge = active & (dq.reshape(n_batch, -1)[rows, best] >= 0)
+        if not merge.any():
+            break
+
+        # Merge community u into community v.
+        b = rows[merge]
+        u, v = np.divmod(best[merge], n)
+        dq_u, dq_v = dq[b, u], dq[b, v]
+        nbr_u, nbr_v = np.isfinite(dq_u), np.isfinite(dq_v)
+        a_u, a_v, a_w = a[b, u][:, None], a[b, v][:, None], a[b]
+        dq_vw = np.where(nbr_u & nbr_v, dq_v + dq_u,
+                         np.where(nbr_v, dq_v - (a_u * a_w + a_w * a_u),
+                                  np.where(nbr_u, dq_u - (a_v * a_w + a_w * a_v), -np.inf)))
+        dq_vw[np.arange(len(b)), u] = -np.inf
+        dq_vw[np.arange(len(b)), v] = -np.inf
+        dq[b, v, :] = dq_vw
+        dq[b, :, v] = dq_vw
+        dq[b, u, :] = -np.inf
+        dq[b, :, u] = -np.inf
+        a[b, v] += a[b, u]
+        a[b, u] = 0
+        labels[b] = np.where(labels[b] == u[:, None], v[:, None], labels[b])
+        active = merge
+
+    return labels
+
+
+def modularity(weights, labels):
+    """
+    Weighted modularity of a partition, as nx.community.modularity(G, communities).
+    """
+    n = weights.shape[-1]
+    strength = weights.sum(axis=-1)
+    total = strength.sum(axis=-1)
+    same = labels[:, :, None] == labels[:, None, :]
+    one_hot = labels[:, :, None] == np.arange(n)[None, None, :]
+    community_strength = np.einsum("bi,bic->bc", strength, one_hot)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (weights * same).sum(axis=(1, 2)) / total - (community_strength ** 2).sum(axis=1) / total ** 2
+
+
+def compute_graph_metrics(matrices, batch_size=32):
+    """
+    Graph metrics of a stack of matrices of shape (n_subjects, N, N), one row
+    per matrix.
+    """
+    n = matrices.shape[-1]
+    results = {metric: np.empty(len(matrices)) for metric in METRICS}
+
+    # Only one batch is read (e.g. from a memory map) at a time.
+    for start in range(0, len(matrices), batch_size):
+        batch = np.asarray(matrices[start:start + batch_size], dtype=float)
+        out = slice(start, start + len(batch))
+        adj = batch != 0
+        dist = shortest_path_lengths(adj)
+
+        results["Density"][out] = (batch > 0).sum(axis=(1, 2)) / (n * n)
+        results["GlobalEfficiency"][out] = global_efficiency(dist)
+        results["LocalEfficiency"][out] = [local_efficiency(a) for a in adj]
+        results["AverageStrength"][out] = batch.sum(axis=-1).mean(axis=-1)
+        results["Modularity"][out] = modularity(batch, greedy_modularity_labels(adj))
+        results["AverageBetweennessCentrality"][out] = average_betweenness(dist)
+        results["RichClubCoefficient"][out] = average_rich_club(adj)
+
+    return pd.DataFrame(results)
+
+
+def graph_metrics_table(connectomes, batch_size=32):
+    """
+    Graph metrics of a dict of matrices keyed by (participant_id, session_id).
+    Matrices of different sizes (e.g. 83 and 227 nodes) are stacked separately.
+    """
+    keys = list(connectomes)
+    tables = []
+    for shape in sorted({connectomes[k].shape for k in keys}):
+        shape_keys = [k for k in keys if connectomes[k].shape == shape]
+        metrics = compute_graph_metrics(np.stack([connectomes[k] for k in shape_keys]), batch_size)
+        metrics.insert(0, "participant_id", [k[0] for k in shape_keys])
+        metrics.insert(1, "session_id", [k[1] for k in shape_keys])
+        metrics.index = [keys.index(k) for k in shape_keys]
+        tables.append(metrics)
+
+    return pd.concat(tables).sort_index().reset_index(drop=True)
+
+
+def store_graph_metrics(store, batch_size=32):
+    """
+    Graph metrics of every matrix of a ConnectomeStore, read straight from
+    its memory maps.
+    """
+    tables = []
+    for n_nodes in store.sizes:
+        rows = store.index[store.index["n_nodes"] == n_nodes].sort_values("offset")
+        metrics = compute_graph_metrics(store.matrices(n_nodes), batch_size)
+        metrics.insert(0, "participant_id", rows["participant_id"].to_numpy())
+        metrics.insert(1, "session_id", rows["session_id"].to_numpy())
+        tables.append(metrics)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    if args.store is not None:
+        df = store_graph_metrics(ConnectomeStore(args.store), args.batch_size)
+    else:
+        # Load every matrix, keyed by subject and session.
+        connectomes = {}
+        for folder in args.in_dirs:
+            for f in tqdm(sorted(os.listdir(folder)), desc=f"Loading {folder}"):
+                if not f.endswith(".npy"):
+                    continue
+                sub = re.search(r'sub-[a-zA-Z0-9]+', f).group(0)
+                ses = re.search(r'ses-[a-zA-Z0-9]+', f)
+                mat = np.load(os.path.join(folder, f))
+                if not args.no_normalization:
+                    mat = normalize(mat)
+                connectomes[(sub, ses.group(0) if ses else "")] = mat
+        df = graph_metrics_table(connectomes, args.batch_size)
+
+    if args.demographics is not None:
+        n = len(df)
+        df = DemographicsRegistry.load(args.demographics).join(df, how="inner")
+        df = df.dropna(subset=["age", "sex"])
+        print(f"Dropped {n - len(df)} of {n} matrices without age or sex.")
+    df.to_csv(args.out_csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,16 +6,18 @@ for graph network metrics.
 """
 
 import argparse
-import subprocess
 import os
-import shutil
+import time
 
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib import axes, font_manager
-import numpy as np
-import seaborn as sns
-from tqdm import tqdm
+
+from demographics import DemographicsRegistry
+from gamlss_args import add_fit_arguments
+from gamlss_bootstrap import report_incomplete, run_bootstrap
+from gamlss_cache import FitCache, cached_runner, update_args
+from gamlss_jobs import FitJob, fit_runner, run_fit_jobs, write_timing_report
+from gamlss_manifest import new_run_id, reset_output_dir, write_manifest
+from gamlss_plots import plot_network, setup_fonts
 
 
 def _build_arg_parser():
@@ -32,16 +34,17 @@ def _build_arg_parser():
                    help="Network metric(s) for which to fit the GAMLSS model.",
                    nargs="+",
                    required=True)
-    p.add_argument("--rscript",
-                   help="Path to the R script that fits the GAMLSS model.",
-                   required=True)
-    p.add_argument("-n", "--n_cpus",
-                   type=int,
-                   help="Number of CPUs to use.",
-                   default=1)
-    p.add_argument("-f", "--force",
+    add_fit_arguments(p)
+    p.add_argument("--exchange",
+                   choices=["csv", "parquet"],
+                   help="Format of the data handed to gamlss.R. 'parquet' writes the input\n"
+                   "table in a columnar file, each fit reading only its own columns, and\n"
+                   "reads the centiles back in wide format.",
+                   default="csv")
+    p.add_argument("--plots_only", "--plots-only",
                    action="store_true",
-                   help="Overwrite output folder.",
+                   help="Re-render the figure from the results already in output_dir,\n"
+                   "without running R.",
                    default=False)
     p.add_argument("--log_age",
                    action="store_true",
@@ -55,30 +58,38 @@ def _build_arg_parser():
     return p
 
 
-def fetch_font(font_name="Harding"):
+def load_table(args):
     """
-    Fetch a font from the matplotlib font manager.
+    Load the input table, joined to the --demographics registry.
     """
-    font_files = []
-    for font in font_manager.findSystemFonts(fontpaths=None, fontext='ttf'):
-        if font_name.lower() in font.lower():
-            font_files.append(font)
-    if not font_files:
-        raise ValueError(f"Font {font_name} not found in system fonts.")
+    df = pd.read_csv(args.in_dataframe, dtype={"participant_id": str, "subject_id": str, "session_id": str})
+    if args.demographics is not None:
+        df = DemographicsRegistry.load(args.demographics).join(df)
+    return df
 
-    for font_file in font_files:
-        font_manager.fontManager.addfont(font_file)
 
-
-def main():
+def main(args=None):
     parser = _build_arg_parser()
-    args = parser.parse_args()
-
-    # Look if output folder exists.
-    if os.path.exists(args.output_dir):
+    if args is None:
+        args = parser.parse_args()
+
+    if args.plots_only:
+        setup_fonts()
+        plot_network(load_table(args), args.metric, args.output_dir,
+                     log_age=args.log_age, log_y=args.log_y)
+        return
+    if args.rscript is None:
+        parser.error("--rscript is required unless --plots_only is used.")
+    if args.bootstrap_only and args.bootstrap <= 0:
+        parser.error("--bootstrap_only needs the number of replicates (--bootstrap).")
+    run_id = new_run_id()
+
+    # Look if output folder exists. Updates and bootstraps start from the models in it.
+    if args.update or args.bootstrap_only:
+        os.makedirs(args.output_dir, exist_ok=True)
+    elif os.path.exists(args.output_dir):
         if args.force:
-            shutil.rmtree(args.output_dir)
-            os.makedirs(args.output_dir)
+            reset_output_dir(args.output_dir)
         else:
             raise FileExistsError(f"Output folder {args.output_dir} exists."
                                   " Use -f to overwrite.")
@@ -86,177 +97,69 @@ def main():
         os.makedirs(args.output_dir)
 
     # Load dataframe.
-    df = pd.read_csv(args.in_dataframe)
+    df = load_table(args)
 
     # Save temporary dataframe.
-    temp_csv = os.path.join(args.output_dir, "network_data.csv")
-    df.to_csv(temp_csv, index=False)
+    if args.exchange == "parquet":
+        temp_path = os.path.join(args.output_dir, "network_data.parquet")
+        df.to_parquet(temp_path, index=False)
+    else:
+        temp_path = os.path.join(args.output_dir, "network_data.csv")
+        df.to_csv(temp_path, index=False)
 
     # Check for NA values in the metric, age, sex, and cohort columns
     if df[args.metric + ["age", "sex", "cohort"]].isnull().values.any():
         raise ValueError("Data contains NA values in the metric, age, sex, or cohort columns."
                          " Please remove these rows before fitting the GAMLSS model.")
     
-    # Let's build a list of commands to be executed in R but in parallel.
-    cmd = []
-    for metric in args.metric:
-        cmd.append([
-            "Rscript",
-            args.rscript,
-            "--input", temp_csv,
-            "--output", args.output_dir,
-            "--metric", metric
-        ])
-
-    # Execute all commands using the allocated number of CPUs from args.n_cpus.
-    processes = []
-    for i in range(0, len(cmd), args.n_cpus):
-        for j in range(i, min(i + args.n_cpus, len(cmd))):
-            metric_name = cmd[j][-1]  # Get the metric name from the command
-            log_file = os.path.join(args.output_dir, f"{metric_name}_gamlss.log")
-            with open(log_file, 'w') as f:
-                processes.append(subprocess.Popen(cmd[j], stdout=f, stderr=subprocess.STDOUT))
-        for p in processes:
-            p.wait()
-        processes = []
+    # Extra gamlss.R arguments. Only the ones changing the fitted model
+    # are part of the cache key.
+    model_args = ["--search", args.search, "--sbc_tol", str(args.sbc_tol)]
+    r_args = model_args + ["--n_cores", str(args.search_cores)]
+
+    # Build one fit job per metric and run them on the worker pool.
+    prev_args = {metric: update_args(args.output_dir, metric) if args.update else ([], [])
+                 for metric in args.metric}
+    jobs = [FitJob("network", metric, temp_path, args.output_dir, r_args + prev_args[metric][0], n_rows=len(df))
+            for metric in args.metric]
+
+    # Fits restored from the cache skip R entirely.
+    cache = None
+    if args.cache_dir is not None:
+        cache = FitCache(args.cache_dir, args.rscript, args.cache_size)
+        for job in jobs:
+            job.cache_key = cache.key(df, job.metric, model_args + prev_args[job.metric][1])
+
+    if args.bootstrap_only:
+        for job in jobs:
+            job.returncode = 0 if os.path.exists(os.path.join(job.output_dir, f"gamlss_model_{job.metric}.rds")) else 1
+        with fit_runner(args.rscript, args.n_cpus, args.persistent_r) as run_job:
+            report_incomplete(run_bootstrap(jobs, run_job, args.n_cpus, args.bootstrap,
+                                            args.bootstrap_chunk, args.bootstrap_seed))
+        return
+
+    incomplete = []
+    with fit_runner(args.rscript, args.n_cpus, args.persistent_r) as run_job:
+        run_fit_jobs(jobs, cached_runner(run_job, cache), args.n_cpus)
+        # Bootstrap replicates reuse the same workers once the fits are done.
+        if args.bootstrap > 0:
+            incomplete = run_bootstrap(jobs, run_job, args.n_cpus, args.bootstrap,
+                                       args.bootstrap_chunk, args.bootstrap_seed)
+
+    # Report per-job queue-wait and wall time.
+    failed = write_timing_report(jobs, os.path.join(args.output_dir, "gamlss_jobs_timing.tsv"))
+    for job in failed:
+        print(f"GAMLSS fit failed for {job.metric}, see {job.log_file}")
+    report_incomplete(incomplete)
 
     # Plotting
-    fetch_font("Harding")
-    plt.rcParams['font.family'] = 'Harding Text Web'
-    rocket_cmap = sns.color_palette("rocket_r", 6)
-    cohort_cmap = [rocket_cmap[0], rocket_cmap[1], rocket_cmap[2], rocket_cmap[3], rocket_cmap[4], rocket_cmap[5]]  # six cohorts
-
-    # Load results (batch load in a dict all files ending by "_centiles_by_age.csv") and merge them.
-    results_files = [f for f in os.listdir(args.output_dir) if f.endswith("_centiles_by_age.csv")]
-    results_dfs = {}
-    metric_names = []
-    for rf in results_files:
-        metric_name = rf.replace("_centiles_by_age.csv", "")
-        metric_names.append(metric_name)
-        temp_df = pd.read_csv(os.path.join(args.output_dir, rf))
-        results_dfs[metric_name] = temp_df
-        results_dfs[metric_name] = results_dfs[metric_name].pivot(index="age", columns='prob', values="metric").reset_index()
-
-    # Dict of y labels for each metric.
-    y_labels = {
-        "GlobalEfficiency": "Global Efficiency",
-        "LocalEfficiency": "Local Efficiency",
-        "AverageStrength": "Average Strength",
-        "Modularity": "Modularity",
-        "AverageBetweennessCentrality": "Average BC",
-        "RichClubCoefficient": "Rich Club Coefficient",
-    }
-
-    # Let's plot the data.
-    fig, ax = plt.subplots(2, len(args.metric) if len(args.metric) > 1 else 2, figsize=(18, 6), sharex=True, squeeze=True)
-    for i, metric in enumerate(args.metric):
-
-        # Let's define the ylim based on the data
-        # Take the max/min, and round to the next 0.1, 0.01, 0.001 or 0.0001 depending on the range.
-        data_max = df[metric].max()
-        data_min = df[metric].min()
-        data_range = data_max - data_min
-        if data_range > 0.1:
-            ylim_max = round(data_max + 0.1, 1)
-            ylim_min = round(max(0, data_min - 0.1), 1)
-        elif data_range > 0.01:
-            ylim_max = round(data_max + 0.01, 2)
-            ylim_min = round(max(0, data_min - 0.01), 2)
-        elif data_range > 0.001:
-            ylim_max = round(data_max + 0.001, 3)
-            ylim_min = round(max(0, data_min - 0.001), 3)
-        else:
-            ylim_max = round(data_max + 0.0001, 4)
-            ylim_min = round(max(0, data_min - 0.0001), 4)
-
-        sns.scatterplot(data=df, x="age", y=metric, ax=ax[0, i],
-                        hue="cohort", style="sex", palette=cohort_cmap, legend=False,
-                        hue_order=["MYRNA", "BCP", "ABCD", "GESTE", "BANDA", "PING"])
-        if not args.log_y:
-            ax[0, i].set_ylim(ylim_min, ylim_max)
-        else:
-            ax[0, i].set_yscale('log')
-        ax[0, i].set_ylabel(y_labels.get(metric, metric), fontsize=14, fontweight='bold')
-        ax[0, i].set_xlabel("")
-        if args.log_age:
-            ax[0, i].set_xscale('log')
-            ax[0, i].set_xticks([0.1, 0.5, 1, 2, 5, 10, 18])
-            ax[0, i].set_xticklabels(['0.1', '0.5', '1', '2', '5', '10', '18'])
-        else:
-            ax[0, i].set_xticks([0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
-            # Plot the centiles.
-        sns.lineplot(data=results_dfs[metric], x="age", y=0.05, ax=ax[1, i], color=rocket_cmap[0], linestyle='--', linewidth=2, legend=False)
-        sns.lineplot(data=results_dfs[metric], x="age", y=0.5, ax=ax[1, i], color=rocket_cmap[5], linestyle='-', linewidth=2, legend=False)
-        sns.lineplot(data=results_dfs[metric], x="age", y=0.95, ax=ax[1, i], color=rocket_cmap[0], linestyle='--', linewidth=2, legend=False)
-        ax[1, i].fill_between(results_dfs[metric]['age'], results_dfs[metric][0.05], results_dfs[metric][0.95], color=rocket_cmap[0], alpha=0.4, zorder=-1)
-        if not args.log_y:
-            ax[1, i].set_ylim(ylim_min, ylim_max)
-        else:
-            ax[1, i].set_yscale('log')
-        ax[1, i].set_xlabel("Age (years)", fontsize=14, fontweight='bold')
-        ax[1, i].set_ylabel(y_labels.get(metric, metric), fontsize=14, fontweight='bold')
-        if args.log_age:
-            ax[1, i].set_xscale('log')
-            ax[1, i].set_xticks([0.1, 0.5, 1, 2, 5, 10, 18])
-            ax[1, i].set_xticklabels(['0.1', '0.5', '1', '2', '5', '10', '18'])
-        else:
-            ax[1, i].set_xticks([0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
-        ax[1, i].tick_params(axis='both', which='major', labelsize=10)
-
-        for row in ax:
-            for a in row:
-                a.spines['top'].set_visible(False)
-                a.spines['right'].set_visible(False)
-                a.spines[["left", "bottom"]].set_linewidth(2)
-                if a.get_ylim()[1] < 0.01 and not args.log_y:
-                    a.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
-
-        # Add global legends: sex, cohorts and centile labels (compact)
-        handles_sex = [plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="o", markeredgewidth=1, markeredgecolor='black'),
-                    plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="x", markeredgewidth=3, markeredgecolor='black')]
-        labels_sex = ["Male", "Female"]
-        fig.legend(handles_sex, labels_sex, loc="upper left", bbox_to_anchor=(0.90, 0.86), ncol=1, fontsize=12, frameon=False, title="Sex", title_fontproperties={'size': 14, 'weight': 'bold'})
-
-        handles_cohort = [plt.Line2D([0], [0], color=cohort_cmap[i], markersize=8, lw=0, marker="o", markeredgewidth=1, markeredgecolor='dimgrey') for i in range(len(cohort_cmap))]
-        labels_cohort = ["MYRNA", "BCP", "ABCD", "GESTE", "BANDA", "PING"]
-        fig.legend(handles_cohort, labels_cohort, loc="upper left", bbox_to_anchor=(0.90, 0.69), ncol=1, fontsize=12, frameon=False, title="Cohort", title_fontproperties={'size': 14, 'weight': 'bold'})
-
-        handles_centile = [plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='-', label='Median'),
-                            plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='--', label='5th/95th Percentiles')]
-    for row in ax:
-        for a in row:
-            a.spines['top'].set_visible(False)
-            a.spines['right'].set_visible(False)
-            a.spines[["left", "bottom"]].set_linewidth(2)
-            if a.get_ylim()[1] < 0.01 and not args.log_y:
-                a.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
-
-    # Add global legends: sex, cohorts and centile labels (compact)
-    handles_sex = [plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="o", markeredgewidth=1, markeredgecolor='black'),
-                plt.Line2D([0], [0], color="black", markersize=10, lw=0, marker="x", markeredgewidth=3, markeredgecolor='black')]
-    labels_sex = ["Male", "Female"]
-    fig.legend(handles_sex, labels_sex, loc="upper left", bbox_to_anchor=(0.90, 0.86), ncol=1, fontsize=12, frameon=False, title="Sex", title_fontproperties={'size': 14, 'weight': 'bold'})
-
-    handles_cohort = [plt.Line2D([0], [0], color=cohort_cmap[i], markersize=8, lw=0, marker="o", markeredgewidth=1, markeredgecolor='dimgrey') for i in range(len(cohort_cmap))]
-    labels_cohort = ["MYRNA", "BCP", "ABCD", "GESTE", "BANDA", "PING"]
-    fig.legend(handles_cohort, labels_cohort, loc="upper left", bbox_to_anchor=(0.90, 0.69), ncol=1, fontsize=12, frameon=False, title="Cohort", title_fontproperties={'size': 14, 'weight': 'bold'})
-
-    handles_centile = [plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='-', label='Median'),
-                        plt.Line2D([0], [0], color="black", markersize=8, lw=3, linestyle='--', label='5th/95th Percentiles')]
-    labels_centile = ["Median", "5th/95th Percentiles"]
-    fig.legend(handles_centile, labels_centile, loc="upper left", bbox_to_anchor=(0.90, 0.36), ncol=1, fontsize=12, frameon=False)
-
-    row_labels = ['a', 'b']
-    ax[0, 0].text(-0.2, 1.07, row_labels[0], transform=ax[0, 0].transAxes, fontsize=18, fontweight='bold', va='top', ha='right')
-    ax[1, 0].text(-0.2, 1.07, row_labels[1], transform=ax[1, 0].transAxes, fontsize=18, fontweight='bold', va='top', ha='right')
-
-    # Some adjustements to space between subplots.
-    plt.subplots_adjust(wspace=0.30)
-
-    #plt.tight_layout(rect=[0, 0, 1, 0.97])
-    plot_path = os.path.join(args.output_dir, "network_GAMLSS_centiles.png")
-    plt.savefig(plot_path, dpi=300, bbox_inches='tight', facecolor='white')
-    plt.close()
+    setup_fonts()
+    start = time.perf_counter()
+    try:
+        plot_network(df, args.metric, args.output_dir, log_age=args.log_age, log_y=args.log_y)
+    finally:
+        write_manifest(args.manifest or os.path.join(args.output_dir, "gamlss_manifest.jsonl"), jobs,
+                       run_id, "networkGAMLSS", {"network": time.perf_counter() - start})
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,204 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+"""
+Score new subjects against the normative GAMLSS models fitted by
+bundleGAMLSS.py (or networkGAMLSS.py).
+
+Every bundle x metric model of the output folder is loaded once, then a
+whole cohort table (subject_id, session_id, age, sex, cohort, bundle and one
+column per metric) is scored in a single vectorized pass per model. For each
+metric, two columns are added: <metric>_centile (0-100) and <metric>_z.
+
+Subjects from a cohort unseen during the fit are scored against the
+reference cohort, as the centile curves are. AFD fixel values are scored
+against the single-shell or multi-shell model depending on the cohort.
+Rows whose sex is missing or unknown to a model get NaN scores.
+
+Usage:
+    python scoreGAMLSS.py <models_dir> --in_dataframe subjects.tsv --out_dataframe scores.tsv
+    python scoreGAMLSS.py <models_dir> --port 8000
+        curl -X POST --data-binary @subjects.tsv http://127.0.0.1:8000/score
+"""
+
+import argparse
+import io
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtri
+
+from gamlss_centiles import GAMLSSModel
+from gamlss_jobs import HIGH_BVAL_COHORTS, LOW_BVAL_COHORTS
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument("models_dir",
+                   help="Output directory of bundleGAMLSS.py (one folder per bundle) or\n"
+                   "of networkGAMLSS.py.")
+    p.add_argument("--in_dataframe",
+                   help="Subjects to score, TSV file in the long format:\n"
+                   "subject_id,session_id,age,sex,cohort,bundle,metric1,metric2,...")
+    p.add_argument("--out_dataframe",
+                   help="Output TSV file with the centiles and z-scores.")
+    p.add_argument("--port",
+                   type=int,
+                   help="Serve the models over HTTP on this port instead of scoring a file.\n"
+                   "POST a TSV/CSV table (or a JSON list of rows) to /score.",
+                   default=None)
+    p.add_argument("--host",
+                   help="Address the HTTP server listens on.",
+                   default="127.0.0.1")
+
+    return p
+
+
+class NormativeModels:
+    """
+    In-memory set of fitted models, keyed by (bundle, metric). Models found
+    directly in the folder (networkGAMLSS.py) are keyed on the bundle
+    "network".
+    """
+
+    def __init__(self, models_dir):
+        self.models = {}
+        for root, _, files in os.walk(models_dir):
+            bundle = os.path.relpath(root, models_dir)
+            bundle = "network" if bundle == "." else bundle
+            for f in files:
+                if f.endswith("_gamlss_params.csv"):
+                    metric = f.replace("_gamlss_params.csv", "")
+                    self.models[(bundle, metric)] = GAMLSSModel.load(os.path.join(root, f))
+        if not self.models:
+            raise ValueError(f"No fitted models (*_gamlss_params.csv) found in {models_dir}.")
+
+        self.metrics = sorted({metric for _, metric in self.models})
+        # The afd_fixel column is scored against the split models.
+        if "afd_fixel_lowb" in self.metrics or "afd_fixel_highb" in self.metrics:
+            self.metrics.append("afd_fixel")
+
+    def _score(self, model, rows):
+        """
+        Percentiles (between 0 and 1) of the rows of a single model.
+        """
+        # Unseen cohorts fall back to the reference cohort of the model,
+        # unknown sexes (missing, other coding) are left as NaN.
+        cohorts = rows["cohort"].astype(str).to_numpy()
+        cohorts = np.where(model.cohorts.get_indexer(cohorts) < 0, model.cohorts[0], cohorts)
+        sexes = rows["sex"].astype(str).to_numpy()
+        unknown = model.sexes.get_indexer(sexes) < 0
+        sexes = np.where(unknown, model.sexes[0], sexes)
+        cdf = model.cdf(rows["value"].to_numpy(dtype=float), rows["age"].to_numpy(dtype=float),
+                        sex=sexes, cohort=cohorts)
+        return np.where(unknown, np.nan, cdf), unknown
+
+    def score(self, df):
+        """
+        Add <metric>_centile and <metric>_z columns for every metric of `df`
+        that has a model. Rows without a matching model or with a sex level
+        unknown to the model are left as NaN.
+        """
+        df = df.reset_index(drop=True)
+        if "bundle" not in df.columns:
+            df["bundle"] = "network"
+
+        scored = df.copy()
+        unknown_sex = np.zeros(len(df), dtype=bool)
+        for metric in [m for m in self.metrics if m in df.columns]:
+            rows = df[["bundle", "age", "sex", "cohort"]].assign(value=df[metric], model=metric)
+            if metric == "afd_fixel":
+                rows["model"] = np.select(
+                    [rows["cohort"].isin(LOW_BVAL_COHORTS), rows["cohort"].isin(HIGH_BVAL_COHORTS)],
+                    ["afd_fixel_lowb", "afd_fixel_highb"], default="")
+
+            cdf = np.full(len(df), np.nan)
+            for (bundle, model_name), group in rows.groupby(["bundle", "model"], sort=False):
+                model = self.models.get((bundle, model_name))
+                if model is not None:
+                    cdf[group.index], unknown = self._score(model, group)
+                    unknown_sex[group.index[unknown]] = True
+
+            scored[f"{metric}_centile"] = 100 * cdf
+            scored[f"{metric}_z"] = ndtri(cdf)
+
+        if unknown_sex.any():
+            levels = sorted({str(sex) for sex in df.loc[unknown_sex, "sex"]})
+            print(f"{unknown_sex.sum()} rows with an unknown sex level ({', '.join(levels)}) "
+                  "were not scored.")
+        return scored
+
+
+def _read_table(body, content_type):
+    if "json" in content_type:
+        return pd.DataFrame(json.loads(body))
+    text = body.decode()
+    sep = "\t" if "\t" in text.split("\n", 1)[0] else ","
+    return pd.read_csv(io.StringIO(text), sep=sep)
+
+
+def serve(models, host, port):
+    """
+    Serve the loaded models over HTTP. POST /score returns the scored rows
+    as JSON.
+    """
+    class ScoreHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != "/score":
+                self.send_error(404, "Unknown endpoint, use POST /score.")
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                scored = models.score(_read_table(body, self.headers.get("Content-Type", "")))
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+
+            payload = scored.to_json(orient="records").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer((host, port), ScoreHandler)
+    print(f"Scoring {len(models.models)} models on http://{host}:{port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args=None):
+    parser = _build_arg_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    if args.port is None and (args.in_dataframe is None or args.out_dataframe is None):
+        parser.error("--in_dataframe and --out_dataframe are required unless --port is given.")
+
+    # Load every model once.
+    models = NormativeModels(args.models_dir)
+
+    if args.port is not None:
+        serve(models, args.host, args.port)
+        return
+
+    # Load dataframe.
+    df = pd.read_csv(args.in_dataframe, sep="\t")
+    missing = {"age", "sex", "cohort"} - set(df.columns)
+    if missing:
+        raise ValueError(f"Missing columns in {args.in_dataframe}: {', '.join(sorted(missing))}.")
+
+    scores = models.score(df)
+    scores.to_csv(args.out_dataframe, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
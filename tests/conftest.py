@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+The scripts are not a package: make them importable by the tests.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+from connectome_store import ConnectomeStore, normalize
+
+
+def _save(folder, name, mat, mtime_ns=None):
+    path = os.path.join(folder, name)
+    np.save(path, mat)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return mat
+
+
+def _random_matrix(rng, n):
+    mat = np.triu(rng.random((n, n)), k=1)
+    return mat + mat.T
+
+
+def _check(store, expected):
+    stored = store.to_dict()
+    assert stored.keys() == expected.keys()
+    for key, mat in expected.items():
+        np.testing.assert_allclose(stored[key], normalize(mat), rtol=1e-12)
+
+
+def test_add_update_reorder(tmp_path):
+    rng = np.random.default_rng(0)
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    expected = {
+        ("sub-01", "ses-1"): _save(first, "sub-01_ses-1_connectome.npy", _random_matrix(rng, 5)),
+        ("sub-01", "ses-2"): _save(first, "sub-01_ses-2_connectome.npy", _random_matrix(rng, 5)),
+        ("sub-02", ""): _save(first, "sub-02_connectome.npy", _random_matrix(rng, 8)),
+        ("sub-03", ""): _save(second, "sub-03_connectome.npy", _random_matrix(rng, 5)),
+    }
+
+    store = ConnectomeStore(str(tmp_path / "store"))
+    assert store.add("A", str(first)) == 3
+    assert store.add("B", str(second)) == 1
+    assert store.sizes == [5, 8]
+    _check(store, expected)
+
+    # Unchanged files are skipped.
+    assert store.add("A", str(first)) == 0
+
+    # A changed file is overwritten in place, a new one is appended.
+    expected[("sub-01", "ses-1")] = _save(first, "sub-01_ses-1_connectome.npy", _random_matrix(rng, 5),
+                                          mtime_ns=1)
+    expected[("sub-04", "")] = _save(first, "sub-04_connectome.npy", _random_matrix(rng, 5))
+    assert store.add("A", str(first)) == 2
+    assert len(store.matrices(5)) == 4
+    _check(store, expected)
+
+    # A matrix of a different size than the stored one is refused, and the
+    # matrices appended before it are dropped, leaving the store unchanged.
+    _save(second, "sub-02_connectome.npy", _random_matrix(rng, 5))
+    _save(second, "sub-00_connectome.npy", _random_matrix(rng, 5))
+    with pytest.raises(ValueError):
+        store.add("B", str(second))
+    assert os.path.getsize(store._data_path(5)) == 4 * 5 * 5 * 8
+    _check(ConnectomeStore(str(tmp_path / "store")), expected)
+
+    # Reordered matrices follow the keys, the others are kept after them.
+    store.reorder([("sub-04", ""), ("sub-03", ""), ("sub-01", "ses-1")])
+    store = ConnectomeStore(str(tmp_path / "store"))
+    _check(store, expected)
+    assert list(store.index["participant_id"]) == ["sub-04", "sub-03", "sub-01", "sub-01", "sub-02"]
+    assert list(store.index["offset"]) == [0, 1, 2, 3, 0]
+
+    # Contiguous selections are views of the memory map.
+    selection = store.get(store.index["participant_id"].isin(["sub-04", "sub-03"]))
+    assert isinstance(selection, np.memmap)
+    np.testing.assert_allclose(selection, [normalize(expected[("sub-04", "")]),
+                                           normalize(expected[("sub-03", "")])], rtol=1e-12)
+    with pytest.raises(ValueError):
+        store.get(store.index["participant_id"].isin(["sub-01", "sub-02"]))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import json
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+from nibabel.streamlines import Tractogram
+from nibabel.streamlines import TrkFile as NibabelTrkFile
+
+from dice_score import TrkFile, compare_bundles, traversed_voxels
+
+DIMS = (20, 20, 20)
+AFFINE = np.array([[2., 0, 0, -20], [0, 2, 0, -20], [0, 0, 2, -20], [0, 0, 0, 1]])
+
+
+def _save_trk(path, streamlines, scalars=False):
+    tractogram = Tractogram(streamlines, affine_to_rasmm=np.eye(4))
+    if scalars:
+        tractogram.data_per_point = {"fa": [np.full((len(s), 1), 0.5, np.float32) for s in streamlines]}
+        tractogram.data_per_streamline = {"id": np.arange(2 * len(streamlines), dtype=np.float32)
+                                          .reshape(-1, 2)}
+    header = {"dimensions": DIMS, "voxel_sizes": (2., 2., 2.), "voxel_to_rasmm": AFFINE}
+    NibabelTrkFile(tractogram, header=header).save(str(path))
+    return str(path)
+
+
+def _random_streamlines(rng, n):
+    # Random walks (RAS mm) kept inside the grid, from 3 to 40 points.
+    return [np.clip(rng.uniform(-15, 5, 3) + np.cumsum(rng.normal(0, 1, (length, 3)), axis=0),
+                    -19.5, 19.5).astype(np.float32)
+            for length in rng.integers(3, 40, n)]
+
+
+@pytest.fixture
+def bundle_pair(tmp_path):
+    rng = np.random.default_rng(1)
+    shared = _random_streamlines(rng, 60)
+    return (_save_trk(tmp_path / "test.trk", shared + _random_streamlines(rng, 20)),
+            _save_trk(tmp_path / "retest.trk", shared + _random_streamlines(rng, 30)))
+
+
+def test_points_match_nibabel(tmp_path):
+    streamlines = _random_streamlines(np.random.default_rng(0), 50)
+    trk = TrkFile(_save_trk(tmp_path / "scalars.trk", streamlines, scalars=True))
+
+    assert list(trk.lengths) == [len(s) for s in streamlines]
+    points = np.concatenate([p for _, p in trk.chunks(max_points=64)])
+    # Voxel space with the corner (not the center) of the first voxel at 0.
+    expected = (np.concatenate(streamlines) + 20) / 2 + 0.5
+    np.testing.assert_allclose(points, expected, atol=1e-5)
+
+
+def test_identical_bundles(bundle_pair):
+    scores = compare_bundles(bundle_pair[0], bundle_pair[0])
+    assert scores["dice_voxels"] == scores["w_dice_voxels"] == scores["dice_streamlines"] == 1
+
+
+def test_empty_bundles(tmp_path, bundle_pair):
+    empty = _save_trk(tmp_path / "empty.trk", [])
+    scores = compare_bundles(empty, _save_trk(tmp_path / "empty2.trk", []))
+    assert scores["n_streamlines_test"] == scores["n_voxels_test"] == 0
+    assert np.isnan([scores["dice_voxels"], scores["w_dice_voxels"], scores["dice_streamlines"]]).all()
+
+    scores = compare_bundles(empty, bundle_pair[1])
+    assert scores["dice_voxels"] == scores["w_dice_voxels"] == scores["dice_streamlines"] == 0
+
+
+def test_density_matches_scilpy():
+    metrics = pytest.importorskip("scilpy.tractanalysis.streamlines_metrics")
+    rng = np.random.default_rng(3)
+    dims = (30, 30, 30)
+    streamlines = [np.clip(rng.uniform(5, 25, 3) + np.cumsum(rng.normal(0, 1.5, (n, 3)), axis=0),
+                           0.01, 29.99).astype(np.float32) for n in rng.integers(2, 60, 300)]
+
+    ids = np.repeat(np.arange(len(streamlines)), [len(s) for s in streamlines])
+    ids, voxels = traversed_voxels(ids, np.concatenate(streamlines))
+    keys = np.unique(ids * np.prod(dims) + np.ravel_multi_index(voxels.T, dims))
+    density = np.bincount(keys % np.prod(dims), minlength=np.prod(dims)).reshape(dims)
+
+    np.testing.assert_array_equal(density, metrics.compute_tract_counts_map(streamlines, dims))
+
+
+@pytest.mark.skipif(shutil.which("scil_bundle_pairwise_comparison") is None,
+                    reason="scilpy is not installed")
+def test_dice_matches_scilpy(bundle_pair, tmp_path):
+    out_json = tmp_path / "scilpy.json"
+    subprocess.run(["scil_bundle_pairwise_comparison", *bundle_pair, str(out_json),
+                    "--streamline_dice", "-f"], check=True, capture_output=True)
+    with open(out_json) as f:
+        expected = json.load(f)
+
+    scores = compare_bundles(*bundle_pair)
+    for name in ("dice_voxels", "w_dice_voxels", "dice_streamlines"):
+        assert scores[name] == pytest.approx(expected[name][0], rel=1e-6)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from gamlss_centiles import NU_EPS, GAMLSSModel, gg_cdf, gg_quantile
+
+PROBS = np.array([1e-4, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1 - 1e-4])
+
+
+@pytest.mark.parametrize("nu", [-2.0, -0.5, -1e-3, -NU_EPS / 2, 0.0, NU_EPS / 2, 1e-3, 0.5, 1.0, 3.0])
+@pytest.mark.parametrize("mu, sigma", [(0.7, 0.05), (1.0, 0.2), (2.5e-3, 0.5)])
+def test_quantile_cdf_round_trip(mu, sigma, nu):
+    y = gg_quantile(PROBS, mu, sigma, nu)
+    assert np.all(np.diff(y) > 0)
+    np.testing.assert_allclose(gg_cdf(y, mu, sigma, nu), PROBS, rtol=1e-7, atol=1e-12)
+
+
+def test_quantile_cdf_broadcast():
+    mu, sigma, nu = np.meshgrid([0.5, 1.0, 4.0], [0.1, 0.3], [-1.0, 0.0, 0.7], indexing="ij")
+    p = np.linspace(0.02, 0.98, 7)[:, None, None, None]
+    y = gg_quantile(p, mu, sigma, nu)
+    assert y.shape == (7,) + mu.shape
+    np.testing.assert_allclose(gg_cdf(y, mu, sigma, nu), np.broadcast_to(p, y.shape), rtol=1e-7)
+
+
+def test_gamma_and_lognormal_cases():
+    # nu = 1 is a gamma distribution of mean mu and coefficient of variation
+    # sigma, nu = 0 a lognormal of median mu.
+    mu, sigma = 1.5, 0.3
+    gamma = stats.gamma(a=1 / sigma ** 2, scale=mu * sigma ** 2)
+    np.testing.assert_allclose(gg_quantile(PROBS, mu, sigma, 1.0), gamma.ppf(PROBS), rtol=1e-9)
+    lognormal = stats.lognorm(s=sigma, scale=mu)
+    np.testing.assert_allclose(gg_quantile(PROBS, mu, sigma, 0.0), lognormal.ppf(PROBS), rtol=1e-12)
+
+    # The lognormal limit is continuous around the NU_EPS cutoff.
+    np.testing.assert_allclose(gg_quantile(PROBS, mu, sigma, 2 * NU_EPS),
+                               lognormal.ppf(PROBS), rtol=1e-5)
+
+
+def _params_table():
+    ages = np.linspace(0, 10, 11)
+    rows = []
+    for sex, scale in [("F", 1.0), ("M", 1.2)]:
+        for cohort, nu in [("A", 0.5), ("B", -0.3)]:
+            for age in ages:
+                rows.append({"sex": sex, "cohort": cohort, "age": age,
+                             "mu": scale * np.exp(0.1 * age), "sigma": 0.1 + 0.01 * age, "nu": nu + 0.02 * age})
+    return pd.DataFrame(rows)
+
+
+def test_model_interpolation():
+    table = _params_table()
+    model = GAMLSSModel(table.sample(frac=1, random_state=0))
+
+    # Exact on the grid.
+    ref = table[(table["sex"] == "M") & (table["cohort"] == "B")]
+    params = model.params(ref["age"], sex="M", cohort="B")
+    for name in ["mu", "sigma", "nu"]:
+        np.testing.assert_allclose(params[name], ref[name], rtol=1e-12)
+
+    # Linear on the link scale between grid ages, NaN outside the grid.
+    params = model.params([2.5, -1.0, 10.5])
+    np.testing.assert_allclose(params["mu"][0], np.exp(0.25), rtol=1e-12)
+    np.testing.assert_allclose(params["sigma"][0], np.sqrt(0.12 * 0.13), rtol=1e-12)
+    np.testing.assert_allclose(params["nu"][0], 0.55, rtol=1e-12)
+    assert np.isnan(params["mu"][1:]).all()
+
+    ages = np.array([1.3, 4.0, 9.9])
+    sexes = np.array(["F", "M", "M"])
+    y = model.quantile(0.3, ages, sex=sexes, cohort="B")
+    np.testing.assert_allclose(model.cdf(y, ages, sex=sexes, cohort="B"), 0.3, rtol=1e-9)
+    np.testing.assert_allclose(model.zscore(y, ages, sex=sexes, cohort="B"), stats.norm.ppf(0.3), rtol=1e-7)
+
+    centiles = model.centiles(ages, probs=[0.05, 0.5, 0.95])
+    assert list(centiles.columns) == ["age", 0.05, 0.5, 0.95]
+    assert (np.diff(centiles[[0.05, 0.5, 0.95]].to_numpy(), axis=1) > 0).all()
+
+    with pytest.raises(KeyError):
+        model.params(ages, sex="X")
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from gamlss_io import bundle_row_groups, load_centiles, write_bundle_table
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def test_bundle_table_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"bundle": rng.choice(["AF_L", "AF_R", "CST_L"], 50),
+                       "age": rng.uniform(0, 18, 50),
+                       "sex": rng.choice(["F", "M"], 50),
+                       "fa": rng.random(50)})
+    path = str(tmp_path / "input.parquet")
+    bundles = ["CST_L", "empty", "AF_L", "AF_R"]
+
+    row_groups = write_bundle_table(df, path, bundles)
+    assert row_groups == {bundle: i for i, bundle in enumerate(bundles)}
+    # Bundles without rows are not found in the file.
+    assert bundle_row_groups(path) == {b: i for b, i in row_groups.items() if b != "empty"}
+
+    parquet = pq.ParquetFile(path)
+    for bundle in ["CST_L", "AF_L", "AF_R"]:
+        read = parquet.read_row_group(row_groups[bundle]).to_pandas()
+        pd.testing.assert_frame_equal(read, df[df["bundle"] == bundle].reset_index(drop=True))
+
+
+def test_load_centiles(tmp_path):
+    ages = [0.0, 1.0, 2.0]
+    long_df = pd.DataFrame({"age": np.repeat(ages, 2), "prob": [0.05, 0.95] * 3,
+                            "metric": [0.1, 0.9, 0.2, 1.0, 0.3, 1.1]})
+    long_df.to_csv(tmp_path / "fa_centiles_by_age.csv", index=False)
+    long_df.to_csv(tmp_path / "md_centiles_by_age.csv", index=False)
+    # gamlss.R writes the centile columns of the parquet tables as strings.
+    pd.DataFrame({"age": ages, "0.05": [1.0, 2.0, 3.0], "0.95": [4.0, 5.0, 6.0]}).to_parquet(
+        tmp_path / "md_centiles_by_age.parquet")
+
+    centiles = load_centiles(str(tmp_path))
+    assert sorted(centiles) == ["fa", "md"]
+    for metric, low in [("fa", [0.1, 0.2, 0.3]), ("md", [1.0, 2.0, 3.0])]:
+        assert list(centiles[metric].columns) == ["age", 0.05, 0.95]
+        np.testing.assert_array_equal(centiles[metric]["age"], ages)
+        np.testing.assert_array_equal(centiles[metric][0.05], low)
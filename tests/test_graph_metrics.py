@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from graph_metrics import METRICS, compute_graph_metrics, shortest_path_lengths
+
+nx = pytest.importorskip("networkx")
+
+
+def _random_connectomes(rng, n_subjects, n_nodes, density):
+    # Symmetric weighted matrices with an empty diagonal, some of them with
+    # several components and isolated nodes.
+    weights = np.triu(rng.random((n_subjects, n_nodes, n_nodes)), k=1)
+    weights *= rng.random(weights.shape) < density
+    return weights + weights.transpose(0, 2, 1)
+
+
+def _networkx_metrics(mat):
+    # Metrics of the networkx graph, as computed in notebooks/network.ipynb.
+    G = nx.from_numpy_array(mat)
+    return {
+        "Density": np.sum(mat > 0) / (mat.shape[0] * (mat.shape[1])),
+        "GlobalEfficiency": nx.global_efficiency(G),
+        "LocalEfficiency": nx.local_efficiency(G),
+        "AverageStrength": np.mean([val for (node, val) in G.degree(weight='weight')]),
+        "Modularity": nx.algorithms.community.modularity(
+            G, list(nx.algorithms.community.greedy_modularity_communities(G))),
+        "AverageBetweennessCentrality": np.mean(list(nx.betweenness_centrality(G, weight=None).values())),
+        "RichClubCoefficient": np.mean(list(nx.rich_club_coefficient(G, normalized=False).values())),
+    }
+
+
+@pytest.mark.parametrize("n_nodes, density", [(12, 0.15), (20, 0.3), (30, 0.6)])
+def test_metrics_match_networkx(n_nodes, density):
+    matrices = _random_connectomes(np.random.default_rng(n_nodes), 8, n_nodes, density)
+    # Batches smaller than the stack.
+    metrics = compute_graph_metrics(matrices, batch_size=3)
+
+    for i, mat in enumerate(matrices):
+        expected = _networkx_metrics(mat)
+        for metric in METRICS:
+            assert metrics[metric][i] == pytest.approx(expected[metric], rel=1e-9, abs=1e-12), metric
+
+
+def test_shortest_path_lengths_match_networkx():
+    adj = _random_connectomes(np.random.default_rng(0), 4, 25, 0.1) > 0
+    dist = shortest_path_lengths(adj)
+
+    for a, d in zip(adj, dist):
+        expected = np.full(d.shape, np.inf)
+        for source, lengths in nx.all_pairs_shortest_path_length(nx.from_numpy_array(a.astype(int))):
+            expected[source, list(lengths)] = list(lengths.values())
+        np.testing.assert_array_equal(d, expected)